@@ -0,0 +1,175 @@
+"""
+Сравнение задержки колбэка дашборда на Postgres и DuckDB.
+
+Генерирует синтетические данные (по умолчанию 10 млн строк) одними и теми же
+детерминированными формулами в обоих бэкендах и замеряет время
+dashboard_aggregates + build_figures для нескольких наборов фильтров.
+
+    python -m benchmarks.dashboard_backends --rows 10000000 --populate --backends duckdb,postgres
+
+Для Postgres нужна отдельная пустая база (DB_* в .env): данные пишутся прямо в local_logs.
+"""
+
+import argparse
+import json
+import logging
+import statistics
+import time
+import duckdb
+from log_export.backends import get_backend
+from log_export.queries import normalize_filters
+from rendering.dashboard import build_figures
+
+PATHS = 500
+IPS = 50000
+START = '2023-01-01 00:00:00+00'
+STEP_SECONDS = 3
+
+SCENARIOS = {
+    'all': ('all', 'all', 'all', 'all'),
+    'month': ('2023-03-01T00:00:00', '2023-03-31T00:00:00', 'all', 'all'),
+    'status_get': ('2023-01-01T00:00:00', '2023-12-31T00:00:00', 500, 'GET'),
+}
+
+REQUEST_TYPES = ['GET', 'POST', 'PUT', 'DELETE']
+STATUS_CODES = [200, 200, 200, 200, 303, 304, 403, 404, 500, 502]
+
+
+def _case(expr, values):
+    """CASE-выражение, выбирающее значение по индексу (одинаково для Postgres и DuckDB)."""
+    whens = ' '.join(f"WHEN {i} THEN {v!r}" if isinstance(v, str) else f"WHEN {i} THEN {v}"
+                     for i, v in enumerate(values))
+    return f"CASE {expr} {whens} END"
+
+
+def populate_duckdb(path, rows):
+    """Создает таблицу logs с синтетическими данными в файле DuckDB."""
+    conn = duckdb.connect(path)
+    conn.execute("DROP TABLE IF EXISTS logs")
+    conn.execute(f"""
+        CREATE TABLE logs AS
+        SELECT
+            i AS log_id,
+            '10.' || ((i * 7919) % {IPS} // 256) || '.' || ((i * 7919) % {IPS} % 256) || '.1' AS ip_address,
+            'bench-agent/' || (i % 5) AS user_agent,
+            'Bench' AS browser,
+            'Linux' AS os,
+            'PC' AS device_type,
+            TIMESTAMPTZ '{START}' + to_seconds(i * {STEP_SECONDS}) AS timestamp_utc,
+            {_case(f'(i % {len(REQUEST_TYPES)})', REQUEST_TYPES)} AS request_type,
+            '/api/v1/resource' || ((i * 31) % {PATHS}) AS api_path,
+            'HTTP/1.1' AS protocol,
+            {_case(f'((i * 13) % {len(STATUS_CODES)})', STATUS_CODES)} AS status_code,
+            (i * 17) % 10000 AS bytes_sent,
+            NULL::VARCHAR AS referrer_url,
+            (i * 37) % 5000 AS response_time
+        FROM range({rows}) t(i)
+    """)
+    conn.close()
+
+
+def populate_postgres(rows):
+    """Заполняет пустую базу Postgres теми же синтетическими данными."""
+    from log2db.db import create_tables
+    backend = get_backend('postgres')
+    with backend.connect() as conn:
+        create_tables(conn)
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT EXISTS (SELECT 1 FROM local_logs)")
+            if cursor.fetchone()[0]:
+                raise RuntimeError("local_logs не пуста: для бенчмарка нужна отдельная пустая база")
+            cursor.execute(f"""
+                INSERT INTO dim_ip_client (ip_client_id, ip_address)
+                SELECT g + 1, '10.' || (g / 256) || '.' || (g % 256) || '.1' FROM generate_series(0, {IPS - 1}) g
+            """)
+            cursor.execute("""
+                INSERT INTO dim_user_agent (user_agent_id, user_agent, browser, os, device_type)
+                SELECT g + 1, 'bench-agent/' || g, 'Bench', 'Linux', 'PC' FROM generate_series(0, 4) g
+            """)
+            cursor.execute(f"""
+                INSERT INTO dim_request_type (request_type_id, request_type)
+                SELECT g + 1, {_case('g', REQUEST_TYPES)} FROM generate_series(0, {len(REQUEST_TYPES) - 1}) g
+            """)
+            cursor.execute(f"""
+                INSERT INTO dim_api (api_id, api_path)
+                SELECT g + 1, '/api/v1/resource' || g FROM generate_series(0, {PATHS - 1}) g
+            """)
+            cursor.execute("INSERT INTO dim_protocol (protocol_id, protocol) VALUES (1, 'HTTP/1.1')")
+            cursor.execute(f"""
+                INSERT INTO dim_time (time_id, timestamp_utc, year, month, day, hour, minute, second, weekday)
+                SELECT g + 1, ts, EXTRACT(YEAR FROM ts), EXTRACT(MONTH FROM ts), EXTRACT(DAY FROM ts),
+                       EXTRACT(HOUR FROM ts), EXTRACT(MINUTE FROM ts), EXTRACT(SECOND FROM ts),
+                       EXTRACT(ISODOW FROM ts) - 1
+                FROM (
+                    SELECT g, (TIMESTAMPTZ '{START}' + g * interval '{STEP_SECONDS} seconds') AT TIME ZONE 'UTC' AS ts
+                    FROM generate_series(0, {rows - 1}) g
+                ) s
+            """)
+            cursor.execute(f"""
+                INSERT INTO local_logs (
+                    ip_client_id, user_agent_id, time_id, timestamp_utc, request_type_id, api_id,
+                    protocol_id, status_code, bytes_sent, referrer_id, response_time
+                )
+                SELECT (g * 7919) % {IPS} + 1, g % 5 + 1, g + 1,
+                       TIMESTAMPTZ '{START}' + g * interval '{STEP_SECONDS} seconds',
+                       g % {len(REQUEST_TYPES)} + 1, (g * 31) % {PATHS} + 1, 1,
+                       {_case(f'((g * 13) % {len(STATUS_CODES)})', STATUS_CODES)},
+                       (g * 17) % 10000, NULL, (g * 37) % 5000
+                FROM generate_series(0, {rows - 1}) g
+            """)
+            for table, id_col in [('dim_ip_client', 'ip_client_id'), ('dim_user_agent', 'user_agent_id'),
+                                  ('dim_request_type', 'request_type_id'), ('dim_api', 'api_id'),
+                                  ('dim_protocol', 'protocol_id'), ('dim_time', 'time_id')]:
+                cursor.execute(f"SELECT setval(pg_get_serial_sequence('{table}', '{id_col}'), (SELECT MAX({id_col}) FROM {table}))")
+            cursor.execute("ANALYZE")
+        conn.commit()
+
+
+def measure(backend_name, repeats, **connect_kwargs):
+    """Замеряет задержку колбэка (агрегаты + построение графиков) по сценариям, в мс."""
+    backend = get_backend(backend_name)
+    results = {}
+    for scenario, args in SCENARIOS.items():
+        filters = normalize_filters(*args)
+        timings = []
+        for _ in range(repeats):
+            started = time.perf_counter()
+            with backend.connect(**connect_kwargs) as conn:
+                aggregates = backend.dashboard_aggregates(conn, filters)
+            build_figures(aggregates)
+            timings.append((time.perf_counter() - started) * 1000)
+        results[scenario] = {
+            'median_ms': round(statistics.median(timings), 2),
+            'min_ms': round(min(timings), 2),
+            'max_ms': round(max(timings), 2),
+        }
+        logging.info(f"{backend_name}/{scenario}: медиана {results[scenario]['median_ms']} мс")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=10_000_000)
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--backends', default='duckdb', help="duckdb, postgres или оба через запятую")
+    parser.add_argument('--duckdb-path', default='bench_analytics.duckdb')
+    parser.add_argument('--populate', action='store_true', help="сгенерировать данные перед замером")
+    args = parser.parse_args()
+
+    backends = [b.strip() for b in args.backends.split(',') if b.strip()]
+    report = {'rows': args.rows, 'repeats': args.repeats, 'results': {}}
+    for name in backends:
+        if args.populate:
+            started = time.perf_counter()
+            if name == 'duckdb':
+                populate_duckdb(args.duckdb_path, args.rows)
+            else:
+                populate_postgres(args.rows)
+            logging.info(f"Данные для {name} сгенерированы за {time.perf_counter() - started:.1f} с")
+        connect_kwargs = {'path': args.duckdb_path, 'parquet_dir': ''} if name == 'duckdb' else {}
+        report['results'][name] = measure(name, args.repeats, **connect_kwargs)
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+
+
+if __name__ == '__main__':
+    main()
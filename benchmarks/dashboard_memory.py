@@ -0,0 +1,90 @@
+"""
+Объем памяти DataFrame дашборда: прежнее представление против компактного.
+
+Прежнее — как возвращал pd.read_sql_query: строки измерений object, целые int64,
+плюс колонки year/month/day/hour/minute/second/weekday. Компактное — как fetch_logs:
+category по id измерений, суженные целые, без компонент времени.
+
+    python -m benchmarks.dashboard_memory --rows 1000000
+"""
+
+import argparse
+import json
+import numpy as np
+import pandas as pd
+from log_export.compact import TIME_PART_COLUMNS, categorical_from_ids, downcast_integers, memory_usage_mb
+
+# Кардинальности измерений, близкие к реальным логам веб-сервера
+CARDINALITY = {
+    'ip_address': 50000,
+    'user_agent': 300,
+    'request_type': 4,
+    'api_path': 500,
+    'protocol': 2,
+    'referrer_url': 2000,
+}
+
+
+def _dimension_values(name, size):
+    if name == 'ip_address':
+        return np.array([f"10.{i // 65536}.{i // 256 % 256}.{i % 256}" for i in range(size)], dtype=object)
+    if name == 'request_type':
+        return np.array(['GET', 'POST', 'PUT', 'DELETE'][:size], dtype=object)
+    if name == 'protocol':
+        return np.array(['HTTP/1.0', 'HTTP/1.1'][:size], dtype=object)
+    if name == 'user_agent':
+        return np.array([f"Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 Chrome/{i}.0 Safari/537.36"
+                         for i in range(size)], dtype=object)
+    if name == 'api_path':
+        return np.array([f"/api/v1/resource/{i}" for i in range(size)], dtype=object)
+    return np.array([f"https://www.example{i}.com/page.html" for i in range(size)], dtype=object)
+
+
+def build_frames(rows, seed=42):
+    """Строит одинаковые данные в прежнем и компактном представлении."""
+    rng = np.random.default_rng(seed)
+    timestamps = pd.to_datetime(
+        1672531200 + np.sort(rng.integers(0, 365 * 86400, rows)), unit='s', utc=True)
+    legacy = {'log_id': np.arange(1, rows + 1, dtype=np.int64)}
+    compact = {'log_id': legacy['log_id']}
+    for name, size in CARDINALITY.items():
+        dim_ids = np.arange(1, size + 1, dtype=np.int64)
+        values = _dimension_values(name, size)
+        ids = rng.zipf(1.3, rows) % size + 1
+        legacy[name] = values[ids - 1]
+        compact[name] = categorical_from_ids(ids, dim_ids, values)
+    legacy['timestamp_utc'] = timestamps
+    compact['timestamp_utc'] = timestamps
+    for part in TIME_PART_COLUMNS:
+        source = 'dayofweek' if part == 'weekday' else part
+        legacy[part] = getattr(timestamps, source).to_numpy().astype(np.int64)
+    numeric = {
+        'status_code': rng.choice([200, 303, 304, 403, 404, 500, 502], rows),
+        'bytes_sent': rng.integers(0, 100000, rows),
+        'response_time': rng.integers(0, 5000, rows),
+    }
+    legacy.update({name: values.astype(np.int64) for name, values in numeric.items()})
+    compact.update(numeric)
+    return pd.DataFrame(legacy), downcast_integers(pd.DataFrame(compact))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=1_000_000)
+    args = parser.parse_args()
+
+    legacy, compact = build_frames(args.rows)
+    before = memory_usage_mb(legacy)
+    after = memory_usage_mb(compact)
+    print(json.dumps({
+        'rows': args.rows,
+        'legacy_mb': round(before, 1),
+        'compact_mb': round(after, 1),
+        'ratio': round(before / after, 1),
+        'legacy_by_column_mb': (legacy.memory_usage(deep=True, index=False) / 2 ** 20).round(1).to_dict(),
+        'compact_by_column_mb': (compact.memory_usage(deep=True, index=False) / 2 ** 20).round(1).to_dict(),
+    }, ensure_ascii=False, indent=2))
+
+
+if __name__ == '__main__':
+    main()
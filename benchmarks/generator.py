@@ -0,0 +1,134 @@
+"""
+Детерминированный генератор синтетических логов веб-сервера.
+
+Поддерживает оба формата парсера (alt и nginx), управляет кардинальностью
+IP, User-Agent, путей и рефереров и пишет файл потоково, поэтому
+масштабируется до сотен миллионов строк.
+
+    python -m benchmarks.generator --lines 100000000 --format nginx --out big.log
+"""
+
+import argparse
+import bisect
+import itertools
+import random
+from datetime import datetime, timedelta, timezone
+
+FORMATS = ('alt', 'nginx')
+METHODS = ['GET', 'POST', 'PUT', 'DELETE']
+METHOD_WEIGHTS = [70, 15, 10, 5]
+STATUS_CODES = [200, 303, 304, 403, 404, 500, 502]
+STATUS_WEIGHTS = [70, 5, 8, 3, 8, 4, 2]
+PROTOCOLS = ['HTTP/1.0', 'HTTP/1.1', 'HTTP/2.0']
+
+UA_TEMPLATES = [
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/{major}.0.{minor}.0 Safari/537.36",
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:{major}.0) Gecko/20100101 Firefox/{major}.0",
+    "Mozilla/5.0 (iPhone; CPU iPhone OS 12_4_{minor} like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/12.1.2 Mobile/15E148 Safari/604.1",
+    "Mozilla/5.0 (Linux; Android 10; ONEPLUS A6000) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/{major}.0.{minor}.141 Mobile Safari/537.36",
+    "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_{minor}) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/{major}.0 Safari/605.1.15",
+]
+
+PATH_SEGMENTS = ['usr', 'api', 'admin', 'login', 'register', 'orders', 'items', 'search', 'profile', 'static']
+
+
+def _zipf_cumulative(size, skew):
+    """Накопленные веса распределения Ципфа для выбора значения по рангу."""
+    return list(itertools.accumulate(1.0 / (rank ** skew) for rank in range(1, size + 1)))
+
+
+class _Pool:
+    """Набор значений с Ципф-распределением частот."""
+
+    def __init__(self, values, skew):
+        self.values = values
+        self.cumulative = _zipf_cumulative(len(values), skew)
+        self.total = self.cumulative[-1]
+
+    def pick(self, rng):
+        return self.values[bisect.bisect_left(self.cumulative, rng.random() * self.total)]
+
+
+def _build_pools(rng, ips, user_agents, paths, referrers, skew):
+    ip_pool = [f"{rng.randint(1, 223)}.{rng.randint(0, 255)}.{rng.randint(0, 255)}.{rng.randint(1, 254)}"
+               for _ in range(ips)]
+    ua_pool = [UA_TEMPLATES[i % len(UA_TEMPLATES)].format(major=70 + i // len(UA_TEMPLATES) % 40, minor=i)
+               for i in range(user_agents)]
+    path_pool = ['/' + '/'.join(rng.sample(PATH_SEGMENTS, rng.randint(1, 3))) + (f"/{i}" if i >= len(PATH_SEGMENTS) else '')
+                 for i in range(paths)]
+    referrer_pool = [f"https://www.site{i}.example/{rng.choice(PATH_SEGMENTS)}.html" for i in range(referrers)] + ['-']
+    return (_Pool(ip_pool, skew), _Pool(ua_pool, skew), _Pool(path_pool, skew), _Pool(referrer_pool, skew))
+
+
+def generate_lines(count, fmt='alt', seed=0, ips=10000, user_agents=50, paths=200, referrers=500,
+                   start=datetime(2023, 1, 1, tzinfo=timezone(timedelta(hours=3))),
+                   lines_per_second=20.0, skew=1.1, invalid_ratio=0.0):
+    """
+    Генерирует count строк лога в формате fmt ('alt' или 'nginx').
+    Одинаковые параметры и seed дают одинаковый результат.
+    invalid_ratio — доля заведомо нераспознаваемых строк.
+    """
+    if fmt not in FORMATS:
+        raise ValueError(f"Неизвестный формат логов: {fmt}")
+    rng = random.Random(seed)
+    ip_pool, ua_pool, path_pool, referrer_pool = _build_pools(rng, ips, user_agents, paths, referrers, skew)
+    time_format = '%Y-%m-%d %H:%M:%S %z' if fmt == 'alt' else '%d/%b/%Y:%H:%M:%S %z'
+    current = start
+    stamp = current.strftime(time_format)
+    for _ in range(count):
+        if rng.random() < 1.0 / lines_per_second:
+            current += timedelta(seconds=1)
+            stamp = current.strftime(time_format)
+        if invalid_ratio and rng.random() < invalid_ratio:
+            yield f"garbage line {rng.getrandbits(32):08x} without known format"
+            continue
+        method = rng.choices(METHODS, METHOD_WEIGHTS)[0]
+        status = rng.choices(STATUS_CODES, STATUS_WEIGHTS)[0]
+        yield (f'{ip_pool.pick(rng)} - - [{stamp}] "{method} {path_pool.pick(rng)} {rng.choice(PROTOCOLS)}" '
+               f'{status} {rng.randint(200, 10000)} "{referrer_pool.pick(rng)}" "{ua_pool.pick(rng)}" '
+               f'{rng.randint(1, 5000)}')
+
+
+def write_log(path, count, chunk_lines=100000, **kwargs):
+    """Потоково пишет count сгенерированных строк в файл."""
+    lines = generate_lines(count, **kwargs)
+    with open(path, 'w', encoding='utf-8') as f:
+        while True:
+            chunk = list(itertools.islice(lines, chunk_lines))
+            if not chunk:
+                break
+            f.write('\n'.join(chunk))
+            f.write('\n')
+    return path
+
+
+def add_generator_arguments(parser):
+    """Добавляет в argparse параметры генератора."""
+    parser.add_argument('--lines', type=int, default=100000)
+    parser.add_argument('--format', choices=FORMATS, default='alt')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--ips', type=int, default=10000)
+    parser.add_argument('--user-agents', type=int, default=50)
+    parser.add_argument('--paths', type=int, default=200)
+    parser.add_argument('--referrers', type=int, default=500)
+    parser.add_argument('--invalid-ratio', type=float, default=0.0)
+
+
+def generator_kwargs(args):
+    """Параметры generate_lines из разобранных аргументов."""
+    return {
+        'fmt': args.format, 'seed': args.seed, 'ips': args.ips, 'user_agents': args.user_agents,
+        'paths': args.paths, 'referrers': args.referrers, 'invalid_ratio': args.invalid_ratio,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    add_generator_arguments(parser)
+    parser.add_argument('--out', required=True)
+    args = parser.parse_args()
+    write_log(args.out, args.lines, **generator_kwargs(args))
+
+
+if __name__ == '__main__':
+    main()
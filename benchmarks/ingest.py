@@ -0,0 +1,221 @@
+"""
+Бенчмарки стадий загрузки логов.
+
+Стадии:
+  parse       — только parse_log_line
+  parse_ua    — парсинг + разбор User-Agent (кэш разбора очищается перед замером)
+  block       — колоночный разбор блоками BATCH_SIZE строк с разбором User-Agent (parse_log_block),
+                сравнивается с parse_ua
+  dimensions  — process_log_block против Postgres: разрешение измерений без вставки фактов,
+                транзакция откатывается
+  full        — process_file_async: полная загрузка в Postgres (пишет данные, нужна отдельная база)
+
+Строки генерируются один раз во временный файл (или берутся из --input) и читаются
+стадиями потоково, поэтому объем не ограничен памятью.
+
+Результат — JSON (одна строка на запуск) с хешем коммита, пригодный для сравнения между коммитами:
+
+    python -m benchmarks.ingest --lines 1000000 --stages parse,parse_ua --output bench.jsonl
+    python -m benchmarks.ingest --lines 1000000 --stages parse --compare bench.jsonl
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from benchmarks.generator import add_generator_arguments, generator_kwargs, write_log
+from log2db.parser import parse_log_line
+
+STAGES = ('parse', 'parse_ua', 'block', 'dimensions', 'full')
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], text=True,
+                                       cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                       stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _clear_dimension_caches():
+    from log2db.cache import default_caches
+    default_caches.clear()
+
+
+def _read_lines(path):
+    with open(path, 'r', encoding='utf-8', errors='ignore') as f:
+        for line in f:
+            yield line.strip()
+
+
+def bench_parse(path, _args):
+    parsed = 0
+    for line in _read_lines(path):
+        if parse_log_line(line) is not None:
+            parsed += 1
+    return parsed
+
+
+def bench_parse_ua(path, _args):
+    from log2db.processor import describe_user_agent
+    describe_user_agent.cache_clear()
+    parsed = 0
+    for line in _read_lines(path):
+        log_data = parse_log_line(line)
+        if log_data is not None:
+            describe_user_agent(log_data.user_agent)
+            parsed += 1
+    return parsed
+
+
+def bench_block(path, _args):
+    from log2db.config import BATCH_SIZE
+    from log2db.processor import describe_user_agent, parse_log_block
+    describe_user_agent.cache_clear()
+    parsed = 0
+    lines = _read_lines(path)
+    while True:
+        batch_lines = list(itertools.islice(lines, BATCH_SIZE))
+        if not batch_lines:
+            break
+        parsed += parse_log_block(batch_lines).num_rows
+    return parsed
+
+
+def bench_dimensions(path, args):
+    import psycopg2
+    from log2db.config import BATCH_SIZE, DATABASE_CONFIG
+    from log2db.db import create_tables
+    from log2db.processor import process_log_block
+    conn = psycopg2.connect(**DATABASE_CONFIG)
+    try:
+        create_tables(conn)
+        _clear_dimension_caches()
+        processed = 0
+        lines = _read_lines(path)
+        while True:
+            batch_lines = list(itertools.islice(lines, BATCH_SIZE))
+            if not batch_lines:
+                break
+            processed += process_log_block(conn, batch_lines, [])
+        return processed
+    finally:
+        conn.rollback()
+        conn.close()
+        _clear_dimension_caches()
+
+
+def bench_full(path, args):
+    import psycopg2
+    from log2db.config import DATABASE_CONFIG
+    from log2db.db import create_tables
+    from log2db.processor import process_file_async
+    if not args.allow_writes:
+        raise RuntimeError("Стадия full пишет данные в базу: запусти с --allow-writes на отдельной базе")
+    conn = psycopg2.connect(**DATABASE_CONFIG)
+    try:
+        create_tables(conn)
+        result = asyncio.run(process_file_async(conn, path, is_uploaded_file=False))
+        if result['status'] != 'success':
+            raise RuntimeError(result['message'])
+        return result['processed']
+    finally:
+        conn.close()
+
+
+BENCHMARKS = {
+    'parse': bench_parse,
+    'parse_ua': bench_parse_ua,
+    'block': bench_block,
+    'dimensions': bench_dimensions,
+    'full': bench_full,
+}
+
+
+def run(args):
+    """Генерирует строки и прогоняет выбранные стадии, возвращает словарь результатов."""
+    stages = [s.strip() for s in args.stages.split(',') if s.strip()]
+    unknown = set(stages) - set(STAGES)
+    if unknown:
+        raise ValueError(f"Неизвестные стадии: {', '.join(sorted(unknown))}")
+    path = args.input
+    if path is None:
+        fd, path = tempfile.mkstemp(suffix='.log')
+        os.close(fd)
+        write_log(path, args.lines, **generator_kwargs(args))
+    report = {
+        'commit': _git_commit(),
+        'started_at': datetime.now(timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'input': args.input,
+        'lines': args.lines,
+        'generator': None if args.input else generator_kwargs(args),
+        'stages': {},
+    }
+    try:
+        for stage in stages:
+            started = time.perf_counter()
+            processed = BENCHMARKS[stage](path, args)
+            elapsed = time.perf_counter() - started
+            report['stages'][stage] = {
+                'seconds': round(elapsed, 4),
+                'processed': processed,
+                'lines_per_second': round(processed / elapsed, 1) if elapsed else None,
+            }
+            print(f"Стадия {stage}: {elapsed:.2f} с, {report['stages'][stage]['lines_per_second']} строк/с",
+                  file=sys.stderr)
+    finally:
+        if args.input is None:
+            os.remove(path)
+    return report
+
+
+def compare(report, baseline_path):
+    """Сравнивает скорость стадий с последним запуском из файла baseline (JSON Lines)."""
+    with open(baseline_path, encoding='utf-8') as f:
+        baseline = json.loads(f.read().strip().splitlines()[-1])
+    rows = {}
+    for stage, result in report['stages'].items():
+        base = baseline['stages'].get(stage)
+        if base and base.get('lines_per_second') and result['lines_per_second']:
+            rows[stage] = {
+                'baseline_commit': baseline.get('commit'),
+                'baseline_lines_per_second': base['lines_per_second'],
+                'lines_per_second': result['lines_per_second'],
+                'change_pct': round((result['lines_per_second'] / base['lines_per_second'] - 1) * 100, 1),
+            }
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    add_generator_arguments(parser)
+    parser.add_argument('--stages', default='parse,parse_ua')
+    parser.add_argument('--input', help="готовый лог-файл вместо сгенерированного")
+    parser.add_argument('--output', help="дописать результат в файл JSON Lines")
+    parser.add_argument('--compare', help="сравнить с последним результатом из файла JSON Lines")
+    parser.add_argument('--allow-writes', action='store_true', help="разрешить стадии full писать в базу")
+    args = parser.parse_args()
+
+    logging.disable(logging.INFO)
+    report = run(args)
+    if args.compare:
+        report['comparison'] = compare(report, args.compare)
+    line = json.dumps(report, ensure_ascii=False)
+    if args.output:
+        with open(args.output, 'a', encoding='utf-8') as f:
+            f.write(line + '\n')
+    print(line)
+
+
+if __name__ == '__main__':
+    main()
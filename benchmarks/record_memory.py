@@ -0,0 +1,148 @@
+"""
+Память и аллокации на разобранные строки лога (tracemalloc): прежние словари против LogRecord и блоков.
+
+Представления:
+  dict    — как прежний parse_log_line: словарь из 10 ключей с datetime на строку
+  record  — parser.LogRecord: __slots__, время — int микросекунд, повторяющиеся строки интернированы
+  block   — columnar.parse_block + User-Agent блоками по BATCH_SIZE строк (pyarrow.Table на блок)
+
+Все разобранные строки удерживаются до замера, как в буфере пакета. Для каждого представления
+выводятся удерживаемая и пиковая память, число живых блоков памяти, сборки мусора поколения 0
+и время разбора (отдельным прогоном без tracemalloc). Буферы pyarrow tracemalloc не видит,
+они учитываются отдельно (arrow_mb, по pyarrow.total_allocated_bytes):
+
+    python -m benchmarks.record_memory --lines 200000 --output memory.jsonl
+    python -m benchmarks.record_memory --lines 200000 --compare memory.jsonl
+"""
+
+import argparse
+import gc
+import json
+import logging
+import time
+import tracemalloc
+from datetime import datetime, timezone
+import pyarrow as pa
+from benchmarks.generator import add_generator_arguments, generator_kwargs, generate_lines
+from benchmarks.ingest import _git_commit
+from log2db.config import BATCH_SIZE
+from log2db.parser import ALT_PATTERN, ALT_TIME_FORMAT, NGINX_PATTERN, NGINX_TIME_FORMAT, try_parse_log_line
+
+REPRESENTATIONS = ('dict', 'record', 'block')
+
+
+def _parse_dict(line):
+    """Разбор строки в словарь, как parse_log_line до LogRecord (эталон для сравнения)."""
+    match = ALT_PATTERN.match(line)
+    time_format = ALT_TIME_FORMAT
+    if not match:
+        match = NGINX_PATTERN.match(line)
+        time_format = NGINX_TIME_FORMAT
+    if not match:
+        return None
+    (ip_client, timestamp_str, request_type, api_path, protocol,
+     status_code, bytes_sent, referrer, user_agent, response_time) = match.groups()
+    return {
+        'ip_client': ip_client,
+        'timestamp_utc': datetime.strptime(timestamp_str, time_format).astimezone(timezone.utc),
+        'request_type': request_type,
+        'api_path': api_path,
+        'protocol': protocol,
+        'status_code': int(status_code),
+        'bytes_sent': int(bytes_sent) if bytes_sent != '-' else 0,
+        'referrer': None if referrer in ('-', '') else referrer,
+        'user_agent': user_agent,
+        'response_time': int(response_time) if response_time != '-' else 0,
+    }
+
+
+def parse_all(lines, representation):
+    """Разбирает строки в заданное представление и возвращает (удерживаемые объекты, число записей)."""
+    if representation == 'dict':
+        records = [record for record in map(_parse_dict, lines) if record is not None]
+        return records, len(records)
+    if representation == 'record':
+        records = [record for record, _ in map(try_parse_log_line, lines) if record is not None]
+        return records, len(records)
+    from log2db.processor import parse_log_block
+    tables = [parse_log_block(lines[i:i + BATCH_SIZE]) for i in range(0, len(lines), BATCH_SIZE)]
+    return tables, sum(table.num_rows for table in tables)
+
+
+def measure(lines, representation):
+    """Замер одного представления: память и аллокации под tracemalloc, время — без него."""
+    gc.collect()
+    started = time.perf_counter()
+    held, parsed = parse_all(lines, representation)
+    seconds = time.perf_counter() - started
+    del held
+    gc.collect()
+
+    collections = gc.get_stats()[0]['collections']
+    arrow_before = pa.total_allocated_bytes()
+    tracemalloc.start()
+    held, parsed = parse_all(lines, representation)
+    current, peak = tracemalloc.get_traced_memory()
+    arrow_bytes = pa.total_allocated_bytes() - arrow_before
+    blocks = sum(stat.count for stat in tracemalloc.take_snapshot().statistics('filename'))
+    tracemalloc.stop()
+    gc_runs = gc.get_stats()[0]['collections'] - collections
+    del held
+    gc.collect()
+    return {
+        'parsed': parsed,
+        'seconds': round(seconds, 3),
+        'retained_mb': round(current / 2 ** 20, 1),
+        'peak_mb': round(peak / 2 ** 20, 1),
+        'arrow_mb': round(arrow_bytes / 2 ** 20, 1),
+        'live_blocks': blocks,
+        'gen0_collections': gc_runs,
+    }
+
+
+def compare(report, baseline_path):
+    """Сравнивает память и время с последним результатом из файла (JSON Lines)."""
+    with open(baseline_path, encoding='utf-8') as f:
+        baseline = json.loads(f.read().strip().splitlines()[-1])
+    rows = {}
+    for representation, result in report['representations'].items():
+        base = baseline['representations'].get(representation)
+        if not base:
+            continue
+        rows[representation] = {key: {'baseline': base[key], 'current': result[key]}
+                                for key in ('seconds', 'retained_mb', 'peak_mb', 'arrow_mb', 'live_blocks')
+                                if key in base}
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    add_generator_arguments(parser)
+    parser.add_argument('--representations', default=','.join(REPRESENTATIONS))
+    parser.add_argument('--output', help="дописать результат в файл JSON Lines")
+    parser.add_argument('--compare', help="сравнить с последним результатом из файла JSON Lines")
+    args = parser.parse_args()
+
+    representations = [name.strip() for name in args.representations.split(',') if name.strip()]
+    unknown = set(representations) - set(REPRESENTATIONS)
+    if unknown:
+        raise SystemExit(f"Неизвестные представления: {', '.join(sorted(unknown))}")
+    logging.disable(logging.INFO)
+    lines = [line.strip() for line in generate_lines(args.lines, **generator_kwargs(args))]
+    report = {
+        'commit': _git_commit(),
+        'lines': args.lines,
+        'generator': generator_kwargs(args),
+        'representations': {name: measure(lines, name) for name in representations},
+    }
+    if args.compare:
+        report['comparison'] = compare(report, args.compare)
+    line = json.dumps(report, ensure_ascii=False)
+    if args.output:
+        with open(args.output, 'a', encoding='utf-8') as f:
+            f.write(line + '\n')
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+"""
+Нагрузочный тест загрузки по API: много одновременных POST /upload/ к запущенному серверу.
+
+Лог-файлы генерируются заранее (у каждого запроса свой файл, чтобы запросы не делили измерения
+целиком), затем --uploads загрузок отправляются с параллелизмом --concurrency.
+Сравнить асинхронный слой БД с psycopg2 в потоках — запустить сервер дважды:
+
+    ASYNC_DB_ENABLED=true  python -m log2db.run_api
+    python -m benchmarks.upload_load --uploads 200 --concurrency 50 --lines 2000 --label async --output load.jsonl
+    ASYNC_DB_ENABLED=false python -m log2db.run_api
+    python -m benchmarks.upload_load --uploads 200 --concurrency 50 --lines 2000 --label threads --compare load.jsonl
+
+Сервер пишет данные в базу, поэтому запускать только на отдельной базе.
+"""
+
+import argparse
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+import numpy as np
+import requests
+from benchmarks.generator import add_generator_arguments, generator_kwargs, write_log
+from benchmarks.ingest import _git_commit
+
+
+def _upload(url, path):
+    started = time.perf_counter()
+    try:
+        with open(path, 'rb') as f:
+            response = requests.post(url, files={'file': (os.path.basename(path), f)}, timeout=600)
+        ok = response.status_code == 200
+    except requests.RequestException:
+        ok = False
+    return ok, time.perf_counter() - started
+
+
+def run(args):
+    """Генерирует файлы, выполняет загрузки и возвращает словарь результатов."""
+    directory = tempfile.mkdtemp(prefix='upload_load_')
+    try:
+        paths = []
+        for index in range(args.files):
+            path = os.path.join(directory, f'load_{index}.log')
+            write_log(path, args.lines, **{**generator_kwargs(args), 'seed': args.seed + index})
+            paths.append(path)
+        url = args.url.rstrip('/') + '/upload/'
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+            results = list(executor.map(lambda i: _upload(url, paths[i % len(paths)]), range(args.uploads)))
+        elapsed = time.perf_counter() - started
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    latencies = np.array([seconds for ok, seconds in results if ok])
+    succeeded = len(latencies)
+    return {
+        'commit': _git_commit(),
+        'started_at': datetime.now(timezone.utc).isoformat(),
+        'label': args.label,
+        'uploads': args.uploads,
+        'concurrency': args.concurrency,
+        'lines': args.lines,
+        'succeeded': succeeded,
+        'failed': args.uploads - succeeded,
+        'seconds': round(elapsed, 3),
+        'uploads_per_second': round(succeeded / elapsed, 2) if elapsed else None,
+        'lines_per_second': round(succeeded * args.lines / elapsed, 1) if elapsed else None,
+        'latency_p50': round(float(np.percentile(latencies, 50)), 3) if succeeded else None,
+        'latency_p95': round(float(np.percentile(latencies, 95)), 3) if succeeded else None,
+        'latency_max': round(float(latencies.max()), 3) if succeeded else None,
+    }
+
+
+def compare(report, baseline_path):
+    """Сравнивает пропускную способность и задержки с последним результатом из файла (JSON Lines)."""
+    with open(baseline_path, encoding='utf-8') as f:
+        baseline = json.loads(f.read().strip().splitlines()[-1])
+    rows = {'baseline_label': baseline.get('label'), 'baseline_commit': baseline.get('commit')}
+    for key in ('uploads_per_second', 'latency_p50', 'latency_p95'):
+        if baseline.get(key) and report.get(key):
+            rows[key] = {'baseline': baseline[key], 'current': report[key],
+                         'change_pct': round((report[key] / baseline[key] - 1) * 100, 1)}
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    add_generator_arguments(parser)
+    parser.add_argument('--url', default='http://127.0.0.1:8000')
+    parser.add_argument('--uploads', type=int, default=100, help="всего загрузок")
+    parser.add_argument('--concurrency', type=int, default=20, help="одновременных загрузок")
+    parser.add_argument('--files', type=int, default=20, help="сколько разных файлов сгенерировать")
+    parser.add_argument('--label', help="метка запуска, например async или threads")
+    parser.add_argument('--output', help="дописать результат в файл JSON Lines")
+    parser.add_argument('--compare', help="сравнить с последним результатом из файла JSON Lines")
+    args = parser.parse_args()
+
+    logging.disable(logging.INFO)
+    report = run(args)
+    print(f"Загрузок: {report['succeeded']}/{report['uploads']} за {report['seconds']} с, "
+          f"{report['uploads_per_second']} загрузок/с, p95 {report['latency_p95']} с", file=sys.stderr)
+    if args.compare:
+        report['comparison'] = compare(report, args.compare)
+    line = json.dumps(report, ensure_ascii=False)
+    if args.output:
+        with open(args.output, 'a', encoding='utf-8') as f:
+            f.write(line + '\n')
+    print(line)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,18 +1,47 @@
 """Загрузка в БД с помощью API"""
 
 import os
+import json
+import asyncio
 import logging
+import psycopg
 import psycopg2
+from contextlib import asynccontextmanager
+from typing import Optional
 from fastapi import FastAPI, File, UploadFile
-from fastapi.responses import JSONResponse, HTMLResponse, FileResponse
+from fastapi.responses import JSONResponse, HTMLResponse, FileResponse, PlainTextResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from werkzeug.utils import secure_filename
-from log2db.config import UPLOAD_LOG_DIRECTORY, ALLOWED_EXTENSIONS, DATABASE_CONFIG
-from log2db.processor import process_file_async
+from log2db.config import (UPLOAD_LOG_DIRECTORY, ALLOWED_EXTENSIONS, DATABASE_CONFIG, INGEST_SINKS,
+                           TIMESERIES_MAX_POINTS, ASYNC_DB_ENABLED, MAINTENANCE_ENABLED, RAW_ARCHIVE_MAX_LINES,
+                           LOGS_PAGE_SIZE, LOGS_PAGE_MAX_SIZE)
+from log2db import async_db
+from log2db.db import run_db_operation
+from log2db.processor import process_file_async, replay_quarantine
+from log2db.quarantine import quarantine_summary
+from log2db.shards import get_shards, sharding_enabled
+from log2db.replicas import get_read_router
+from log2db.maintenance import get_scheduler
+from log2db.metrics import render_prometheus
+from log2db.profiling import request_profiling
+from log2db.tracing import slowest_traces
 import log_export.export as export
+from log_export.timeseries import get_timeseries
+from log_export.queries import normalize_filters
+from log_export.browse import decode_cursor, iter_log_lines
+from log_export.search import resolve_search_ids
 
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(_app):
+    maintenance = asyncio.create_task(get_scheduler().loop()) if MAINTENANCE_ENABLED else None
+    yield
+    if maintenance is not None:
+        maintenance.cancel()
+    await async_db.close_pool()
+
+
+app = FastAPI(lifespan=lifespan)
 
 app.mount(
     "/html_page",
@@ -25,6 +54,28 @@ def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
 
+@asynccontextmanager
+async def _ingest_connection(native=ASYNC_DB_ENABLED):
+    """
+    Соединение с БД для загрузки, если Postgres среди приемников, иначе None.
+    native — асинхронное соединение из пула psycopg 3, иначе соединение psycopg2 (открывается в потоке).
+    При шардировании соединения берутся из пулов шардов внутри обработки, поэтому тоже None.
+    """
+    if 'postgres' not in INGEST_SINKS or sharding_enabled():
+        yield None
+        return
+    if native:
+        async with async_db.connection() as conn:
+            yield conn
+        return
+    conn = await run_db_operation(lambda: psycopg2.connect(**DATABASE_CONFIG))
+    conn.autocommit = False
+    try:
+        yield conn
+    finally:
+        await run_db_operation(conn.close)
+
+
 @app.get("/", response_class=HTMLResponse)
 async def index():
     """Возвращает HTML-страницу с формой загрузки и кнопками экспорта."""
@@ -38,10 +89,11 @@ async def index():
 
 
 @app.post("/upload/")
-async def upload_log_file(file: UploadFile = File(...)):
+async def upload_log_file(file: UploadFile = File(...), profile: Optional[str] = None):
     """
     Эндпоинт для загрузки лог-файла.
     Проверяет расширение, сохраняет файл и инициирует его обработку.
+    Параметр ?profile=cprofile|sampling включает профилирование обработки.
     """
     if not file or not file.filename:
         return JSONResponse(content={'error': 'Нет файла в запросе'}, status_code=400)
@@ -63,25 +115,54 @@ async def upload_log_file(file: UploadFile = File(...)):
     finally:
         await file.close()
     
-    conn = None
     try:
-        conn = psycopg2.connect(**DATABASE_CONFIG)
-        conn.autocommit = False
-        result = await process_file_async(conn, filepath, is_uploaded_file=True)
+        async with _ingest_connection() as conn:
+            with request_profiling(profile):
+                result = await process_file_async(conn, filepath, is_uploaded_file=True)
         if result['status'] == 'success':
-            return JSONResponse(content={'message': f'Файл "{filename}" успешно обработан. Загружено {result["processed"]} записей.'}, status_code=200)
+            return JSONResponse(content={'message': f'Файл "{filename}" успешно обработан. Загружено {result["processed"]} записей.',
+                                         'rejected': result['rejected'], 'metrics': result['metrics']}, status_code=200)
         else:
             return JSONResponse(content={'error': f'Ошибка при обработке файла "{filename}": {result["message"]}'}, status_code=500)
-    except psycopg2.Error as e:
+    except (psycopg2.Error, psycopg.Error) as e:
         logging.error(f"Ошибка подключения к БД при обработке {filename}: {e}")
         return JSONResponse(content={'error': f'Ошибка базы данных: {str(e)}'}, status_code=500)
     except Exception as e:
          logging.error(f"Неожиданная ошибка в /upload/ для файла {filename}: {e}")
          return JSONResponse(content={'error': f'Внутренняя ошибка сервера: {str(e)}'}, status_code=500)
-    finally:
-        if conn:
-            conn.close()
-            logging.info(f"Соединение с БД закрыто после обработки {filename}")
+
+
+@app.get("/quarantine")
+async def quarantine_status():
+    """Число строк в карантине по файлам и причинам отказа."""
+    try:
+        if 'postgres' in INGEST_SINKS and sharding_enabled():
+            pending = {}
+            for shard in get_shards():
+                async with shard.connection_async() as shard_conn:
+                    pending.update(await run_db_operation(quarantine_summary, shard_conn))
+            return JSONResponse(content={'pending': pending})
+        async with _ingest_connection(native=False) as conn:
+            return JSONResponse(content={'pending': await run_db_operation(quarantine_summary, conn)})
+    except Exception as e:
+        logging.error(f"Ошибка чтения карантина: {e}")
+        return JSONResponse(content={'error': f'Ошибка чтения карантина: {str(e)}'}, status_code=500)
+
+
+@app.post("/quarantine/replay")
+async def quarantine_replay(source_file: Optional[str] = None):
+    """
+    Повторно обрабатывает строки из карантина (все или только файла source_file).
+    Загружаются строки, которые разбираются текущим парсером, остальные остаются в карантине.
+    """
+    try:
+        async with _ingest_connection(native=False) as conn:
+            result = await replay_quarantine(conn, source_file)
+        status_code = 200 if result['status'] == 'success' else 500
+        return JSONResponse(content=result, status_code=status_code)
+    except psycopg2.Error as e:
+        logging.error(f"Ошибка подключения к БД при обработке карантина: {e}")
+        return JSONResponse(content={'error': f'Ошибка базы данных: {str(e)}'}, status_code=500)
 
 
 @app.get("/export/csv")
@@ -91,7 +172,7 @@ async def export_csv():
     Вызывает функцию экспорта и возвращает полученный CSV-файл.
     """
     try:
-        csv_path = export.export_all_csv()
+        csv_path = await export.export_all_csv_async()
         return FileResponse(path=csv_path,
                             filename=os.path.basename(csv_path),
                             media_type='text/csv')
@@ -107,10 +188,184 @@ async def export_parquet():
     Вызывает функцию экспорта и возвращает полученный Parquet-файл.
     """
     try:
-        parquet_path = export.export_all_parquet()
+        parquet_path = await run_db_operation(export.export_all_parquet)
         return FileResponse(path=parquet_path,
                             filename=os.path.basename(parquet_path),
                             media_type='application/octet-stream')
     except Exception as e:
         logging.error(f"Ошибка экспорта Parquet: {e}")
         return JSONResponse(content={'error': f'Ошибка экспорта Parquet: {str(e)}'}, status_code=500)
+
+
+@app.get("/timeseries")
+async def timeseries_data(start: Optional[str] = None, end: Optional[str] = None, status_code: Optional[str] = None,
+                          request_type: Optional[str] = None, metric: str = 'count',
+                          max_points: int = TIMESERIES_MAX_POINTS):
+    """
+    Временной ряд метрики (count, errors, avg_response_time) за диапазон [start, end].
+    Размер корзины (second/minute/hour/day) выбирается по диапазону, ряд прореживается до max_points точек.
+    """
+    try:
+        result = await run_db_operation(get_timeseries, start, end, status_code, request_type, metric, max_points)
+        return JSONResponse(content=result)
+    except ValueError as e:
+        return JSONResponse(content={'error': str(e)}, status_code=400)
+    except Exception as e:
+        logging.error(f"Ошибка построения временного ряда: {e}")
+        return JSONResponse(content={'error': f'Ошибка построения временного ряда: {str(e)}'}, status_code=500)
+
+
+@app.get("/logs")
+async def browse_logs(start: Optional[str] = None, end: Optional[str] = None, status_code: Optional[str] = None,
+                      method: Optional[str] = None, path_prefix: Optional[str] = None, ip: Optional[str] = None,
+                      cursor: Optional[str] = None, limit: int = LOGS_PAGE_SIZE, order: str = 'desc'):
+    """
+    Записи логов по фильтрам (время, статус, метод, префикс пути, IP) страницами в формате JSON Lines.
+    Страницы листаются по ключу (timestamp_utc, log_id): последняя строка ответа — {"next_cursor": ...},
+    следующая страница запрашивается с cursor=<next_cursor>, поэтому дальние страницы не медленнее первой.
+    """
+    if sharding_enabled():
+        return JSONResponse(content={'error': 'Просмотр записей при шардировании не поддерживается'}, status_code=501)
+    try:
+        if order not in ('asc', 'desc'):
+            raise ValueError(f"Неизвестный порядок записей: {order}")
+        filters = normalize_filters(start, end, status_code, method)
+        after = decode_cursor(cursor) if cursor else None
+        limit = max(1, min(limit, LOGS_PAGE_MAX_SIZE))
+    except ValueError as e:
+        return JSONResponse(content={'error': str(e)}, status_code=400)
+
+    def lines():
+        try:
+            with export.connect() as conn:
+                yield from iter_log_lines(conn, filters, path_prefix, ip, after, limit, order == 'desc')
+        except psycopg2.Error as e:
+            # Заголовки уже отправлены: ошибка передается последней строкой потока
+            logging.error(f"Ошибка чтения записей логов: {e}")
+            yield json.dumps({'error': f'Ошибка базы данных: {str(e)}'}, ensure_ascii=False) + '\n'
+
+    return StreamingResponse(lines(), media_type='application/x-ndjson')
+
+
+@app.get("/search")
+async def search_logs(path: Optional[str] = None, referrer: Optional[str] = None, referrer_host: Optional[str] = None,
+                      start: Optional[str] = None, end: Optional[str] = None, status_code: Optional[str] = None,
+                      method: Optional[str] = None, cursor: Optional[str] = None, limit: int = LOGS_PAGE_SIZE,
+                      order: str = 'desc'):
+    """
+    Поиск записей по шаблону пути API (path), URL реферера (referrer) и хосту реферера (referrer_host)
+    вместе с фильтрами /logs. В шаблонах * — любая подстрока, шаблон без * ищется как префикс.
+    Сначала по индексам измерений находятся id подходящих значений (заголовки X-Search-Api-Ids,
+    X-Search-Referrer-Ids, X-Search-Truncated), затем записи выбираются по id страницами, как в /logs.
+    """
+    if sharding_enabled():
+        return JSONResponse(content={'error': 'Поиск записей при шардировании не поддерживается'}, status_code=501)
+    if not (path or referrer or referrer_host):
+        return JSONResponse(content={'error': 'Не задан критерий поиска: path, referrer или referrer_host'},
+                            status_code=400)
+    try:
+        if order not in ('asc', 'desc'):
+            raise ValueError(f"Неизвестный порядок записей: {order}")
+        filters = normalize_filters(start, end, status_code, method)
+        after = decode_cursor(cursor) if cursor else None
+        limit = max(1, min(limit, LOGS_PAGE_MAX_SIZE))
+    except ValueError as e:
+        return JSONResponse(content={'error': str(e)}, status_code=400)
+
+    def resolve():
+        with export.connect() as conn:
+            return resolve_search_ids(conn, path, referrer, referrer_host)
+
+    try:
+        ids, truncated = await run_db_operation(resolve)
+    except Exception as e:
+        logging.error(f"Ошибка поиска значений измерений: {e}")
+        return JSONResponse(content={'error': f'Ошибка поиска: {str(e)}'}, status_code=500)
+    headers = {'X-Search-Truncated': str(truncated).lower()}
+    for name, header in (('api_ids', 'X-Search-Api-Ids'), ('referrer_ids', 'X-Search-Referrer-Ids')):
+        if ids[name] is not None:
+            headers[header] = str(len(ids[name]))
+
+    def lines():
+        if any(value == [] for value in ids.values()):
+            # Критерию не соответствует ни одно значение измерения: факты не читаются
+            yield json.dumps({'next_cursor': None}) + '\n'
+            return
+        try:
+            with export.connect() as conn:
+                yield from iter_log_lines(conn, filters, after=after, limit=limit, descending=order == 'desc', **ids)
+        except psycopg2.Error as e:
+            logging.error(f"Ошибка поиска записей логов: {e}")
+            yield json.dumps({'error': f'Ошибка базы данных: {str(e)}'}, ensure_ascii=False) + '\n'
+
+    return StreamingResponse(lines(), media_type='application/x-ndjson', headers=headers)
+
+
+@app.get("/logs/raw")
+async def raw_logs(start: Optional[str] = None, end: Optional[str] = None, status_code: Optional[str] = None,
+                   request_type: Optional[str] = None, log_id: Optional[str] = None, after_id: int = 0,
+                   limit: int = 1000):
+    """
+    Исходные строки логов для выборки дашборда (фильтры как у /timeseries) или списка log_id через запятую
+    из архива строк (RAW_ARCHIVE_ENABLED). Строки идут по возрастанию log_id, не больше limit за запрос;
+    следующая страница — с after_id=next_after_id. missing — факты, строк которых нет в архиве.
+    """
+    try:
+        filters = normalize_filters(start, end, status_code, request_type)
+        log_ids = [int(value) for value in log_id.split(',') if value.strip()] if log_id else None
+        limit = max(1, min(limit, RAW_ARCHIVE_MAX_LINES))
+
+        def fetch():
+            with export.connect() as conn:
+                return export.fetch_raw_lines(conn, filters, log_ids, after_id, limit)
+
+        lines, last_id, missing = await run_db_operation(fetch)
+        return JSONResponse(content={
+            'lines': lines,
+            'missing': missing,
+            'next_after_id': last_id if len(lines) + missing == limit else None,
+        })
+    except ValueError as e:
+        return JSONResponse(content={'error': str(e)}, status_code=400)
+    except Exception as e:
+        logging.error(f"Ошибка чтения архива строк: {e}")
+        return JSONResponse(content={'error': f'Ошибка чтения архива строк: {str(e)}'}, status_code=500)
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    """Эндпоинт метрик загрузки в формате Prometheus."""
+    return PlainTextResponse(content=render_prometheus(), media_type='text/plain; version=0.0.4')
+
+
+@app.get("/admin/dashboard/slow")
+async def slow_dashboard_requests(limit: int = 20, callback: Optional[str] = None):
+    """
+    Самые медленные из последних запросов дашборда: параметры фильтров,
+    общее время и спаны (sql, transfer, frame, figure:*, serialize).
+    """
+    return JSONResponse(content={'traces': slowest_traces(limit, callback)})
+
+
+@app.get("/admin/replicas")
+async def replicas_status():
+    """Состояние реплик для чтения: занятые соединения, последнее отставание и доступность."""
+    router = get_read_router()
+    return JSONResponse(content=router.status() if router is not None else {'replicas': []})
+
+
+@app.get("/admin/maintenance")
+async def maintenance_status():
+    """Итог последнего обслуживания базы и пора ли следующее (полный проход, VACUUM после загрузок)."""
+    return JSONResponse(content=get_scheduler().status())
+
+
+@app.post("/admin/maintenance")
+async def run_maintenance(full: bool = True):
+    """
+    Запускает обслуживание базы вне расписания: full — хранение по сроку и чистка осиротевших измерений,
+    иначе только VACUUM ANALYZE. Если обслуживание уже идет, возвращает 409.
+    """
+    result = await asyncio.to_thread(get_scheduler().run, full)
+    status_code = {'success': 200, 'busy': 409}.get(result['status'], 500)
+    return JSONResponse(content=result, status_code=status_code)
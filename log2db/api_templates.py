@@ -0,0 +1,68 @@
+"""Шаблоны API-путей: /users/42/orders?page=2 -> /users/{id}/orders"""
+
+import re
+from functools import lru_cache
+import numpy as np
+from log2db.config import API_TEMPLATE_RULES, API_TEMPLATE_CACHE_SIZE
+
+# Сегменты-идентификаторы, заменяемые без правил (по порядку проверки)
+AUTO_SEGMENTS = (
+    (re.compile(r'\d+'), '{id}'),
+    (re.compile(r'[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}'), '{uuid}'),
+    (re.compile(r'(?=[a-fA-F]*\d)[0-9a-fA-F]{16,}'), '{hash}'),
+)
+
+_PLACEHOLDER = re.compile(r'\{[^/{}]+\}')
+
+
+def compile_rules(rules):
+    """
+    Правила-шаблоны ('/repos/{owner}/{repo}') -> {число сегментов: [(сегменты, шаблон)]}.
+    Сегмент в фигурных скобках совпадает с любым непустым сегментом пути, остальные — буквально.
+    """
+    compiled = {}
+    for rule in rules:
+        segments = tuple(None if _PLACEHOLDER.fullmatch(segment) else segment for segment in rule.split('/'))
+        compiled.setdefault(len(segments), []).append((segments, rule))
+    return compiled
+
+
+RULES = compile_rules(API_TEMPLATE_RULES)
+
+
+def _auto_segment(segment):
+    for pattern, placeholder in AUTO_SEGMENTS:
+        if pattern.fullmatch(segment):
+            return placeholder
+    return segment
+
+
+def path_template(path, rules=RULES):
+    """
+    Шаблон пути без строки запроса и фрагмента: первое подходящее правило rules (compile_rules),
+    иначе путь, в котором числа, UUID и шестнадцатеричные хэши заменены на {id}, {uuid} и {hash}.
+    """
+    path = path.split('?', 1)[0].split('#', 1)[0]
+    segments = path.split('/')
+    for rule_segments, template in rules.get(len(segments), ()):
+        if all(expected == segment if expected is not None else segment
+               for expected, segment in zip(rule_segments, segments)):
+            return template
+    return '/'.join(_auto_segment(segment) for segment in segments)
+
+
+@lru_cache(maxsize=API_TEMPLATE_CACHE_SIZE)
+def api_template(path):
+    """path_template по правилам API_TEMPLATE_RULES; результат запоминается для API_TEMPLATE_CACHE_SIZE путей."""
+    return path_template(path)
+
+
+def template_indices(paths, indices):
+    """
+    Шаблоны словаря путей блока: (уникальные шаблоны, номер шаблона для каждой строки).
+    paths — значения словаря, indices — номера значений строк (-1 — null), как у columnar.dictionary_parts.
+    """
+    positions = {}
+    mapping = np.array([positions.setdefault(api_template(path), len(positions)) for path in paths] + [-1],
+                       dtype=np.int64)
+    return list(positions), mapping[indices]
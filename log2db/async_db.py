@@ -0,0 +1,330 @@
+"""Асинхронный слой работы с БД (psycopg 3): пул соединений, конвейерные запросы и COPY"""
+
+import asyncio
+import logging
+import time
+from contextlib import asynccontextmanager
+import psycopg
+import pyarrow as pa
+from psycopg_pool import AsyncConnectionPool
+from log2db.config import (DATABASE_CONFIG, TIME_STORAGE_MODE, ASYNC_POOL_MIN_SIZE, ASYNC_POOL_MAX_SIZE,
+                           API_TEMPLATES_ENABLED, API_LITERAL_PATHS)
+from log2db.metrics import (DIMENSION_CACHE, DB_ROUND_TRIPS, BATCH_COMMIT_SECONDS, BATCH_ROWS, STAGE_SECONDS,
+                            DUPLICATE_LINES)
+from log2db.sketches import SKETCH_LOCK_KEY, BucketSketch
+from log2db.columnar import buffered_rows, copy_csv_sql, dimension_keys, fact_table, facts_csv
+from log2db.db import INGEST_LOCK_KEY
+from log2db.dedup import (CREATE_STAGING, insert_from_staging_sql, SELECT_HOUR_HASHES, SELECT_EXISTING_HASHES,
+                          normalize_hash)
+from log2db.raw_archive import RESERVE_LOG_IDS, INSERT_BLOCK
+
+COPY_QUARANTINE = "COPY quarantine_lines (source_file, line_no, reason, detail, raw_line) FROM STDIN"
+
+
+def _conninfo(config):
+    """Параметры подключения psycopg 3 из DATABASE_CONFIG (libpq ждет dbname, а не database)."""
+    params = dict(config)
+    params['dbname'] = params.pop('database')
+    return params
+
+
+def is_async_connection(conn):
+    return isinstance(conn, psycopg.AsyncConnection)
+
+
+_pool = None
+_pool_lock = asyncio.Lock()
+
+
+async def get_pool():
+    """Пул асинхронных соединений с основной базой (один на процесс, открывается при первом обращении)."""
+    global _pool
+    async with _pool_lock:
+        if _pool is None:
+            pool = AsyncConnectionPool(kwargs=_conninfo(DATABASE_CONFIG), min_size=ASYNC_POOL_MIN_SIZE,
+                                       max_size=ASYNC_POOL_MAX_SIZE, open=False)
+            await pool.open()
+            _pool = pool
+        return _pool
+
+
+async def close_pool():
+    global _pool
+    async with _pool_lock:
+        if _pool is not None:
+            await _pool.close()
+            _pool = None
+
+
+@asynccontextmanager
+async def connection():
+    """Соединение из пула; незавершенная транзакция откатывается при возврате в пул."""
+    pool = await get_pool()
+    async with pool.connection() as conn:
+        yield conn
+
+
+async def connect(config=DATABASE_CONFIG):
+    """Отдельное асинхронное соединение вне пула (например, для локальной загрузки в main.py)."""
+    return await psycopg.AsyncConnection.connect(**_conninfo(config))
+
+
+async def acquire_ingest_lock(conn):
+    """Асинхронный вариант db.acquire_ingest_lock."""
+    await conn.execute("SELECT pg_advisory_lock_shared(%s)", (INGEST_LOCK_KEY,))
+    await conn.commit()
+
+
+async def release_ingest_lock(conn):
+    """Асинхронный вариант db.release_ingest_lock: блокировка сессии не снимается при возврате соединения в пул."""
+    if conn.closed:
+        return
+    await conn.rollback()
+    await conn.execute("SELECT pg_advisory_unlock_shared(%s)", (INGEST_LOCK_KEY,))
+    await conn.commit()
+
+
+def _upsert_sql(table, columns):
+    """
+    Вставка недостающих значений измерения одним запросом: новые id возвращает INSERT,
+    существующие — SELECT из того же набора значений.
+    """
+    names = [name for name, _ in columns]
+    key, id_column = names[0], f'{table[4:]}_id'
+    arrays = ', '.join(f'%s::{pg_type}[]' for _, pg_type in columns)
+    return f"""
+        WITH input AS (SELECT * FROM unnest({arrays}) AS v({', '.join(names)})),
+        inserted AS (
+            INSERT INTO {table} ({', '.join(names)}) SELECT {', '.join(names)} FROM input
+            ON CONFLICT ({key}) DO NOTHING
+            RETURNING {key}, {id_column}
+        )
+        SELECT {key}, {id_column} FROM inserted
+        UNION ALL
+        SELECT d.{key}, d.{id_column} FROM {table} d JOIN input ON d.{key} = input.{key}
+    """
+
+
+async def resolve_fact_columns(conn, caches, table):
+    """
+    Разрешает измерения блока, разобранного columnar.parse_block, и возвращает таблицу фактов.
+    Уникальные значения, которых нет в кэше, вставляются по одному запросу на измерение; все запросы
+    отправляются конвейером (pipeline) и коммитятся за один обмен с сервером.
+    """
+    started = time.perf_counter()
+    dimensions = dimension_keys(table, TIME_STORAGE_MODE != 'inline', API_TEMPLATES_ENABLED, API_LITERAL_PATHS)
+    pending = {}
+    for attr, table_name, columns, values, _ in dimensions:
+        cache = getattr(caches, attr)
+        missing = [value for value in values if value[0] not in cache]
+        DIMENSION_CACHE.inc(len(values) - len(missing), table=table_name, result='hit')
+        if missing:
+            DIMENSION_CACHE.inc(len(missing), table=table_name, result='miss')
+            # Ключи сортируются, чтобы параллельные загрузки блокировали строки в одном порядке
+            pending[attr] = (table_name, columns, sorted(missing, key=lambda value: value[0]))
+
+    if pending:
+        cursors = []
+        try:
+            async with conn.pipeline():
+                for attr, (table_name, columns, rows) in pending.items():
+                    cursor = conn.cursor()
+                    cursors.append((attr, cursor))
+                    await cursor.execute(_upsert_sql(table_name, columns), [list(column) for column in zip(*rows)])
+                DB_ROUND_TRIPS.inc(operation='pipeline')
+                await conn.commit()
+            for attr, cursor in cursors:
+                cache = getattr(caches, attr)
+                for key, dim_id in await cursor.fetchall():
+                    cache[key] = dim_id
+        except psycopg.Error as e:
+            logging.error(f"Ошибка разрешения измерений блока из {table.num_rows} записей: {e}")
+            await conn.rollback()
+            raise
+        finally:
+            for _, cursor in cursors:
+                await cursor.close()
+        await _reselect_missing(conn, caches, pending)
+
+    dimension_ids = {attr: ([getattr(caches, attr)[value[0]] for value in values], indices)
+                     for attr, _, _, values, indices in dimensions}
+    STAGE_SECONDS.inc(time.perf_counter() - started, stage='dimensions')
+    return fact_table(table, dimension_ids)
+
+
+async def _reselect_missing(conn, caches, pending):
+    """
+    Дочитывает id значений, вставленных параллельной загрузкой после начала запроса:
+    ON CONFLICT их пропускает, а снимок запроса их еще не видит.
+    """
+    for attr, (table, columns, rows) in pending.items():
+        cache = getattr(caches, attr)
+        keys = [row[0] for row in rows if row[0] not in cache]
+        if not keys:
+            continue
+        key, pg_type = columns[0]
+        logging.debug(f"Race condition handled for {table}: {len(keys)} values. Re-selecting.")
+        DB_ROUND_TRIPS.inc(operation='race_retry')
+        async with conn.cursor() as cursor:
+            await cursor.execute(f"SELECT {key}, {table[4:]}_id FROM {table} WHERE {key} = ANY(%s::{pg_type}[])", (keys,))
+            for value, dim_id in await cursor.fetchall():
+                cache[value] = dim_id
+        await conn.commit()
+        if any(k not in cache for k in keys):
+            raise RuntimeError(f"Не удалось получить ID для {table} после race condition.")
+
+
+async def copy_facts(conn, fact_tables, returning=False):
+    """
+    Вставка таблиц фактов (columnar.fact_table) в local_logs через COPY с коммитом; буфер очищается после успеха.
+    Факты с колонкой line_hash идут через временную таблицу с ON CONFLICT DO NOTHING (см. db.copy_facts).
+    Возвращает (число вставленных строк, хэши вставленных строк с line_hash и returning или None).
+    """
+    if not fact_tables:
+        return 0, None
+    insert_count = buffered_rows(fact_tables)
+    logging.info(f"Вставка пакета из {insert_count} записей (COPY)...")
+    columns = fact_tables[0].column_names
+    dedup = 'line_hash' in columns
+    hashes = None
+    try:
+        with BATCH_COMMIT_SECONDS.time():
+            DB_ROUND_TRIPS.inc(4 if dedup else 2, operation='copy_insert')
+            async with conn.cursor() as cursor:
+                if dedup:
+                    await cursor.execute(CREATE_STAGING)
+                async with cursor.copy(copy_csv_sql('local_logs_incoming' if dedup else 'local_logs', columns)) as copy:
+                    await copy.write(facts_csv(fact_tables))
+                inserted = insert_count
+                if dedup:
+                    await cursor.execute(insert_from_staging_sql(columns, returning))
+                    inserted = cursor.rowcount
+                    if returning:
+                        hashes = [normalize_hash(row[0]) for row in await cursor.fetchall()]
+                    DUPLICATE_LINES.inc(insert_count - inserted, stage='constraint')
+            await conn.commit()
+        BATCH_ROWS.inc(inserted)
+        logging.info(f"Пакет из {insert_count} записей успешно вставлен и транзакция закоммичена.")
+        fact_tables.clear()
+    except psycopg.Error as e:
+        logging.error(f"Ошибка пакетной вставки: {e}")
+        await conn.rollback()
+        raise
+    return inserted, hashes
+
+
+async def drop_duplicate_lines(conn, dedup, table, pending=()):
+    """Асинхронный вариант db.drop_duplicate_lines: отбрасывает повторные строки блока и возвращает блок без них."""
+    try:
+        async with conn.cursor() as cursor:
+            for start, end in dedup.hours_to_load(table):
+                DB_ROUND_TRIPS.inc(operation='dedup_load')
+                await cursor.execute(SELECT_HOUR_HASHES, (start, end))
+                dedup.load(start, end, [row[0] for row in await cursor.fetchall()])
+            repeated, candidates = dedup.candidates(table, pending)
+            existing = []
+            if candidates:
+                DB_ROUND_TRIPS.inc(operation='dedup_check')
+                await cursor.execute(SELECT_EXISTING_HASHES, (candidates,))
+                existing = [row[0] for row in await cursor.fetchall()]
+    except psycopg.Error as e:
+        logging.error(f"Ошибка проверки повторов блока из {table.num_rows} записей: {e}")
+        await conn.rollback()
+        raise
+    table, dropped = dedup.keep(table, repeated, existing)
+    DUPLICATE_LINES.inc(dropped, stage='filter')
+    return table
+
+
+async def archive_raw_lines(conn, archive, table, facts):
+    """
+    Асинхронный вариант db.archive_raw_lines: log_id выдаются запросом на цикле событий,
+    сжатие и запись кадра архива выполняются в отдельном потоке.
+    """
+    try:
+        DB_ROUND_TRIPS.inc(2, operation='raw_archive')
+        async with conn.cursor() as cursor:
+            await cursor.execute(RESERVE_LOG_IDS, (facts.num_rows,))
+            log_ids = [row[0] for row in await cursor.fetchall()]
+            block = await asyncio.to_thread(archive.write, log_ids, table['raw_line'].to_pylist())
+            await cursor.execute(INSERT_BLOCK, block)
+    except psycopg.Error as e:
+        logging.error(f"Ошибка записи блока из {facts.num_rows} строк в архив: {e}")
+        await conn.rollback()
+        raise
+    return facts.add_column(0, 'log_id', pa.array(log_ids, pa.int64()))
+
+
+async def write_quarantine(conn, rows):
+    """Запись отказов (source_file, line_no, reason, detail, raw_line) в quarantine_lines через COPY."""
+    try:
+        DB_ROUND_TRIPS.inc(2, operation='quarantine_insert')
+        async with conn.cursor() as cursor:
+            async with cursor.copy(COPY_QUARANTINE) as copy:
+                for source, line_no, reason, detail, raw in rows:
+                    # В TEXT Postgres не допускается NUL
+                    await copy.write_row((source, line_no, reason, detail, raw.replace('\x00', '\\x00')))
+        await conn.commit()
+    except psycopg.Error as e:
+        logging.error(f"Ошибка записи {len(rows)} строк в карантин: {e}")
+        await conn.rollback()
+        raise
+
+
+async def write_sketches(conn, accumulator):
+    """
+    Асинхронный вариант sketches.write_sketches: блокировка и чтение сохраненных скетчей идут
+    одним обменом, перезапись sketch_hourly и добавление к latency_histogram — вторым.
+    """
+    if not accumulator.buckets:
+        return
+    keys = list(accumulator.buckets)
+    try:
+        DB_ROUND_TRIPS.inc(2, operation='sketch_upsert')
+        async with conn.cursor() as cursor:
+            async with conn.pipeline():
+                await cursor.execute("SELECT pg_advisory_xact_lock(%s)", (SKETCH_LOCK_KEY,))
+                await cursor.execute("""
+                    SELECT s.hour_bucket, s.api_path, s.requests, s.ip_hll, s.ua_hll, s.latency
+                    FROM sketch_hourly s
+                    JOIN unnest(%s::bigint[], %s::text[]) AS k(hour_bucket, api_path)
+                      ON s.hour_bucket = k.hour_bucket AND s.api_path = k.api_path
+                """, ([hour for hour, _ in keys], [path for _, path in keys]))
+            for hour_bucket, api_path, *stored in await cursor.fetchall():
+                accumulator.buckets[(hour_bucket, api_path)].merge(BucketSketch.from_row(*stored))
+            rows = [(hour_bucket, api_path, bucket.requests, bucket.ips.to_bytes(), bucket.user_agents.to_bytes(),
+                     bucket.latency.to_bytes())
+                    for (hour_bucket, api_path), bucket in accumulator.buckets.items()]
+            async with conn.pipeline():
+                await cursor.executemany("""
+                    INSERT INTO sketch_hourly (hour_bucket, api_path, requests, ip_hll, ua_hll, latency)
+                    VALUES (%s, %s, %s, %s, %s, %s)
+                    ON CONFLICT (hour_bucket, api_path) DO UPDATE SET
+                        requests = EXCLUDED.requests, ip_hll = EXCLUDED.ip_hll,
+                        ua_hll = EXCLUDED.ua_hll, latency = EXCLUDED.latency
+                """, rows)
+                await cursor.executemany("""
+                    INSERT INTO latency_histogram (hour_bucket, api_path, bucket, count) VALUES (%s, %s, %s, %s)
+                    ON CONFLICT (hour_bucket, api_path, bucket) DO UPDATE SET
+                        count = latency_histogram.count + EXCLUDED.count
+                """, [(*key, count) for key, count in accumulator.histograms.items()])
+                await conn.commit()
+        logging.debug(f"Скетчи записаны: {len(rows)} строк sketch_hourly, "
+                      f"{len(accumulator.histograms)} корзин latency_histogram")
+    except psycopg.Error as e:
+        logging.error(f"Ошибка записи скетчей: {e}")
+        await conn.rollback()
+        raise
+    accumulator.clear()
+
+
+async def copy_to_csv(conn, query, params, path):
+    """Потоковая выгрузка результата запроса в CSV-файл через COPY ... TO STDOUT (время — в UTC)."""
+    async with conn.cursor() as cursor:
+        await cursor.execute("SET LOCAL TIME ZONE 'UTC'")
+        async with cursor.copy(f"COPY ({query}) TO STDOUT WITH (FORMAT csv, HEADER)", params) as copy:
+            with open(path, 'wb') as f:
+                async for data in copy:
+                    f.write(data)
+    await conn.rollback()
+    return path
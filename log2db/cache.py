@@ -1,9 +1,32 @@
 """Глобальные кэши для измерений"""
 
-ip_cache = {}
-ua_cache = {}
-time_cache = {}
-req_type_cache = {}
-api_cache = {}
-protocol_cache = {}
-referrer_cache = {}
+
+class DimensionCaches:
+    """Кэши измерений одной базы: значение измерения -> id."""
+
+    def __init__(self):
+        self.ip = {}
+        self.ua = {}
+        self.time = {}
+        self.req_type = {}
+        self.api = {}
+        self.api_template = {}
+        self.protocol = {}
+        self.referrer = {}
+
+    def clear(self):
+        for cache in vars(self).values():
+            cache.clear()
+
+
+# Кэши основной базы (DATABASE_CONFIG); у каждого шарда свои (см. log2db.shards)
+default_caches = DimensionCaches()
+
+ip_cache = default_caches.ip
+ua_cache = default_caches.ua
+time_cache = default_caches.time
+req_type_cache = default_caches.req_type
+api_cache = default_caches.api
+api_template_cache = default_caches.api_template
+protocol_cache = default_caches.protocol
+referrer_cache = default_caches.referrer
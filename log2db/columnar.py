@@ -0,0 +1,271 @@
+"""Колоночный разбор блоков строк лога (pyarrow) и подготовка фактов к COPY"""
+
+import io
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pcsv
+from log2db.parser import REJECT_NO_MATCH, REJECT_BAD_VALUE, MAX_DIGITS, split_referrer
+from log2db.api_templates import template_indices
+from log2db.geoip import ip_geo
+
+# Те же форматы, что parser.ALT_PATTERN и parser.NGINX_PATTERN, с именованными группами (RE2)
+FIELDS = r'"(?P<request_type>\S+) (?P<api_path>\S+) (?P<protocol>\S+)" ' \
+         r'(?P<status_code>\d{3}) (?P<bytes_sent>\d+|-) "(?P<referrer>[^"]*|-)" "(?P<user_agent>[^"]*)" ' \
+         r'(?P<response_time>\d+|-)'
+FORMATS = (
+    (r'^(?P<ip_client>\S+) - - \[(?P<timestamp>\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2} \+\d{4})\] ' + FIELDS,
+     '%Y-%m-%d %H:%M:%S %z'),
+    (r'^(?P<ip_client>\S+) \S+ \S+ \[(?P<timestamp>\d{2}/\w{3}/\d{4}:\d{2}:\d{2}:\d{2} \+\d{4})\] ' + FIELDS,
+     '%d/%b/%Y:%H:%M:%S %z'),
+)
+
+# Строковые поля записи (в блоке — словарные массивы)
+STRING_FIELDS = ('ip_client', 'request_type', 'api_path', 'protocol', 'referrer', 'user_agent')
+
+# Колонки фактов local_logs в порядке fact_table и COPY
+FACT_COLUMNS = ('ip_client_id', 'user_agent_id', 'time_id', 'timestamp_utc', 'request_type_id', 'api_id',
+                'api_template_id', 'protocol_id', 'status_code', 'bytes_sent', 'referrer_id', 'response_time')
+
+# Измерения: (атрибут DimensionCaches, таблица, колонки с типами Postgres; первая колонка — ключ)
+DIMENSIONS = (
+    ('ip', 'dim_ip_client', (('ip_address', 'text'), ('country_code', 'text'), ('asn', 'bigint'), ('as_org', 'text'))),
+    ('ua', 'dim_user_agent', (('user_agent', 'text'), ('browser', 'text'), ('os', 'text'), ('device_type', 'text'))),
+    ('time', 'dim_time', (('timestamp_utc', 'timestamptz'), ('year', 'int'), ('month', 'int'), ('day', 'int'),
+                          ('hour', 'int'), ('minute', 'int'), ('second', 'int'), ('weekday', 'int'))),
+    ('req_type', 'dim_request_type', (('request_type', 'text'),)),
+    ('api', 'dim_api', (('api_path', 'text'),)),
+    ('api_template', 'dim_api_template', (('api_template', 'text'),)),
+    ('protocol', 'dim_protocol', (('protocol', 'text'),)),
+    ('referrer', 'dim_referrer', (('referrer_url', 'text'), ('referrer_host', 'text'), ('referrer_path', 'text'))),
+)
+
+# Атрибут измерения -> колонка блока со значением-ключом
+DIMENSION_KEYS = {'ip': 'ip_client', 'ua': 'user_agent', 'time': 'timestamp_utc', 'req_type': 'request_type',
+                  'api': 'api_path', 'protocol': 'protocol', 'referrer': 'referrer'}
+
+
+def _to_int(values, dtype):
+    """'-' -> 0, остальное — число; значения длиннее MAX_DIGITS цифр и вне диапазона dtype — null (как parser._to_int)."""
+    values = pc.if_else(pc.equal(values, '-'), '0', values)
+    values = pc.if_else(pc.greater(pc.utf8_length(values), MAX_DIGITS), pa.scalar(None, pa.string()), values)
+    numbers = pc.cast(values, pa.int64())
+    limits = np.iinfo(dtype.to_pandas_dtype())
+    outside = pc.or_(pc.less(numbers, limits.min), pc.greater(numbers, limits.max))
+    return pc.cast(pc.if_else(outside, pa.scalar(None, pa.int64()), numbers), dtype)
+
+
+def _to_timestamp(texts, time_format):
+    """
+    Время со смещением (формат time_format с %z в конце) -> timestamp[us, UTC]; несуществующие даты — null.
+    strptime переносит их вперед (2023-02-30 -> 2023-03-02), а datetime.strptime в parser отвергает,
+    поэтому время без смещения форматируется обратно и сравнивается с исходным текстом.
+    """
+    timestamps = pc.strptime(texts, format=time_format, unit='us', error_is_null=True)
+    local_format = time_format[:-len(' %z')]
+    local = pc.utf8_lower(pc.utf8_slice_codeunits(texts, 0, -len(' +0000')))
+    parsed = pc.strptime(local, format=local_format, unit='s', error_is_null=True)
+    exact = pc.equal(pc.utf8_lower(pc.strftime(parsed, format=local_format)), local)
+    return pc.if_else(exact, timestamps, pa.scalar(None, timestamps.type))
+
+
+def _columns(matched, time_format):
+    """Колонки из результата extract_regex одного формата."""
+    field = matched.field
+    referrer = field('referrer')
+    return {
+        'ip_client': field('ip_client'),
+        'timestamp_utc': _to_timestamp(field('timestamp'), time_format),
+        'request_type': field('request_type'),
+        'api_path': field('api_path'),
+        'protocol': field('protocol'),
+        'status_code': pc.cast(field('status_code'), pa.int16()),
+        'bytes_sent': _to_int(field('bytes_sent'), pa.int64()),
+        'referrer': pc.if_else(pc.is_in(referrer, pa.array(['-', ''])), pa.scalar(None, pa.string()), referrer),
+        'user_agent': field('user_agent'),
+        'response_time': _to_int(field('response_time'), pa.int32()),
+        'timestamp_text': field('timestamp'),
+    }
+
+
+def parse_block(lines):
+    """
+    Разбирает блок строк в колонки без промежуточных словарей на строку:
+    регулярные выражения применяются ко всему блоку (pyarrow.compute.extract_regex), время — strptime по колонке.
+    Возвращает (table, line_index, rejected):
+      - table — pyarrow.Table: timestamp_utc — timestamp[us, UTC] (int64 от эпохи), status_code/bytes_sent/
+        response_time — целые, строковые поля — словарные массивы
+      - line_index — номера строк блока (с 0) для строк table
+      - rejected — [(номер строки блока, причина, подробности)] как у parser.try_parse_log_line
+    """
+    candidates = pc.utf8_trim_whitespace(pa.array(lines, pa.string()))
+    remaining = np.arange(len(lines))
+    parts, positions = [], []
+    for pattern, time_format in FORMATS:
+        if not len(remaining):
+            break
+        matched = pc.extract_regex(candidates, pattern)
+        ok = matched.is_valid().to_numpy(zero_copy_only=False)
+        if ok.any():
+            parts.append(_columns(pc.filter(matched, pa.array(ok)), time_format))
+            positions.append(remaining[ok])
+        candidates = pc.filter(candidates, pa.array(~ok))
+        remaining = remaining[~ok]
+    rejected = [(int(index), REJECT_NO_MATCH, None) for index in remaining]
+    if not parts:
+        return _empty_block(), np.empty(0, dtype=np.int64), rejected
+
+    columns = {name: pa.chunked_array([part[name] for part in parts]) for name in parts[0]}
+    line_index = np.concatenate(positions)
+    bad = np.zeros(len(line_index), dtype=bool)
+    for name in ('timestamp_utc', 'bytes_sent', 'response_time'):
+        bad |= columns[name].is_null().to_numpy()
+    if bad.any():
+        timestamps = columns['timestamp_utc'].is_null().to_numpy()
+        texts = columns['timestamp_text'].to_pylist()
+        for position in np.flatnonzero(bad):
+            detail = (f"time data '{texts[position]}' does not match format" if timestamps[position]
+                      else "number out of range")
+            rejected.append((int(line_index[position]), REJECT_BAD_VALUE, detail))
+    keep = ~bad
+    del columns['timestamp_text']
+    table = pa.table(columns).filter(pa.array(keep))
+    line_index = line_index[keep]
+    # Строки двух форматов возвращаются в исходном порядке
+    order = np.argsort(line_index, kind='stable')
+    table = table.take(order)
+    for name in STRING_FIELDS:
+        table = table.set_column(table.schema.get_field_index(name), name,
+                                 pc.dictionary_encode(table[name].combine_chunks()))
+    rejected.sort()
+    return table, line_index[order], rejected
+
+
+def _empty_block():
+    return pa.table({
+        'ip_client': pa.array([], pa.dictionary(pa.int32(), pa.string())),
+        'timestamp_utc': pa.array([], pa.timestamp('us', tz='UTC')),
+        'request_type': pa.array([], pa.dictionary(pa.int32(), pa.string())),
+        'api_path': pa.array([], pa.dictionary(pa.int32(), pa.string())),
+        'protocol': pa.array([], pa.dictionary(pa.int32(), pa.string())),
+        'status_code': pa.array([], pa.int16()),
+        'bytes_sent': pa.array([], pa.int64()),
+        'referrer': pa.array([], pa.dictionary(pa.int32(), pa.string())),
+        'user_agent': pa.array([], pa.dictionary(pa.int32(), pa.string())),
+        'response_time': pa.array([], pa.int32()),
+    })
+
+
+def dictionary_parts(column):
+    """(значения словаря, индексы строк в словаре; null — -1) словарной колонки."""
+    array = column.combine_chunks() if isinstance(column, pa.ChunkedArray) else column
+    indices = pc.fill_null(array.indices, -1).to_numpy(zero_copy_only=False).astype(np.int64)
+    return array.dictionary.to_pylist(), indices
+
+
+def with_user_agents(table, describe):
+    """
+    Добавляет колонки browser, os, device_type: describe(user_agent) -> (browser, os, device_type)
+    вызывается по одному разу на уникальный User-Agent блока.
+    """
+    values, indices = dictionary_parts(table['user_agent'])
+    described = [describe(value) for value in values]
+    for position, name in enumerate(('browser', 'os', 'device_type')):
+        dictionary = pa.array([item[position] for item in described], pa.string())
+        table = table.append_column(name, pa.DictionaryArray.from_arrays(pa.array(indices, pa.int32()), dictionary))
+    return table
+
+
+def dimension_keys(table, time_dimension=True, path_templates=False, literal_paths=True):
+    """
+    Уникальные значения измерений блока: [(атрибут кэша, таблица, колонки, значения, индексы строк)].
+    значения — кортежи колонок измерения (первая — ключ), индексы — номер значения для каждой строки (-1 — null).
+    path_templates — измерение шаблонов путей (log2db.api_templates); без literal_paths в dim_api тоже шаблоны.
+    """
+    user_agents, ua_indices = dictionary_parts(table['user_agent'])
+    ua_details = [dictionary_parts(table[name])[0] for name in ('browser', 'os', 'device_type')]
+    result = []
+    for attr, dim_table, columns in DIMENSIONS:
+        if attr == 'ua':
+            values = list(zip(user_agents, *ua_details))
+            indices = ua_indices
+        elif attr == 'time':
+            if not time_dimension:
+                continue
+            timestamps = table['timestamp_utc']
+            unique = pc.unique(timestamps)
+            indices = pc.index_in(timestamps, value_set=unique).to_numpy(zero_copy_only=False).astype(np.int64)
+            values = [(ts, ts.year, ts.month, ts.day, ts.hour, ts.minute, ts.second, ts.weekday())
+                      for ts in unique.to_pylist()]
+        elif attr == 'ip':
+            keys, indices = dictionary_parts(table['ip_client'])
+            values = [(key, *ip_geo(key)) for key in keys]
+        elif attr in ('api', 'api_template') and path_templates:
+            if attr == 'api' and literal_paths:
+                keys, indices = dictionary_parts(table['api_path'])
+            else:
+                keys, indices = template_indices(*dictionary_parts(table['api_path']))
+            values = [(key,) for key in keys]
+        elif attr == 'api_template':
+            continue
+        elif attr == 'referrer':
+            keys, indices = dictionary_parts(table['referrer'])
+            values = [(key, *split_referrer(key)) for key in keys]
+        else:
+            keys, indices = dictionary_parts(table[DIMENSION_KEYS[attr]])
+            values = [(key,) for key in keys]
+        result.append((attr, dim_table, columns, values, indices))
+    return result
+
+
+def fact_table(table, dimension_ids):
+    """
+    Таблица фактов для COPY: dimension_ids — атрибут измерения -> (id уникальных значений, индексы строк).
+    Отсутствующие измерения (dim_time в режиме inline) и null-значения дают NULL.
+    Колонка line_hash (дедупликация, см. log2db.dedup) переносится в факты, если она есть в блоке;
+    log_id добавляется позже, при записи блока в архив исходных строк (log2db.raw_archive).
+    """
+    def ids(attr):
+        if attr not in dimension_ids:
+            return pa.nulls(table.num_rows, pa.int32())
+        unique_ids, indices = dimension_ids[attr]
+        unique_ids = np.asarray(unique_ids, dtype=np.int64)
+        missing = indices < 0
+        values = unique_ids[np.where(missing, 0, indices)] if len(unique_ids) else np.zeros(len(indices), np.int64)
+        return pa.array(values, pa.int64(), mask=missing if missing.any() else None)
+
+    columns = {
+        'ip_client_id': ids('ip'),
+        'user_agent_id': ids('ua'),
+        'time_id': ids('time'),
+        'timestamp_utc': table['timestamp_utc'],
+        'request_type_id': ids('req_type'),
+        'api_id': ids('api'),
+        'api_template_id': ids('api_template'),
+        'protocol_id': ids('protocol'),
+        'status_code': table['status_code'],
+        'bytes_sent': table['bytes_sent'],
+        'referrer_id': ids('referrer'),
+        'response_time': table['response_time'],
+    }
+    if 'line_hash' in table.column_names:
+        columns['line_hash'] = table['line_hash']
+    return pa.table(columns)
+
+
+def buffered_rows(fact_tables):
+    return sum(table.num_rows for table in fact_tables)
+
+
+def facts_csv(fact_tables):
+    """Пакеты фактов одним CSV для copy_csv_sql (пустое поле без кавычек — NULL)."""
+    buffer = io.BytesIO()
+    options = pcsv.WriteOptions(include_header=False)
+    for table in fact_tables:
+        pcsv.write_csv(table, buffer, options)
+    return buffer.getvalue()
+
+
+def copy_csv_sql(table, columns):
+    """COPY CSV в таблицу table для колонок columns (порядок колонок таблицы фактов)."""
+    return f"COPY {table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)"
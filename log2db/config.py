@@ -15,16 +15,162 @@ DATABASE_CONFIG = {
     'password': os.environ.get('DB_PASS', '347620')
 }
 
+
+def _endpoint_config(spec):
+    """Разбирает описание базы 'host[:port][/dbname]'; пользователь и пароль — из DATABASE_CONFIG."""
+    address, _, database = spec.strip().partition('/')
+    host, _, port = address.partition(':')
+    return {**DATABASE_CONFIG, 'host': host, 'port': int(port or DATABASE_CONFIG['port']),
+            'database': database or DATABASE_CONFIG['database']}
+
+
+# Шарды Postgres для загрузки и дашборда через запятую, например 'localhost:5433,localhost:5434/logs'.
+# Пусто — одна база DATABASE_CONFIG
+DATABASE_SHARDS = [_endpoint_config(spec) for spec in os.environ.get('DATABASE_SHARDS', '').split(',') if spec.strip()]
+# Маршрутизация строк по шардам: 'ip' (хэш IP клиента), 'date' (день записи) или 'file' (исходный файл)
+SHARD_ROUTING = os.environ.get('SHARD_ROUTING', 'ip').lower()
+SHARD_POOL_SIZE = int(os.environ.get('SHARD_POOL_SIZE', 4))
+
+# Реплики для чтения (дашборд и экспорт) в том же формате; запись всегда идет в DATABASE_CONFIG
+DATABASE_REPLICAS = [_endpoint_config(spec) for spec in os.environ.get('DATABASE_REPLICAS', '').split(',') if spec.strip()]
+# Балансировка чтения: 'round_robin' или 'least_connections'
+REPLICA_BALANCING = os.environ.get('REPLICA_BALANCING', 'round_robin').lower()
+# Допустимое отставание реплики, с; более отстающие реплики пропускаются
+REPLICA_MAX_LAG_SECONDS = float(os.environ.get('REPLICA_MAX_LAG_SECONDS', 30))
+REPLICA_LAG_CHECK_SECONDS = float(os.environ.get('REPLICA_LAG_CHECK_SECONDS', 5))
+# Читать с основной базы, если ни одна реплика недоступна
+REPLICA_FALLBACK_TO_PRIMARY = os.environ.get('REPLICA_FALLBACK_TO_PRIMARY', 'True').lower() == 'true'
+REPLICA_POOL_SIZE = int(os.environ.get('REPLICA_POOL_SIZE', 8))
+REPLICA_CONNECT_TIMEOUT = int(os.environ.get('REPLICA_CONNECT_TIMEOUT', 3))
+# На сколько секунд реплика исключается после ошибки подключения
+REPLICA_RETRY_SECONDS = float(os.environ.get('REPLICA_RETRY_SECONDS', 30))
+
+# Асинхронный слой БД (psycopg 3) для загрузки и экспорта: запросы идут с цикла событий, а не из пула потоков.
+# Загрузка в шарды (DATABASE_SHARDS) и повторная обработка карантина остаются на psycopg2
+ASYNC_DB_ENABLED = os.environ.get('ASYNC_DB_ENABLED', 'True').lower() == 'true'
+ASYNC_POOL_MIN_SIZE = int(os.environ.get('ASYNC_POOL_MIN_SIZE', 2))
+ASYNC_POOL_MAX_SIZE = int(os.environ.get('ASYNC_POOL_MAX_SIZE', 20))
+
 UPLOAD_LOG_DIRECTORY = './uploaded_logs'
 LOCAL_LOG_DIRECTORY = 'log2db/local_logs'
 
 EXPORT_DIR = "exported_data"
 
+# Аналитический бэкенд для дашборда и экспорта: 'postgres', 'sharded' (по умолчанию при DATABASE_SHARDS) или 'duckdb'
+ANALYTICS_BACKEND = os.environ.get('ANALYTICS_BACKEND', 'sharded' if DATABASE_SHARDS else 'postgres').lower()
+DUCKDB_PATH = os.environ.get('DUCKDB_PATH', 'analytics.duckdb')
+# Если задан каталог Parquet-озера, DuckDB читает данные из него, а не из DUCKDB_PATH
+DUCKDB_PARQUET_DIR = os.environ.get('DUCKDB_PARQUET_DIR', '')
+
 os.makedirs(EXPORT_DIR, exist_ok=True)
 
 ALLOWED_EXTENSIONS = {'log'}
 BATCH_SIZE = 1000
+
+# Режим хранения времени: 'dimension' — через измерение dim_time,
+# 'inline' — timestamp_utc пишется прямо в local_logs без dim_time
+TIME_STORAGE_MODES = ('dimension', 'inline')
+TIME_STORAGE_MODE = os.environ.get('TIME_STORAGE_MODE', 'dimension').lower()
+if TIME_STORAGE_MODE not in TIME_STORAGE_MODES:
+    raise ValueError(f"Неизвестный режим хранения времени: {TIME_STORAGE_MODE}")
+
+# Шаблоны API-путей (log2db.api_templates): /users/42?page=2 -> /users/{id}. Шаблон пишется в измерение
+# dim_api_template, агрегаты дашборда и скетчи считаются по шаблонам. API_TEMPLATE_RULES — свои шаблоны
+# через запятую ('/repos/{owner}/{repo},/users/{login}'), без правила числа, UUID и хэши заменяются автоматически.
+# API_LITERAL_PATHS='false' — в dim_api вместо исходных путей тоже пишутся шаблоны
+API_TEMPLATES_ENABLED = os.environ.get('API_TEMPLATES_ENABLED', 'False').lower() == 'true'
+API_TEMPLATE_RULES = [rule.strip() for rule in os.environ.get('API_TEMPLATE_RULES', '').split(',') if rule.strip()]
+API_LITERAL_PATHS = os.environ.get('API_LITERAL_PATHS', 'True').lower() == 'true'
+API_TEMPLATE_CACHE_SIZE = int(os.environ.get('API_TEMPLATE_CACHE_SIZE', 100000))
+
+# Обогащение IP клиентов (log2db.geoip): страна и ASN из локальных баз MMDB (MaxMind GeoLite2/GeoIP2)
+# или CSV/TSV с диапазонами адресов, через запятую. Базы загружаются в память при первом обращении,
+# результат запоминается для GEOIP_CACHE_SIZE адресов и пишется в колонки dim_ip_client
+GEOIP_ENABLED = os.environ.get('GEOIP_ENABLED', 'False').lower() == 'true'
+GEOIP_DATABASES = [path.strip() for path in os.environ.get('GEOIP_DATABASES', '').split(',') if path.strip()]
+GEOIP_CACHE_SIZE = int(os.environ.get('GEOIP_CACHE_SIZE', 100000))
+
+# Приемники загрузки: 'postgres', 'parquet' или оба через запятую
+INGEST_SINKS = {s.strip() for s in os.environ.get('INGEST_SINKS', 'postgres').lower().split(',') if s.strip()}
+PARQUET_LAKE_DIR = os.environ.get('PARQUET_LAKE_DIR', 'parquet_lake')
+PARQUET_PARTITION_BY_STATUS = os.environ.get('PARQUET_PARTITION_BY_STATUS', 'False').lower() == 'true'
+PARQUET_FLUSH_ROWS = int(os.environ.get('PARQUET_FLUSH_ROWS', 100000))
+PARQUET_FLUSH_SECONDS = float(os.environ.get('PARQUET_FLUSH_SECONDS', 60))
+
+# Архив исходных строк при загрузке в основную базу: блоки сжимаются отдельными кадрами zstd,
+# индекс raw_archive_blocks связывает диапазоны log_id фактов со смещениями блоков в файлах архива
+RAW_ARCHIVE_ENABLED = os.environ.get('RAW_ARCHIVE_ENABLED', 'False').lower() == 'true'
+RAW_ARCHIVE_DIR = os.environ.get('RAW_ARCHIVE_DIR', 'raw_archive')
+RAW_ARCHIVE_COMPRESSION_LEVEL = int(os.environ.get('RAW_ARCHIVE_COMPRESSION_LEVEL', 3))
+# Не больше стольких строк за один запрос /logs/raw
+RAW_ARCHIVE_MAX_LINES = int(os.environ.get('RAW_ARCHIVE_MAX_LINES', 10000))
+
+# Дедупликация строк при загрузке в основную базу: повторы отбрасываются по 128-битному хэшу строки
+# (фильтр Блума в памяти, проверка по базе и уникальный индекс local_logs.line_hash).
+# Емкость фильтра — сколько хэшей он держит до очистки при заданной доле ложных срабатываний
+DEDUP_ENABLED = os.environ.get('DEDUP_ENABLED', 'False').lower() == 'true'
+DEDUP_BLOOM_CAPACITY = int(os.environ.get('DEDUP_BLOOM_CAPACITY', 10_000_000))
+DEDUP_BLOOM_ERROR_RATE = float(os.environ.get('DEDUP_BLOOM_ERROR_RATE', 0.001))
+
+# Обслуживание базы (log2db.maintenance): хранение фактов по сроку, чистка осиротевших измерений, VACUUM ANALYZE.
+# Полный проход — раз в MAINTENANCE_INTERVAL_SECONDS, VACUUM ANALYZE local_logs — после загрузки
+# MAINTENANCE_VACUUM_AFTER_ROWS строк. RETENTION_DAYS=0 — хранить факты без ограничения срока
+MAINTENANCE_ENABLED = os.environ.get('MAINTENANCE_ENABLED', 'False').lower() == 'true'
+MAINTENANCE_INTERVAL_SECONDS = float(os.environ.get('MAINTENANCE_INTERVAL_SECONDS', 6 * 3600))
+MAINTENANCE_CHECK_SECONDS = float(os.environ.get('MAINTENANCE_CHECK_SECONDS', 60))
+MAINTENANCE_VACUUM_AFTER_ROWS = int(os.environ.get('MAINTENANCE_VACUUM_AFTER_ROWS', 1_000_000))
+RETENTION_DAYS = int(os.environ.get('RETENTION_DAYS', 0))
+# Удаление порциями: строк за запрос, пауза между порциями (дольше, пока идут загрузки), предел времени запроса
+MAINTENANCE_BATCH_ROWS = int(os.environ.get('MAINTENANCE_BATCH_ROWS', 10000))
+MAINTENANCE_BATCH_PAUSE_SECONDS = float(os.environ.get('MAINTENANCE_BATCH_PAUSE_SECONDS', 0.1))
+MAINTENANCE_BUSY_PAUSE_SECONDS = float(os.environ.get('MAINTENANCE_BUSY_PAUSE_SECONDS', 2.0))
+MAINTENANCE_STATEMENT_TIMEOUT_MS = int(os.environ.get('MAINTENANCE_STATEMENT_TIMEOUT_MS', 30000))
+
+# Карантин нераспознанных строк: 'auto' (таблица при загрузке в Postgres, иначе файл), 'table', 'file' или 'off'
+QUARANTINE_SINK = os.environ.get('QUARANTINE_SINK', 'auto').lower()
+QUARANTINE_DIR = os.environ.get('QUARANTINE_DIR', 'quarantine')
+QUARANTINE_FLUSH_ROWS = int(os.environ.get('QUARANTINE_FLUSH_ROWS', 10000))
+# Сводка по отказам пишется в журнал не чаще раза в QUARANTINE_WARN_SECONDS
+QUARANTINE_WARN_SECONDS = float(os.environ.get('QUARANTINE_WARN_SECONDS', 10))
+
+# Временные ряды (/timeseries и график на дашборде): не больше TIMESERIES_MAX_BUCKETS корзин на запрос,
+# не больше TIMESERIES_MAX_POINTS точек на графике; куски агрегатов кэшируются на TIMESERIES_CACHE_SECONDS
+TIMESERIES_MAX_BUCKETS = int(os.environ.get('TIMESERIES_MAX_BUCKETS', 10000))
+TIMESERIES_MAX_POINTS = int(os.environ.get('TIMESERIES_MAX_POINTS', 1000))
+TIMESERIES_CACHE_SECONDS = float(os.environ.get('TIMESERIES_CACHE_SECONDS', 60))
+TIMESERIES_CACHE_CHUNKS = int(os.environ.get('TIMESERIES_CACHE_CHUNKS', 512))
+
+# Просмотр записей (/logs): записей на страницу по умолчанию и наибольшее число,
+# строк за одно чтение серверного курсора (по стольку записей уходит в поток ответа)
+LOGS_PAGE_SIZE = int(os.environ.get('LOGS_PAGE_SIZE', 100))
+LOGS_PAGE_MAX_SIZE = int(os.environ.get('LOGS_PAGE_MAX_SIZE', 5000))
+LOGS_FETCH_ROWS = int(os.environ.get('LOGS_FETCH_ROWS', 500))
+# Поиск (/search): не больше SEARCH_MAX_IDS значений измерения на критерий; при большем числе совпадений
+# поиск выполняется по первым SEARCH_MAX_IDS, а ответ помечается как усеченный
+SEARCH_MAX_IDS = int(os.environ.get('SEARCH_MAX_IDS', 10000))
+
+# Скетчи приближенной аналитики (sketch_hourly): уникальные IP/User-Agent и перцентили времени ответа по часам
+SKETCHES_ENABLED = os.environ.get('SKETCHES_ENABLED', 'True').lower() == 'true'
+# Точность HyperLogLog (2**p регистров): для часа по всем путям и для часа отдельного пути
+SKETCH_HLL_PRECISION = int(os.environ.get('SKETCH_HLL_PRECISION', 12))
+SKETCH_PATH_HLL_PRECISION = int(os.environ.get('SKETCH_PATH_HLL_PRECISION', 10))
+# Относительная ошибка перцентилей DDSketch
+SKETCH_RELATIVE_ACCURACY = float(os.environ.get('SKETCH_RELATIVE_ACCURACY', 0.01))
+# Скетчи сбрасываются в базу, когда набирается столько пар (час, путь)
+SKETCH_MAX_BUCKETS = int(os.environ.get('SKETCH_MAX_BUCKETS', 20000))
+# Сколько самых частых путей показывать в перцентилях по API-путям
+SKETCH_TOP_PATHS = int(os.environ.get('SKETCH_TOP_PATHS', 10))
 DEBUG_MODE = os.environ.get('DEBUG', 'False').lower() == 'true'
 
+# Профилирование: 'off', 'cprofile' или 'sampling'; можно включить и на один запрос параметром ?profile=
+PROFILE_MODE = os.environ.get('PROFILE_MODE', 'off').lower()
+PROFILE_DIR = os.environ.get('PROFILE_DIR', 'profiles')
+PROFILE_SAMPLE_INTERVAL = float(os.environ.get('PROFILE_SAMPLE_INTERVAL', 0.005))
+PROFILE_TOP_FUNCTIONS = int(os.environ.get('PROFILE_TOP_FUNCTIONS', 25))
+
+# Трассировка дашборда: порог медленного колбэка (с) и число хранимых последних трасс
+DASHBOARD_SLOW_CALLBACK_SECONDS = float(os.environ.get('DASHBOARD_SLOW_CALLBACK_SECONDS', 1.0))
+DASHBOARD_TRACE_BUFFER = int(os.environ.get('DASHBOARD_TRACE_BUFFER', 500))
+
 logging.basicConfig(level=logging.DEBUG if DEBUG_MODE else logging.INFO,
                     format='%(asctime)s - %(levelname)s - %(message)s')
@@ -1,13 +1,26 @@
 """Функции по работе с базой данных"""
 
+import io
 import logging
 import psycopg2
 from psycopg2 import sql, extras, errors
 import asyncio
+import pyarrow as pa
+from log2db.config import TIME_STORAGE_MODE, API_TEMPLATES_ENABLED, API_LITERAL_PATHS
+from log2db.columnar import FACT_COLUMNS, buffered_rows, copy_csv_sql, dimension_keys, fact_table, facts_csv
+from log2db.dedup import (CREATE_STAGING, ON_CONFLICT_SKIP, RETURNING_HASHES, insert_from_staging_sql,
+                          SELECT_HOUR_HASHES, SELECT_EXISTING_HASHES, normalize_hash)
+from log2db.raw_archive import RESERVE_LOG_IDS, INSERT_BLOCK
+from log2db.parser import split_referrer
+from log2db.geoip import NO_GEO, get_geoip, ip_geo
+from log2db.metrics import DIMENSION_CACHE, DB_ROUND_TRIPS, BATCH_COMMIT_SECONDS, BATCH_ROWS, DUPLICATE_LINES
 
 
 def create_tables(conn):
-    """Создает таблицы и индексы в базе данных."""
+    """
+    Создает таблицы и индексы в базе данных и переносит timestamp_utc в старые факты
+    (backfill_fact_timestamps): просмотр и поиск записей листают local_logs по этой колонке.
+    """
     logging.info("Проверка и создание таблиц...")
     try:
         with conn.cursor() as cursor:
@@ -15,7 +28,10 @@ def create_tables(conn):
             cursor.execute("""
             CREATE TABLE IF NOT EXISTS dim_ip_client (
                 ip_client_id SERIAL PRIMARY KEY,
-                ip_address TEXT UNIQUE NOT NULL
+                ip_address TEXT UNIQUE NOT NULL,
+                country_code TEXT,
+                asn BIGINT,
+                as_org TEXT
             )""")
             # Таблица User-Agent
             cursor.execute("""
@@ -51,6 +67,12 @@ def create_tables(conn):
                 api_id SERIAL PRIMARY KEY,
                 api_path TEXT UNIQUE NOT NULL
             )""")
+            # Таблица шаблонов API путей (/users/{id}, API_TEMPLATES_ENABLED)
+            cursor.execute("""
+            CREATE TABLE IF NOT EXISTS dim_api_template (
+                api_template_id SERIAL PRIMARY KEY,
+                api_template TEXT UNIQUE NOT NULL
+            )""")
             # Таблица протоколов
             cursor.execute("""
             CREATE TABLE IF NOT EXISTS dim_protocol (
@@ -61,7 +83,9 @@ def create_tables(conn):
             cursor.execute("""
             CREATE TABLE IF NOT EXISTS dim_referrer (
                 referrer_id SERIAL PRIMARY KEY,
-                referrer_url TEXT UNIQUE
+                referrer_url TEXT UNIQUE,
+                referrer_host TEXT,
+                referrer_path TEXT
             )""")
             # Фактовая таблица логов
             cursor.execute("""
@@ -69,28 +93,277 @@ def create_tables(conn):
                 log_id BIGSERIAL PRIMARY KEY,
                 ip_client_id INTEGER NOT NULL REFERENCES dim_ip_client(ip_client_id),
                 user_agent_id INTEGER NOT NULL REFERENCES dim_user_agent(user_agent_id),
-                time_id INTEGER NOT NULL REFERENCES dim_time(time_id),
+                time_id INTEGER REFERENCES dim_time(time_id),
+                timestamp_utc TIMESTAMP WITH TIME ZONE,
                 request_type_id INTEGER NOT NULL REFERENCES dim_request_type(request_type_id),
                 api_id INTEGER NOT NULL REFERENCES dim_api(api_id),
+                api_template_id INTEGER REFERENCES dim_api_template(api_template_id),
                 protocol_id INTEGER NOT NULL REFERENCES dim_protocol(protocol_id),
                 status_code INTEGER,
                 bytes_sent BIGINT,
                 referrer_id INTEGER REFERENCES dim_referrer(referrer_id),
                 response_time INTEGER
             )""")
+            # Карантин строк, которые не удалось разобрать или обработать
+            cursor.execute("""
+            CREATE TABLE IF NOT EXISTS quarantine_lines (
+                quarantine_id BIGSERIAL PRIMARY KEY,
+                source_file TEXT NOT NULL,
+                line_no INTEGER,
+                reason TEXT NOT NULL,
+                detail TEXT,
+                raw_line TEXT NOT NULL,
+                quarantined_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now(),
+                replayed_at TIMESTAMP WITH TIME ZONE
+            )""")
+            # Индекс архива исходных строк: кадр zstd файла архива и диапазон log_id его строк
+            cursor.execute("""
+            CREATE TABLE IF NOT EXISTS raw_archive_blocks (
+                block_id BIGSERIAL PRIMARY KEY,
+                archive_file TEXT NOT NULL,
+                frame_offset BIGINT NOT NULL,
+                frame_length INTEGER NOT NULL,
+                raw_length INTEGER NOT NULL,
+                first_log_id BIGINT NOT NULL,
+                last_log_id BIGINT NOT NULL,
+                line_count INTEGER NOT NULL
+            )""")
+            # Скетчи приближенной аналитики по часам (номер часа от эпохи, UTC) и API-путям, '*' — все пути
+            cursor.execute("""
+            CREATE TABLE IF NOT EXISTS sketch_hourly (
+                hour_bucket BIGINT NOT NULL,
+                api_path TEXT NOT NULL,
+                requests BIGINT NOT NULL,
+                ip_hll BYTEA NOT NULL,
+                ua_hll BYTEA NOT NULL,
+                latency BYTEA NOT NULL,
+                PRIMARY KEY (hour_bucket, api_path)
+            )""")
+            # Гистограммы времени ответа по часам и API-путям (корзины — sketches.LATENCY_BUCKET_EDGES)
+            cursor.execute("""
+            CREATE TABLE IF NOT EXISTS latency_histogram (
+                hour_bucket BIGINT NOT NULL,
+                api_path TEXT NOT NULL,
+                bucket SMALLINT NOT NULL,
+                count BIGINT NOT NULL,
+                PRIMARY KEY (hour_bucket, api_path, bucket)
+            )""")
+            # Миграция для таблиц, созданных до появления timestamp_utc в фактах
+            cursor.execute("ALTER TABLE local_logs ADD COLUMN IF NOT EXISTS timestamp_utc TIMESTAMP WITH TIME ZONE")
+            cursor.execute("ALTER TABLE local_logs ALTER COLUMN time_id DROP NOT NULL")
+            # Хэш исходной строки для дедупликации (DEDUP_ENABLED); у строк, загруженных без нее, — NULL
+            cursor.execute("ALTER TABLE local_logs ADD COLUMN IF NOT EXISTS line_hash UUID")
+            # Шаблон пути; у строк, загруженных без шаблонов, — NULL (агрегаты берут исходный путь)
+            cursor.execute("ALTER TABLE local_logs ADD COLUMN IF NOT EXISTS api_template_id INTEGER "
+                           "REFERENCES dim_api_template(api_template_id)")
+            # Страна и автономная система IP (log2db.geoip); старые значения заполняет backfill_ip_geo
+            cursor.execute("ALTER TABLE dim_ip_client ADD COLUMN IF NOT EXISTS country_code TEXT, "
+                           "ADD COLUMN IF NOT EXISTS asn BIGINT, ADD COLUMN IF NOT EXISTS as_org TEXT")
+            # Хост и путь реферера (parser.split_referrer); старые значения заполняет backfill_referrer_parts
+            cursor.execute("ALTER TABLE dim_referrer ADD COLUMN IF NOT EXISTS referrer_host TEXT, "
+                           "ADD COLUMN IF NOT EXISTS referrer_path TEXT")
             # Индексы
             logging.info("Создание индексов...")
             cursor.execute("CREATE INDEX IF NOT EXISTS idx_logs_time_id ON local_logs (time_id)")
-            cursor.execute("CREATE INDEX IF NOT EXISTS idx_logs_api_id ON local_logs (api_id)")
-            cursor.execute("CREATE INDEX IF NOT EXISTS idx_logs_status_code ON local_logs (status_code)")
-            cursor.execute("CREATE INDEX IF NOT EXISTS idx_logs_ip_client_id ON local_logs (ip_client_id)")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_logs_timestamp_brin ON local_logs USING BRIN (timestamp_utc)")
+            # Просмотр записей (/logs) листается по ключу (timestamp_utc, log_id): составные индексы отдают
+            # страницу с любого места одним проходом по индексу. Они же заменяют индексы по api_id,
+            # status_code и ip_client_id (ведущая колонка та же)
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_logs_ts_log_id ON local_logs (timestamp_utc, log_id)")
+            # Факты без timestamp_utc (загруженные до его появления) ищет backfill_fact_timestamps;
+            # после переноса индекс пуст, и проверка при каждом запуске ничего не стоит
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_logs_timestamp_missing ON local_logs (log_id) "
+                           "WHERE timestamp_utc IS NULL")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_logs_api_ts ON local_logs (api_id, timestamp_utc, log_id)")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_logs_api_template_ts ON local_logs "
+                           "(api_template_id, timestamp_utc, log_id)")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_logs_status_ts ON local_logs (status_code, timestamp_utc, log_id)")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_logs_ip_ts ON local_logs (ip_client_id, timestamp_utc, log_id)")
+            cursor.execute("DROP INDEX IF EXISTS idx_logs_api_id, idx_logs_status_code, idx_logs_ip_client_id")
             cursor.execute("CREATE INDEX IF NOT EXISTS idx_logs_user_agent_id ON local_logs (user_agent_id)")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_logs_referrer_id ON local_logs (referrer_id)")
+            cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_logs_line_hash ON local_logs (line_hash) WHERE line_hash IS NOT NULL")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_latency_histogram_path ON latency_histogram (api_path, hour_bucket)")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_quarantine_pending ON quarantine_lines (source_file) WHERE replayed_at IS NULL")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_raw_archive_log_ids ON raw_archive_blocks (first_log_id, last_log_id)")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_dim_ip_client_country ON dim_ip_client (country_code)")
+            # Поиск по путям и реферерам (/search): префиксные индексы и, если доступен pg_trgm, триграммные
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_dim_api_path_prefix ON dim_api (api_path text_pattern_ops)")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_dim_referrer_host ON dim_referrer (referrer_host text_pattern_ops)")
+            create_trigram_indexes(cursor)
         conn.commit()
         logging.info("Создание таблиц и индексов завершено.")
     except psycopg2.Error as e:
         logging.error(f"Ошибка при создании таблиц: {e}")
         conn.rollback()
         raise
+    backfill_fact_timestamps(conn)
+
+
+# Ключ advisory-блокировки загрузки: загрузки держат ее разделяемой, чистка измерений (log2db.maintenance)
+# берет ее монопольно, чтобы не удалить значения, id которых уже разрешены и лежат в кэшах загрузки
+INGEST_LOCK_KEY = 0x696e6773
+
+
+def acquire_ingest_lock(conn):
+    """Разделяемая блокировка загрузки на сессию соединения (ждет, пока идет порция чистки измерений)."""
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT pg_advisory_lock_shared(%s)", (INGEST_LOCK_KEY,))
+    conn.commit()
+
+
+def release_ingest_lock(conn):
+    """Снимает блокировку загрузки; незавершенная транзакция к этому моменту уже не нужна и откатывается."""
+    if conn.closed:
+        return
+    conn.rollback()
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT pg_advisory_unlock_shared(%s)", (INGEST_LOCK_KEY,))
+    conn.commit()
+
+
+def fact_time_source():
+    """
+    Возвращает SQL-выражение времени факта и JOIN, который для него нужен.
+    В режиме 'inline' время берется прямо из local_logs, без соединения с dim_time.
+    """
+    if TIME_STORAGE_MODE == 'inline':
+        return 'l.timestamp_utc', ''
+    return 't.timestamp_utc', 'JOIN dim_time t ON l.time_id = t.time_id'
+
+
+# Триграммные индексы для поиска по подстроке и шаблону с * в начале или середине (LIKE '%...%')
+TRIGRAM_INDEXES = (
+    ('idx_dim_api_path_trgm', 'dim_api', 'api_path'),
+    ('idx_dim_referrer_url_trgm', 'dim_referrer', 'referrer_url'),
+    ('idx_dim_referrer_host_trgm', 'dim_referrer', 'referrer_host'),
+)
+
+
+def create_trigram_indexes(cursor):
+    """
+    Создает расширение pg_trgm и индексы TRIGRAM_INDEXES. Если расширение недоступно (нет прав или пакета),
+    создание пропускается: поиск по префиксу использует индексы text_pattern_ops, остальной поиск сканирует измерение.
+    Возвращает True, если индексы созданы.
+    """
+    cursor.execute("SAVEPOINT trigram_indexes")
+    try:
+        cursor.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+        for index, table, column in TRIGRAM_INDEXES:
+            cursor.execute(f"CREATE INDEX IF NOT EXISTS {index} ON {table} USING GIN ({column} gin_trgm_ops)")
+        cursor.execute("RELEASE SAVEPOINT trigram_indexes")
+        return True
+    except psycopg2.Error as e:
+        cursor.execute("ROLLBACK TO SAVEPOINT trigram_indexes")
+        logging.warning(f"Триграммные индексы не созданы (нужно расширение pg_trgm): {e}")
+        return False
+
+
+def backfill_referrer_parts(conn, batch_size=10000):
+    """
+    Заполняет referrer_host и referrer_path у рефереров, загруженных до появления этих колонок.
+    Значения без схемы и хоста остаются NULL; проход по referrer_id, поэтому они не перечитываются.
+    """
+    total, position = 0, 0
+    try:
+        with conn.cursor() as cursor:
+            while True:
+                cursor.execute("""
+                    SELECT referrer_id, referrer_url FROM dim_referrer
+                    WHERE referrer_id > %s AND referrer_host IS NULL AND referrer_url IS NOT NULL
+                    ORDER BY referrer_id LIMIT %s
+                """, (position, batch_size))
+                rows = cursor.fetchall()
+                if not rows:
+                    break
+                position = rows[-1][0]
+                values = [(referrer_id, *split_referrer(url)) for referrer_id, url in rows]
+                values = [value for value in values if value[1] is not None]
+                if values:
+                    extras.execute_values(cursor, """
+                        UPDATE dim_referrer d SET referrer_host = v.host, referrer_path = v.path
+                        FROM (VALUES %s) AS v(referrer_id, host, path)
+                        WHERE d.referrer_id = v.referrer_id
+                    """, values)
+                conn.commit()
+                total += len(values)
+        logging.info(f"Заполнение хостов и путей рефереров завершено. Обновлено {total} записей.")
+        return total
+    except psycopg2.Error as e:
+        logging.error(f"Ошибка заполнения хостов и путей рефереров: {e}")
+        conn.rollback()
+        raise
+
+
+def backfill_ip_geo(conn, batch_size=10000):
+    """
+    Заполняет country_code, asn и as_org у IP, загруженных без обогащения (GEOIP_ENABLED).
+    IP, которых нет в базах GeoIP, остаются NULL; проход по ip_client_id, поэтому они не перечитываются.
+    """
+    if get_geoip() is None:
+        raise ValueError("Обогащение IP выключено: задайте GEOIP_ENABLED и GEOIP_DATABASES")
+    total, position = 0, 0
+    try:
+        with conn.cursor() as cursor:
+            while True:
+                cursor.execute("""
+                    SELECT ip_client_id, ip_address FROM dim_ip_client
+                    WHERE ip_client_id > %s AND country_code IS NULL AND asn IS NULL
+                    ORDER BY ip_client_id LIMIT %s
+                """, (position, batch_size))
+                rows = cursor.fetchall()
+                if not rows:
+                    break
+                position = rows[-1][0]
+                values = [(ip_client_id, *ip_geo(ip_address)) for ip_client_id, ip_address in rows]
+                values = [value for value in values if value[1:] != NO_GEO]
+                if values:
+                    extras.execute_values(cursor, """
+                        UPDATE dim_ip_client d SET country_code = v.country_code, asn = v.asn::bigint, as_org = v.as_org
+                        FROM (VALUES %s) AS v(ip_client_id, country_code, asn, as_org)
+                        WHERE d.ip_client_id = v.ip_client_id
+                    """, values)
+                conn.commit()
+                total += len(values)
+        logging.info(f"Обогащение IP завершено. Обновлено {total} записей.")
+        return total
+    except psycopg2.Error as e:
+        logging.error(f"Ошибка обогащения IP: {e}")
+        conn.rollback()
+        raise
+
+
+def backfill_fact_timestamps(conn, batch_size=50000):
+    """
+    Переносит timestamp_utc из dim_time в local_logs для старых записей.
+    Вызывается из create_tables: без timestamp_utc записи не видны в /logs, /search и /logs/raw
+    и не учитываются в режиме TIME_STORAGE_MODE=inline.
+    """
+    total = 0
+    try:
+        with conn.cursor() as cursor:
+            while True:
+                cursor.execute("""
+                    UPDATE local_logs l SET timestamp_utc = t.timestamp_utc
+                    FROM dim_time t
+                    WHERE l.time_id = t.time_id
+                      AND l.log_id IN (
+                          SELECT log_id FROM local_logs
+                          WHERE timestamp_utc IS NULL AND time_id IS NOT NULL
+                          LIMIT %s
+                      )
+                """, (batch_size,))
+                updated = cursor.rowcount
+                conn.commit()
+                total += updated
+                if updated < batch_size:
+                    break
+        logging.info(f"Перенос timestamp_utc в local_logs завершен. Обновлено {total} записей.")
+        return total
+    except psycopg2.Error as e:
+        logging.error(f"Ошибка переноса timestamp_utc в local_logs: {e}")
+        conn.rollback()
+        raise
 
 
 def get_or_insert_dimension(cursor, cache, table, columns_data):
@@ -102,13 +375,16 @@ def get_or_insert_dimension(cursor, cache, table, columns_data):
     if main_value is None:
         return None
     if main_value in cache:
+        DIMENSION_CACHE.inc(table=table, result='hit')
         return cache[main_value]
+    DIMENSION_CACHE.inc(table=table, result='miss')
     query_select = sql.SQL("SELECT {id_col} FROM {table} WHERE {main_col} = %s").format(
         id_col=sql.Identifier(id_col_name),
         table=sql.Identifier(table),
         main_col=sql.Identifier(main_column)
     )
     try:
+        DB_ROUND_TRIPS.inc(operation='select')
         cursor.execute(query_select, (main_value,))
         result = cursor.fetchone()
     except psycopg2.Error as e:
@@ -123,6 +399,7 @@ def get_or_insert_dimension(cursor, cache, table, columns_data):
         savepoint_name_str = f"sp_insert_{table.replace('dim_', '')}_{abs(hash(main_value)) % 10000}"
         savepoint_name = sql.Identifier(savepoint_name_str)
         try:
+            DB_ROUND_TRIPS.inc(operation='savepoint')
             cursor.execute(sql.SQL("SAVEPOINT {}").format(savepoint_name))
             cols = list(columns_data.keys())
             vals = list(columns_data.values())
@@ -136,11 +413,13 @@ def get_or_insert_dimension(cursor, cache, table, columns_data):
                 placeholders_sql,
                 id_col_sql
             )
+            DB_ROUND_TRIPS.inc(operation='insert')
             cursor.execute(insert_query, vals)
             new_id = cursor.fetchone()[0]
             cache[main_value] = new_id
             return new_id
         except errors.UniqueViolation:
+            DB_ROUND_TRIPS.inc(2, operation='race_retry')
             cursor.execute(sql.SQL("ROLLBACK TO SAVEPOINT {}").format(savepoint_name))
             logging.debug(f"Race condition handled for {table} with value '{main_value}'. Re-selecting.")
             cursor.execute(query_select, (main_value,))
@@ -161,27 +440,138 @@ def get_or_insert_dimension(cursor, cache, table, columns_data):
             raise
 
 
-def insert_batch(conn, batch_buffer):
-    """Пакетная вставка данных в таблицу local_logs."""
+def insert_batch(conn, batch_buffer, returning=False):
+    """
+    Пакетная вставка данных в таблицу local_logs.
+    Строки с хэшем исходной строки (последний элемент, дедупликация) вставляются с ON CONFLICT DO NOTHING.
+    Возвращает (число вставленных строк, хэши вставленных строк с дедупликацией и returning или None).
+    """
+    inserted, hashes = 0, None
     if batch_buffer:
         insert_count = len(batch_buffer)
         logging.info(f"Вставка пакета из {insert_count} записей...")
         with conn.cursor() as cursor:
             try:
+                dedup = len(batch_buffer[0]) > len(FACT_COLUMNS)
+                returning = returning and dedup
                 query = sql.SQL("""
                     INSERT INTO local_logs (
-                        ip_client_id, user_agent_id, time_id, request_type_id, api_id,
-                        protocol_id, status_code, bytes_sent, referrer_id, response_time
-                    ) VALUES %s
-                """)
-                extras.execute_values(cursor, query.as_string(cursor), batch_buffer, page_size=insert_count)
-                conn.commit()
+                        ip_client_id, user_agent_id, time_id, timestamp_utc, request_type_id, api_id,
+                        api_template_id, protocol_id, status_code, bytes_sent, referrer_id, response_time{line_hash}
+                    ) VALUES %s{on_conflict}{returning}
+                """).format(line_hash=sql.SQL(', line_hash' if dedup else ''),
+                            on_conflict=sql.SQL(ON_CONFLICT_SKIP if dedup else ''),
+                            returning=sql.SQL(RETURNING_HASHES if returning else ''))
+                with BATCH_COMMIT_SECONDS.time():
+                    DB_ROUND_TRIPS.inc(2, operation='batch_insert')
+                    rows = extras.execute_values(cursor, query.as_string(cursor), batch_buffer,
+                                                 page_size=insert_count, fetch=returning)
+                    inserted = cursor.rowcount
+                    conn.commit()
+                if returning:
+                    hashes = [normalize_hash(row[0]) for row in rows]
+                if dedup:
+                    DUPLICATE_LINES.inc(insert_count - inserted, stage='constraint')
+                BATCH_ROWS.inc(inserted)
                 logging.info(f"Пакет из {insert_count} записей успешно вставлен и транзакция закоммичена.")
                 batch_buffer.clear()
             except psycopg2.Error as e:
                 logging.error(f"Ошибка пакетной вставки: {e}")
                 conn.rollback()
                 raise
+    return inserted, hashes
+
+
+def resolve_fact_columns(cursor, caches, table):
+    """
+    Разрешает измерения блока, разобранного columnar.parse_block, и возвращает таблицу фактов.
+    get_or_insert_dimension вызывается на уникальное значение измерения в блоке, а не на строку.
+    """
+    dimension_ids = {}
+    for attr, table_name, columns, values, indices in dimension_keys(table, TIME_STORAGE_MODE != 'inline',
+                                                                     API_TEMPLATES_ENABLED, API_LITERAL_PATHS):
+        cache = getattr(caches, attr)
+        names = [name for name, _ in columns]
+        dimension_ids[attr] = ([get_or_insert_dimension(cursor, cache, table_name, dict(zip(names, value)))
+                                for value in values], indices)
+    return fact_table(table, dimension_ids)
+
+
+def copy_facts(conn, fact_tables, returning=False):
+    """
+    Пакетная вставка таблиц фактов (columnar.fact_table) в local_logs через COPY.
+    Факты с колонкой line_hash копируются во временную таблицу и переносятся в local_logs
+    с ON CONFLICT DO NOTHING: повторы, не пойманные фильтром, отбрасывает уникальный индекс.
+    Колонки COPY берутся из таблиц фактов (log_id — у блоков, записанных в архив строк).
+    Возвращает (число вставленных строк, хэши вставленных строк с line_hash и returning или None).
+    """
+    inserted, hashes = 0, None
+    if fact_tables:
+        insert_count = buffered_rows(fact_tables)
+        columns = fact_tables[0].column_names
+        logging.info(f"Вставка пакета из {insert_count} записей (COPY)...")
+        with conn.cursor() as cursor:
+            try:
+                with BATCH_COMMIT_SECONDS.time():
+                    if 'line_hash' in columns:
+                        DB_ROUND_TRIPS.inc(4, operation='copy_insert')
+                        cursor.execute(CREATE_STAGING)
+                        cursor.copy_expert(copy_csv_sql('local_logs_incoming', columns),
+                                           io.BytesIO(facts_csv(fact_tables)))
+                        cursor.execute(insert_from_staging_sql(columns, returning))
+                        inserted = cursor.rowcount
+                        if returning:
+                            hashes = [normalize_hash(row[0]) for row in cursor.fetchall()]
+                        DUPLICATE_LINES.inc(insert_count - inserted, stage='constraint')
+                    else:
+                        DB_ROUND_TRIPS.inc(2, operation='copy_insert')
+                        cursor.copy_expert(copy_csv_sql('local_logs', columns), io.BytesIO(facts_csv(fact_tables)))
+                        inserted = insert_count
+                    conn.commit()
+                BATCH_ROWS.inc(inserted)
+                logging.info(f"Пакет из {insert_count} записей успешно вставлен и транзакция закоммичена.")
+                fact_tables.clear()
+            except psycopg2.Error as e:
+                logging.error(f"Ошибка пакетной вставки: {e}")
+                conn.rollback()
+                raise
+    return inserted, hashes
+
+
+def drop_duplicate_lines(cursor, dedup, table, pending=()):
+    """
+    Отбрасывает повторные строки блока (с колонкой line_hash) через фильтр dedup.LineDeduplicator:
+    подгружает в фильтр хэши local_logs за новые часы блока и проверяет по базе только срабатывания фильтра.
+    pending — таблицы фактов, еще не вставленные в базу. Возвращает блок без повторов.
+    """
+    for start, end in dedup.hours_to_load(table):
+        DB_ROUND_TRIPS.inc(operation='dedup_load')
+        cursor.execute(SELECT_HOUR_HASHES, (start, end))
+        dedup.load(start, end, [row[0] for row in cursor.fetchall()])
+    repeated, candidates = dedup.candidates(table, pending)
+    existing = []
+    if candidates:
+        DB_ROUND_TRIPS.inc(operation='dedup_check')
+        cursor.execute(SELECT_EXISTING_HASHES, (candidates,))
+        existing = [row[0] for row in cursor.fetchall()]
+    table, dropped = dedup.keep(table, repeated, existing)
+    DUPLICATE_LINES.inc(dropped, stage='filter')
+    return table
+
+
+def archive_raw_lines(cursor, archive, table, facts):
+    """
+    Записывает исходные строки блока (колонка raw_line) кадром архива raw_archive.RawArchive:
+    выдает фактам log_id из последовательности local_logs и добавляет строку индекса raw_archive_blocks
+    в текущую транзакцию. Возвращает таблицу фактов с колонкой log_id.
+    Кадр пишется до вставки фактов: строки, которые затем отбросит уникальный индекс (line_hash),
+    остаются в кадре и в line_count, но их log_id не получает факта и при чтении архива не запрашивается.
+    """
+    DB_ROUND_TRIPS.inc(2, operation='raw_archive')
+    cursor.execute(RESERVE_LOG_IDS, (facts.num_rows,))
+    log_ids = [row[0] for row in cursor.fetchall()]
+    cursor.execute(INSERT_BLOCK, archive.write(log_ids, table['raw_line'].to_pylist()))
+    return facts.add_column(0, 'log_id', pa.array(log_ids, pa.int64()))
 
 
 async def run_db_operation(func, *args):
@@ -0,0 +1,181 @@
+"""Дедупликация строк логов при загрузке: хэш строки, фильтр Блума в памяти и уникальный индекс в базе"""
+
+import hashlib
+import math
+import threading
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+from log2db.config import DEDUP_ENABLED, DEDUP_BLOOM_CAPACITY, DEDUP_BLOOM_ERROR_RATE
+from log2db.columnar import FACT_COLUMNS
+
+HOUR_SECONDS = 3600
+
+# Факты с хэшем строки: вставка через временную таблицу, повторы отбрасывает уникальный индекс.
+# log_id во временной таблице есть всегда и заполняется, если блок записан в архив строк (log2db.raw_archive)
+DEDUP_FACT_COLUMNS = FACT_COLUMNS + ('line_hash',)
+CREATE_STAGING = (f"CREATE TEMP TABLE IF NOT EXISTS local_logs_incoming ON COMMIT DELETE ROWS AS "
+                  f"SELECT log_id, {', '.join(DEDUP_FACT_COLUMNS)} FROM local_logs WITH NO DATA")
+ON_CONFLICT_SKIP = " ON CONFLICT (line_hash) WHERE line_hash IS NOT NULL DO NOTHING"
+# Хэши строк, действительно вставленных в local_logs (для скетчей: повторы, отброшенные индексом, не учитываются)
+RETURNING_HASHES = " RETURNING line_hash"
+
+SELECT_HOUR_HASHES = ("SELECT line_hash FROM local_logs WHERE timestamp_utc >= to_timestamp(%s) "
+                      "AND timestamp_utc < to_timestamp(%s) AND line_hash IS NOT NULL")
+SELECT_EXISTING_HASHES = "SELECT line_hash FROM local_logs WHERE line_hash = ANY(%s::uuid[])"
+
+
+def insert_from_staging_sql(columns, returning=False):
+    """Перенос колонок columns из временной таблицы в local_logs без повторов; returning — вернуть хэши вставленных строк."""
+    names = ', '.join(columns)
+    return (f"INSERT INTO local_logs ({names}) SELECT {names} FROM local_logs_incoming" + ON_CONFLICT_SKIP
+            + (RETURNING_HASHES if returning else ''))
+
+
+def line_hash(line):
+    """128-битный хэш строки лога (без пробелов по краям) в hex — значение uuid-колонки line_hash."""
+    return hashlib.blake2b(line.strip().encode('utf-8'), digest_size=16).hexdigest()
+
+
+def with_line_hashes(table, lines, line_index):
+    """Добавляет в блок columnar.parse_block колонку line_hash для строк lines[line_index]."""
+    return table.append_column('line_hash', pa.array([line_hash(lines[i]) for i in line_index], pa.string()))
+
+
+def normalize_hash(value):
+    """Хэш из базы (uuid: строка с дефисами в psycopg2, uuid.UUID в psycopg 3) в hex без дефисов."""
+    return str(value).replace('-', '')
+
+
+def _words(hashes):
+    """Хэши hex -> массив uint64 [n, 2] для фильтра Блума."""
+    if not hashes:
+        return np.empty((0, 2), dtype=np.uint64)
+    return np.frombuffer(bytes.fromhex(''.join(hashes)), dtype=np.uint64).reshape(-1, 2)
+
+
+class BloomFilter:
+    """
+    Фильтр Блума на массиве битов numpy. Позиции k хэш-функций получаются двойным хэшированием
+    из двух 64-битных половин хэша строки, поэтому блок проверяется и добавляется массивами.
+    """
+
+    def __init__(self, capacity, error_rate):
+        self.size = max(64, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hash_count = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = np.zeros((self.size + 7) // 8, dtype=np.uint8)
+        self.count = 0
+
+    def _positions(self, words):
+        steps = np.arange(self.hash_count, dtype=np.uint64)
+        with np.errstate(over='ignore'):
+            return (words[:, :1] + steps * words[:, 1:]) % np.uint64(self.size)
+
+    def contains(self, words):
+        positions = self._positions(words)
+        bits = self.bits[positions >> np.uint64(3)] >> (positions & np.uint64(7)).astype(np.uint8)
+        return (bits & 1).all(axis=1)
+
+    def add(self, words):
+        positions = self._positions(words).ravel()
+        masks = np.left_shift(np.uint8(1), (positions & np.uint64(7)).astype(np.uint8))
+        np.bitwise_or.at(self.bits, positions >> np.uint64(3), masks)
+        self.count += len(words)
+
+    def clear(self):
+        self.bits[:] = 0
+        self.count = 0
+
+
+class LineDeduplicator:
+    """
+    Фильтр повторов строк на процесс (общий для одновременных загрузок).
+    В фильтре — хэши строк, загруженных этим процессом, и хэши из local_logs за часы, которые уже
+    встречались при загрузке (подгружаются при первом обращении к часу). Поэтому ответ «не встречалась»
+    окончательный, а «возможно, встречалась» проверяется запросом к базе: ложное срабатывание
+    не отбрасывает новую строку. Когда в фильтре набирается capacity хэшей, он очищается
+    вместе со списком подгруженных часов. Окончательная защита фактов — уникальный индекс line_hash.
+    """
+
+    def __init__(self, capacity=DEDUP_BLOOM_CAPACITY, error_rate=DEDUP_BLOOM_ERROR_RATE):
+        self.capacity = capacity
+        self.bloom = BloomFilter(capacity, error_rate)
+        self.loaded_hours = set()
+        self._lock = threading.Lock()
+
+    def hours_to_load(self, table):
+        """Непрерывные диапазоны часов блока, еще не подгруженные в фильтр: [(начало, конец) в секундах от эпохи]."""
+        timestamps = table['timestamp_utc'].cast(pa.int64()).to_numpy()
+        hours = np.unique(timestamps // (HOUR_SECONDS * 1_000_000))
+        with self._lock:
+            missing = [int(hour) for hour in hours if hour not in self.loaded_hours]
+        ranges = []
+        for hour in missing:
+            if ranges and ranges[-1][1] == hour:
+                ranges[-1][1] = hour + 1
+            else:
+                ranges.append([hour, hour + 1])
+        return [(first * HOUR_SECONDS, end * HOUR_SECONDS) for first, end in ranges]
+
+    def load(self, start, end, hashes):
+        """Добавляет в фильтр хэши local_logs за часы [start, end) (секунды от эпохи)."""
+        with self._lock:
+            self._reserve(len(hashes))
+            self.bloom.add(_words([normalize_hash(value) for value in hashes]))
+            self.loaded_hours.update(range(start // HOUR_SECONDS, end // HOUR_SECONDS))
+
+    def candidates(self, table, pending=()):
+        """
+        Проверяет блок по фильтру. Возвращает (repeated, candidates):
+          - repeated — маска строк, точно повторных: встретились выше в блоке или в pending
+            (таблицах фактов, ожидающих вставки)
+          - candidates — хэши, которые фильтр считает встреченными; их нужно проверить по базе
+        """
+        hashes = table['line_hash']
+        _, first = np.unique(np.asarray(hashes.to_pylist(), dtype=object), return_index=True)
+        repeated = np.ones(table.num_rows, dtype=bool)
+        repeated[first] = False
+        pending = [fact['line_hash'] for fact in pending if 'line_hash' in fact.column_names]
+        if pending:
+            buffered = pa.chunked_array(pending).combine_chunks()
+            repeated |= pc.is_in(hashes, value_set=buffered).to_numpy(zero_copy_only=False)
+        values = hashes.to_pylist()
+        with self._lock:
+            seen = self.bloom.contains(_words(values))
+        return repeated, [value for value, hit, dup in zip(values, seen, repeated) if hit and not dup]
+
+    def keep(self, table, repeated, existing):
+        """
+        Оставляет в блоке новые строки (existing — хэши кандидатов, найденные в базе) и добавляет их в фильтр.
+        Возвращает (блок без повторов, число отброшенных строк).
+        """
+        existing = {normalize_hash(value) for value in existing}
+        values = table['line_hash'].to_pylist()
+        keep = ~repeated
+        if existing:
+            keep &= np.array([value not in existing for value in values], dtype=bool)
+        kept = [value for value, flag in zip(values, keep) if flag]
+        with self._lock:
+            self._reserve(len(kept))
+            self.bloom.add(_words(kept))
+        return table.filter(pa.array(keep)), int(len(keep) - keep.sum())
+
+    def _reserve(self, count):
+        if self.bloom.count + count > self.capacity:
+            self.bloom.clear()
+            self.loaded_hours.clear()
+
+
+_deduplicator = None
+_deduplicator_lock = threading.Lock()
+
+
+def get_deduplicator():
+    """Фильтр повторов процесса (DEDUP_ENABLED) или None; массив фильтра выделяется при первом обращении."""
+    global _deduplicator
+    if not DEDUP_ENABLED:
+        return None
+    with _deduplicator_lock:
+        if _deduplicator is None:
+            _deduplicator = LineDeduplicator()
+        return _deduplicator
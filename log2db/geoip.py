@@ -0,0 +1,174 @@
+"""Обогащение IP клиентов страной и автономной системой (ASN) по локальной базе MMDB или CSV"""
+
+import os
+import csv
+import time
+import bisect
+import logging
+import ipaddress
+import threading
+from functools import lru_cache
+from log2db.config import GEOIP_ENABLED, GEOIP_DATABASES, GEOIP_CACHE_SIZE
+
+# (country_code, asn, as_org) для адресов, которых нет в базе
+NO_GEO = (None, None, None)
+
+# Названия колонок CSV с заголовком -> поле диапазона
+CSV_COLUMNS = {
+    'network': 'network', 'cidr': 'network',
+    'start_ip': 'start_ip', 'range_start': 'start_ip', 'ip_from': 'start_ip',
+    'end_ip': 'end_ip', 'range_end': 'end_ip', 'ip_to': 'end_ip',
+    'country_code': 'country_code', 'country': 'country_code', 'country_iso_code': 'country_code',
+    'asn': 'asn', 'as_number': 'asn', 'autonomous_system_number': 'asn',
+    'as_org': 'as_org', 'as_name': 'as_org', 'as_description': 'as_org', 'autonomous_system_organization': 'as_org',
+}
+# Порядок колонок TSV iptoasn.com без заголовка
+IPTOASN_COLUMNS = ('start_ip', 'end_ip', 'asn', 'country_code', 'as_org')
+
+
+class RangeIndex:
+    """
+    Диапазоны адресов одной версии IP, отсортированные по началу: поиск — двоичный (bisect)
+    по массиву начал. Соседние диапазоны с одинаковыми значениями сливаются в один.
+    """
+
+    def __init__(self, ranges):
+        self.starts, self.ends, self.values = [], [], []
+        for start, end, value in sorted(ranges, key=lambda item: item[0]):
+            if self.values and value == self.values[-1] and start == self.ends[-1] + 1:
+                self.ends[-1] = end
+                continue
+            self.starts.append(start)
+            self.ends.append(end)
+            self.values.append(value)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def find(self, address):
+        position = bisect.bisect_right(self.starts, address) - 1
+        if position >= 0 and address <= self.ends[position]:
+            return self.values[position]
+        return None
+
+
+def _value(interned, country_code, asn, as_org):
+    """Одинаковые значения диапазонов хранятся одним кортежем."""
+    value = (country_code or None, int(asn) if asn not in (None, '', '0', 0) else None, as_org or None)
+    return interned.setdefault(value, value)
+
+
+def _csv_ranges(path):
+    """Диапазоны CSV (TSV для .tsv): колонки network или start_ip/end_ip и country_code, asn, as_org."""
+    interned, ranges = {}, {4: [], 6: []}
+    with open(path, newline='', encoding='utf-8') as f:
+        reader = csv.reader(f, delimiter='\t' if path.endswith('.tsv') else ',')
+        first = next(reader, None)
+        if first is None:
+            return ranges
+        try:
+            ipaddress.ip_address(first[0].strip())
+            columns, rows = IPTOASN_COLUMNS, [first]
+        except ValueError:
+            columns, rows = [CSV_COLUMNS.get(name.strip().lower()) for name in first], []
+        for row in rows + list(reader):
+            fields = {name: value.strip() for name, value in zip(columns, row) if name}
+            if 'network' in fields:
+                network = ipaddress.ip_network(fields['network'], strict=False)
+                version, start, end = network.version, int(network.network_address), int(network.broadcast_address)
+            else:
+                first_ip, last_ip = ipaddress.ip_address(fields['start_ip']), ipaddress.ip_address(fields['end_ip'])
+                version, start, end = first_ip.version, int(first_ip), int(last_ip)
+            ranges[version].append((start, end, _value(interned, fields.get('country_code'), fields.get('asn'),
+                                                       fields.get('as_org'))))
+    return ranges
+
+
+def _mmdb_ranges(path):
+    """Диапазоны базы MaxMind (GeoLite2/GeoIP2 Country, City или ASN): все сети базы читаются один раз."""
+    import maxminddb
+
+    interned, ranges = {}, {4: [], 6: []}
+    with maxminddb.open_database(path) as reader:
+        for network, record in reader:
+            record = record or {}
+            country = record.get('country') or record.get('registered_country') or {}
+            value = _value(interned, country.get('iso_code'), record.get('autonomous_system_number'),
+                           record.get('autonomous_system_organization'))
+            if value != NO_GEO:
+                ranges[network.version].append((int(network.network_address), int(network.broadcast_address), value))
+    return ranges
+
+
+class GeoIPIndex:
+    """
+    Индекс баз GEOIP_DATABASES в памяти: для каждой базы — RangeIndex по версиям IP.
+    Поля берутся из первой базы, где они есть, поэтому страну и ASN можно загрузить из разных баз
+    (например, GeoLite2-Country.mmdb и GeoLite2-ASN.mmdb).
+    """
+
+    def __init__(self, sources):
+        self.sources = sources
+
+    @classmethod
+    def load(cls, paths):
+        sources = []
+        for path in paths:
+            started = time.perf_counter()
+            ranges = _mmdb_ranges(path) if path.endswith('.mmdb') else _csv_ranges(path)
+            source = {version: RangeIndex(items) for version, items in ranges.items()}
+            logging.info(f"База GeoIP {os.path.basename(path)}: {sum(map(len, source.values()))} диапазонов "
+                         f"за {time.perf_counter() - started:.1f} с")
+            sources.append(source)
+        return cls(sources)
+
+    def lookup(self, ip):
+        """(country_code, asn, as_org) адреса ip; NO_GEO для адресов вне баз и строк, не являющихся IP."""
+        try:
+            address = ipaddress.ip_address(ip)
+        except ValueError:
+            return NO_GEO
+        if address.version == 6 and address.ipv4_mapped is not None:
+            address = address.ipv4_mapped
+        result = NO_GEO
+        for source in self.sources:
+            value = source[address.version].find(int(address))
+            if value is not None:
+                result = tuple(current if current is not None else found for current, found in zip(result, value))
+                if None not in result:
+                    break
+        return result
+
+
+_geoip = None
+_geoip_lock = threading.Lock()
+
+
+def get_geoip():
+    """Индекс баз GEOIP_DATABASES (один на процесс, загружается при первом обращении); None, если выключено."""
+    global _geoip
+    if not GEOIP_ENABLED or not GEOIP_DATABASES:
+        return None
+    with _geoip_lock:
+        if _geoip is None:
+            try:
+                _geoip = GeoIPIndex.load(GEOIP_DATABASES)
+            except (OSError, ValueError, KeyError, ImportError) as e:
+                logging.error(f"Ошибка загрузки баз GeoIP {GEOIP_DATABASES}: {e}")
+                raise
+        return _geoip
+
+
+@lru_cache(maxsize=GEOIP_CACHE_SIZE)
+def _lookup(ip):
+    return get_geoip().lookup(ip)
+
+
+def ip_geo(ip):
+    """
+    (country_code, asn, as_org) для колонок измерения dim_ip_client. Результат запоминается
+    для GEOIP_CACHE_SIZE адресов; без GEOIP_ENABLED — NO_GEO без обращения к индексу.
+    """
+    if not GEOIP_ENABLED or not GEOIP_DATABASES:
+        return NO_GEO
+    return _lookup(ip)
@@ -5,8 +5,11 @@ import asyncio
 import logging
 import psycopg2
 from db import create_tables, run_db_operation
-from config import DATABASE_CONFIG, LOCAL_LOG_DIRECTORY
+from config import DATABASE_CONFIG, LOCAL_LOG_DIRECTORY, ASYNC_DB_ENABLED, MAINTENANCE_ENABLED
 from processor import process_file_async
+from shards import get_shards, sharding_enabled
+from maintenance import get_scheduler
+import async_db
 
 
 async def main():
@@ -18,11 +21,22 @@ async def main():
     processed_files_count = 0
     error_files_count = 0
     try:
-        logging.info("Подключение к базе данных для локальной обработки...")
-        conn = await run_db_operation(lambda: psycopg2.connect(**DATABASE_CONFIG))
-        conn.autocommit = False
-        logging.info("Соединение установлено, autocommit=False.")
-        await run_db_operation(create_tables, conn)
+        if sharding_enabled():
+            for shard in get_shards():
+                logging.info(f"Создание таблиц на шарде {shard.name}...")
+                async with shard.connection_async() as shard_conn:
+                    await run_db_operation(create_tables, shard_conn)
+        else:
+            logging.info("Подключение к базе данных для локальной обработки...")
+            conn = await run_db_operation(lambda: psycopg2.connect(**DATABASE_CONFIG))
+            conn.autocommit = False
+            logging.info("Соединение установлено, autocommit=False.")
+            await run_db_operation(create_tables, conn)
+            if ASYNC_DB_ENABLED:
+                # psycopg2 нужен только для создания таблиц, загрузка идет через асинхронное соединение
+                await run_db_operation(conn.close)
+                conn = await async_db.connect()
+                logging.info("Загрузка через асинхронное соединение (psycopg 3).")
         os.makedirs(LOCAL_LOG_DIRECTORY, exist_ok=True)
         log_files = sorted([f for f in os.listdir(LOCAL_LOG_DIRECTORY) if f.endswith('.log')])
         if not log_files:
@@ -44,6 +58,9 @@ async def main():
         logging.info(f"Обработано файлов: {processed_files_count}")
         logging.info(f"Файлов с ошибками: {error_files_count}")
         logging.info(f"Всего записей загружено: {total_processed_all_files}")
+        if MAINTENANCE_ENABLED and total_processed_all_files:
+            # После большой загрузки обновляем статистику планировщика и карту видимости
+            await asyncio.to_thread(get_scheduler().run, False)
     except psycopg2.Error as e:
         logging.error(f"Ошибка базы данных в main(): {e}")
     except Exception as e:
@@ -51,7 +68,10 @@ async def main():
     finally:
         if conn:
             logging.info("Закрытие соединения с БД из main.")
-            await run_db_operation(conn.close)
+            if async_db.is_async_connection(conn):
+                await conn.close()
+            else:
+                await run_db_operation(conn.close)
 
 
 if __name__ == "__main__":
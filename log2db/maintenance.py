@@ -0,0 +1,333 @@
+"""Обслуживание базы: хранение фактов по сроку, чистка осиротевших измерений и VACUUM ANALYZE"""
+
+import os
+import asyncio
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+import psycopg2
+from log2db.config import (DATABASE_CONFIG, MAINTENANCE_INTERVAL_SECONDS, MAINTENANCE_CHECK_SECONDS,
+                           MAINTENANCE_VACUUM_AFTER_ROWS, RETENTION_DAYS, MAINTENANCE_BATCH_ROWS,
+                           MAINTENANCE_BATCH_PAUSE_SECONDS, MAINTENANCE_BUSY_PAUSE_SECONDS,
+                           MAINTENANCE_STATEMENT_TIMEOUT_MS, RAW_ARCHIVE_DIR)
+from log2db.db import INGEST_LOCK_KEY, fact_time_source
+from log2db.metrics import BATCH_ROWS, MAINTENANCE_ROWS
+from log2db.shards import get_shards, sharding_enabled
+
+# Измерения, которые чистятся от значений без фактов: (таблица, id = внешний ключ в local_logs).
+# dim_request_type и dim_protocol из нескольких строк не разрастаются и не чистятся
+PRUNED_DIMENSIONS = (
+    ('dim_ip_client', 'ip_client_id'),
+    ('dim_user_agent', 'user_agent_id'),
+    ('dim_time', 'time_id'),
+    ('dim_api', 'api_id'),
+    ('dim_api_template', 'api_template_id'),
+    ('dim_referrer', 'referrer_id'),
+)
+
+# Загрузки держат блокировку INGEST_LOCK_KEY разделяемой (одно 64-битное число в pg_locks — classid и objid)
+_INGEST_ACTIVE = """
+    SELECT EXISTS (
+        SELECT 1 FROM pg_locks
+        WHERE locktype = 'advisory' AND mode = 'ShareLock' AND objsubid = 1
+          AND classid = (%(key)s >> 32)::oid AND objid = (%(key)s & 4294967295)::oid
+    )
+"""
+
+
+def ingestion_active(cursor):
+    cursor.execute(_INGEST_ACTIVE, {'key': INGEST_LOCK_KEY})
+    return cursor.fetchone()[0]
+
+
+def _pause(cursor):
+    """Пауза между порциями: короткая, пока база свободна, и длинная, пока идут загрузки."""
+    time.sleep(MAINTENANCE_BUSY_PAUSE_SECONDS if ingestion_active(cursor) else MAINTENANCE_BATCH_PAUSE_SECONDS)
+
+
+def _delete_in_batches(cursor, table, query, params, reason, batch_rows):
+    """Повторяет удаление порции (query с LIMIT) до тех пор, пока удаляются строки. Возвращает число удаленных."""
+    total = 0
+    while True:
+        cursor.execute(query, params)
+        deleted = cursor.rowcount
+        total += deleted
+        MAINTENANCE_ROWS.inc(deleted, table=table, reason=reason)
+        if deleted < batch_rows:
+            return total
+        _pause(cursor)
+
+
+def apply_retention(cursor, retention_days=RETENTION_DAYS, batch_rows=MAINTENANCE_BATCH_ROWS):
+    """
+    Удаляет факты старше retention_days дней порциями по batch_rows строк, а также скетчи
+    и строки карантина за тот же срок и кадры архива строк без фактов (prune_raw_archive).
+    Возвращает {таблица: удалено строк}.
+    """
+    cutoff = datetime.now(timezone.utc) - timedelta(days=retention_days)
+    ts_expr, time_join = fact_time_source()
+    deleted = {'local_logs': _delete_in_batches(cursor, 'local_logs', f"""
+        DELETE FROM local_logs WHERE log_id IN (
+            SELECT l.log_id FROM local_logs l {time_join} WHERE {ts_expr} < %s LIMIT %s
+        )""", (cutoff, batch_rows), 'retention', batch_rows)}
+    hour_bucket = int(cutoff.timestamp()) // 3600
+    for table in ('sketch_hourly', 'latency_histogram'):
+        cursor.execute(f"DELETE FROM {table} WHERE hour_bucket < %s", (hour_bucket,))
+        deleted[table] = cursor.rowcount
+        MAINTENANCE_ROWS.inc(cursor.rowcount, table=table, reason='retention')
+    deleted['quarantine_lines'] = _delete_in_batches(cursor, 'quarantine_lines', """
+        DELETE FROM quarantine_lines WHERE quarantine_id IN (
+            SELECT quarantine_id FROM quarantine_lines WHERE quarantined_at < %s LIMIT %s
+        )""", (cutoff, batch_rows), 'retention', batch_rows)
+    deleted['raw_archive_blocks'] = prune_raw_archive(cursor, batch_rows=batch_rows)
+    return deleted
+
+
+def prune_raw_archive(cursor, base_dir=RAW_ARCHIVE_DIR, batch_rows=MAINTENANCE_BATCH_ROWS):
+    """
+    Удаляет строки индекса raw_archive_blocks, все log_id которых меньше наименьшего оставшегося log_id фактов
+    (при пустой local_logs — все), а затем файлы .zst в base_dir, на которые не осталось строк индекса.
+    Порции выполняются под монопольной блокировкой загрузки: загрузка выдает log_id и пишет кадр до вставки
+    фактов, поэтому ее кадры, как и недописанные файлы, не удаляются. Пока идут загрузки, чистка
+    откладывается до следующего прохода. Архив ведется только для основной базы, поэтому при шардировании
+    файлы не удаляются. Возвращает число удаленных строк индекса.
+    """
+    query = """
+        WITH bound AS (
+            SELECT COALESCE((SELECT min(log_id) FROM local_logs), 9223372036854775807) AS min_log_id
+        )
+        DELETE FROM raw_archive_blocks WHERE ctid IN (
+            SELECT b.ctid FROM raw_archive_blocks b, bound
+            WHERE b.first_log_id < bound.min_log_id AND b.last_log_id < bound.min_log_id
+            LIMIT %s
+        )
+    """
+    total = 0
+    while True:
+        with _exclusive_ingest_lock(cursor) as acquired:
+            if not acquired:
+                logging.info("Чистка raw_archive_blocks отложена: идут загрузки")
+                return total
+            cursor.execute(query, (batch_rows,))
+            deleted = cursor.rowcount
+            total += deleted
+            MAINTENANCE_ROWS.inc(deleted, table='raw_archive_blocks', reason='retention')
+            if deleted < batch_rows:
+                if not sharding_enabled():
+                    _remove_archive_files(cursor, base_dir)
+                return total
+        _pause(cursor)
+
+
+def _remove_archive_files(cursor, base_dir):
+    """Удаляет файлы архива без строк индекса и опустевшие каталоги дат; вызывается под блокировкой загрузки."""
+    if not os.path.isdir(base_dir):
+        return
+    cursor.execute("SELECT DISTINCT archive_file FROM raw_archive_blocks")
+    indexed = {row[0] for row in cursor.fetchall()}
+    removed = 0
+    for day in sorted(os.listdir(base_dir)):
+        day_dir = os.path.join(base_dir, day)
+        if not os.path.isdir(day_dir):
+            continue
+        for name in os.listdir(day_dir):
+            if name.endswith('.zst') and f"{day}/{name}" not in indexed:
+                try:
+                    os.remove(os.path.join(day_dir, name))
+                    removed += 1
+                except OSError as e:
+                    logging.warning(f"Не удалось удалить файл архива {day}/{name}: {e}")
+        if not os.listdir(day_dir):
+            os.rmdir(day_dir)
+    MAINTENANCE_ROWS.inc(removed, table='raw_archive_files', reason='retention')
+    if removed:
+        logging.info(f"Удалено файлов архива строк без фактов: {removed}")
+
+
+@contextmanager
+def _exclusive_ingest_lock(cursor):
+    """Пробует взять блокировку загрузки монопольно, не дожидаясь: True — загрузок нет и новые ждут."""
+    cursor.execute("SELECT pg_try_advisory_lock(%s)", (INGEST_LOCK_KEY,))
+    acquired = cursor.fetchone()[0]
+    try:
+        yield acquired
+    finally:
+        if acquired:
+            cursor.execute("SELECT pg_advisory_unlock(%s)", (INGEST_LOCK_KEY,))
+
+
+def prune_dimension(cursor, table, id_column, batch_rows=MAINTENANCE_BATCH_ROWS):
+    """
+    Удаляет значения измерения, на которые нет фактов. Таблица просматривается по id окнами
+    по batch_rows значений; каждое окно — отдельная транзакция под монопольной блокировкой загрузки,
+    поэтому значения, только что разрешенные загрузкой, не удаляются. Пока идут загрузки, чистка
+    откладывается до следующего прохода. Возвращает (удалено строк, дочищено ли до конца).
+    """
+    query = f"""
+        WITH window_ids AS (
+            SELECT {id_column} FROM {table} WHERE {id_column} > %s ORDER BY {id_column} LIMIT %s
+        ), deleted AS (
+            DELETE FROM {table} d USING window_ids w
+            WHERE d.{id_column} = w.{id_column}
+              AND NOT EXISTS (SELECT 1 FROM local_logs l WHERE l.{id_column} = w.{id_column})
+            RETURNING d.{id_column}
+        )
+        SELECT (SELECT max({id_column}) FROM window_ids), (SELECT count(*) FROM deleted)
+    """
+    position, total = 0, 0
+    while True:
+        with _exclusive_ingest_lock(cursor) as acquired:
+            if not acquired:
+                logging.info(f"Чистка {table} отложена: идут загрузки")
+                return total, False
+            cursor.execute(query, (position, batch_rows))
+            last_id, deleted = cursor.fetchone()
+        total += deleted
+        MAINTENANCE_ROWS.inc(deleted, table=table, reason='orphan')
+        if last_id is None:
+            return total, True
+        position = last_id
+        _pause(cursor)
+
+
+def vacuum_analyze(cursor, tables):
+    """VACUUM (ANALYZE) таблиц; соединение должно быть в режиме autocommit."""
+    for table in tables:
+        started = time.perf_counter()
+        cursor.execute(f"VACUUM (ANALYZE) {table}")
+        logging.info(f"VACUUM ANALYZE {table}: {time.perf_counter() - started:.1f} с")
+
+
+def maintain_database(conn, full=True, retention_days=RETENTION_DAYS):
+    """
+    Обслуживание одной базы (соединение в autocommit, каждая порция — своя транзакция):
+      - full: хранение фактов по сроку (retention_days > 0) и чистка осиротевших измерений
+      - VACUUM ANALYZE таблиц, из которых удалялись строки, и local_logs после загрузок;
+        пока идут загрузки, VACUUM откладывается
+    Возвращает сводку {'retention', 'orphans', 'deferred', 'vacuumed'}.
+    """
+    summary = {'retention': {}, 'orphans': {}, 'deferred': [], 'vacuumed': []}
+    with conn.cursor() as cursor:
+        cursor.execute("SET statement_timeout = %s", (MAINTENANCE_STATEMENT_TIMEOUT_MS,))
+        try:
+            touched = {'local_logs'}
+            if full and retention_days > 0:
+                summary['retention'] = apply_retention(cursor, retention_days)
+                touched.update(table for table, count in summary['retention'].items() if count)
+            if full:
+                for table, id_column in PRUNED_DIMENSIONS:
+                    deleted, finished = prune_dimension(cursor, table, id_column)
+                    summary['orphans'][table] = deleted
+                    if not finished:
+                        summary['deferred'].append(table)
+                    if deleted:
+                        touched.add(table)
+            if ingestion_active(cursor):
+                summary['deferred'].append('vacuum')
+            else:
+                vacuum_analyze(cursor, sorted(touched))
+                summary['vacuumed'] = sorted(touched)
+        finally:
+            cursor.execute("RESET statement_timeout")
+    return summary
+
+
+@contextmanager
+def _primary_connection():
+    conn = psycopg2.connect(**DATABASE_CONFIG)
+    try:
+        conn.autocommit = True
+        yield conn
+    finally:
+        conn.close()
+
+
+def _databases():
+    """(имя, контекст соединения в autocommit) для основной базы или каждого шарда."""
+    if sharding_enabled():
+        return [(shard.name, shard.connection(autocommit=True)) for shard in get_shards()]
+    return [(f"{DATABASE_CONFIG['host']}:{DATABASE_CONFIG['port']}/{DATABASE_CONFIG['database']}", _primary_connection())]
+
+
+class MaintenanceScheduler:
+    """
+    Планировщик обслуживания: полный проход раз в MAINTENANCE_INTERVAL_SECONDS и VACUUM ANALYZE local_logs,
+    когда с прошлого VACUUM загружено MAINTENANCE_VACUUM_AFTER_ROWS строк (по счетчику log2db_batch_rows_total).
+    Одновременно выполняется не больше одного прохода.
+    """
+
+    def __init__(self, interval=MAINTENANCE_INTERVAL_SECONDS, vacuum_after_rows=MAINTENANCE_VACUUM_AFTER_ROWS):
+        self.interval = interval
+        self.vacuum_after_rows = vacuum_after_rows
+        self.last_run = None
+        self._last_full = time.monotonic()
+        self._rows_at_vacuum = BATCH_ROWS.total()
+        self._lock = threading.Lock()
+
+    def due(self):
+        """(нужен ли полный проход, нужен ли VACUUM после загрузок)."""
+        full = time.monotonic() - self._last_full >= self.interval
+        return full, BATCH_ROWS.total() - self._rows_at_vacuum >= self.vacuum_after_rows
+
+    def run(self, full=True):
+        """Обслуживает основную базу или все шарды; возвращает сводку прохода."""
+        if not self._lock.acquire(blocking=False):
+            return {'status': 'busy'}
+        try:
+            started = time.perf_counter()
+            loaded_rows = BATCH_ROWS.total()
+            databases = {}
+            for name, connection in _databases():
+                try:
+                    with connection as conn:
+                        databases[name] = maintain_database(conn, full)
+                except psycopg2.Error as e:
+                    logging.error(f"Ошибка обслуживания базы {name}: {e}")
+                    databases[name] = {'error': str(e)}
+            if full:
+                self._last_full = time.monotonic()
+            if all('vacuum' not in result.get('deferred', ['vacuum']) for result in databases.values()):
+                self._rows_at_vacuum = loaded_rows
+            self.last_run = {
+                'status': 'success' if all('error' not in result for result in databases.values()) else 'error',
+                'full': full,
+                'finished_at': datetime.now(timezone.utc).isoformat(),
+                'seconds': round(time.perf_counter() - started, 3),
+                'databases': databases,
+            }
+            logging.info(f"Обслуживание базы завершено за {self.last_run['seconds']} с")
+            return self.last_run
+        finally:
+            self._lock.release()
+
+    def status(self):
+        full, vacuum = self.due()
+        return {'last_run': self.last_run, 'full_due': full, 'vacuum_due': vacuum,
+                'rows_since_vacuum': BATCH_ROWS.total() - self._rows_at_vacuum}
+
+    async def loop(self, check_seconds=MAINTENANCE_CHECK_SECONDS):
+        """Фоновая задача API: раз в check_seconds проверяет, не пора ли обслуживание, и выполняет его в потоке."""
+        while True:
+            await asyncio.sleep(check_seconds)
+            full, vacuum = self.due()
+            if not (full or vacuum):
+                continue
+            try:
+                await asyncio.to_thread(self.run, full)
+            except Exception as e:
+                logging.error(f"Ошибка планового обслуживания базы: {e}")
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler():
+    """Планировщик обслуживания процесса (один на процесс)."""
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = MaintenanceScheduler()
+        return _scheduler
@@ -0,0 +1,188 @@
+"""Метрики загрузки логов в текстовом формате Prometheus"""
+
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+REGISTRY = []
+
+_lock = threading.Lock()
+
+# Статистика текущей обработки файла. asyncio.to_thread копирует контекст,
+# поэтому потоки обработки пишут в тот же объект, что и process_file_async.
+_run_stats = ContextVar('ingest_run_stats', default=None)
+
+
+class RunStats:
+    """Счетчики одной обработки файла — для итогового словаря process_file_async."""
+
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+
+    def add(self, name, key, amount):
+        with _lock:
+            self.counters[(name, key)] = self.counters.get((name, key), 0) + amount
+
+    def observe(self, name, key, value):
+        with _lock:
+            count, total, peak = self.histograms.get((name, key), (0, 0.0, 0.0))
+            self.histograms[(name, key)] = (count + 1, total + value, max(peak, value))
+
+    def summary(self):
+        """Сводка вида {метрика: значение | {метка: значение}}."""
+        result = {}
+        for (name, key), value in sorted(self.counters.items()):
+            short = name.removeprefix('log2db_').removesuffix('_total')
+            if key:
+                result.setdefault(short, {})['/'.join(key)] = round(value, 6)
+            else:
+                result[short] = round(value, 6)
+        for (name, key), (count, total, peak) in sorted(self.histograms.items()):
+            short = name.removeprefix('log2db_')
+            entry = {'count': count, 'sum': round(total, 6), 'max': round(peak, 6)}
+            if key:
+                result.setdefault(short, {})['/'.join(key)] = entry
+            else:
+                result[short] = entry
+        return result
+
+
+class Counter:
+    """Монотонный счетчик с метками."""
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        REGISTRY.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels[n]) for n in self.labelnames)
+        with _lock:
+            self._values[key] = self._values.get(key, 0) + amount
+        stats = _run_stats.get()
+        if stats is not None:
+            stats.add(self.name, key, amount)
+
+    def total(self):
+        """Сумма по всем меткам."""
+        with _lock:
+            return sum(self._values.values())
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with _lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            lines.append(f"{self.name}{_labels(self.labelnames, key)} {_number(value)}")
+        return lines
+
+
+class Histogram:
+    """Гистограмма с фиксированными границами корзин."""
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._values = {}
+        REGISTRY.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels[n]) for n in self.labelnames)
+        index = bisect.bisect_left(self.buckets, value)
+        with _lock:
+            counts, total = self._values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[index] += 1
+            self._values[key] = (counts, total + value)
+        stats = _run_stats.get()
+        if stats is not None:
+            stats.observe(self.name, key, value)
+
+    @contextmanager
+    def time(self, **labels):
+        """Замеряет длительность блока в секундах."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with _lock:
+            items = sorted((key, (list(counts), total)) for key, (counts, total) in self._values.items())
+        for key, (counts, total) in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else _number(bound)
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames + ('le',), key + (le,))} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, key)} {_number(total)}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, key)} {cumulative}")
+        return lines
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join(f'{n}="{_escape(v)}"' for n, v in zip(names, values)) + '}'
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render_prometheus():
+    """Текст всех метрик в формате Prometheus exposition."""
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+def start_run():
+    """Начинает сбор статистики обработки файла в текущем контексте."""
+    stats = RunStats()
+    return stats, _run_stats.set(stats)
+
+
+def finish_run(token):
+    """Завершает сбор статистики, начатый start_run."""
+    _run_stats.reset(token)
+
+
+# --- Метрики загрузки ---
+LINES_READ = Counter('log2db_lines_read_total', 'Прочитано строк логов')
+LINES_PROCESSED = Counter('log2db_lines_processed_total', 'Строк нормализовано и поставлено во вставку')
+PARSE_FAILURES = Counter('log2db_parse_failures_total', 'Строк, не распознанных парсером')
+LINE_ERRORS = Counter('log2db_line_errors_total', 'Строк с ошибкой нормализации')
+STAGE_SECONDS = Counter('log2db_stage_seconds_total', 'Время по стадиям обработки, с', ['stage'])
+DIMENSION_CACHE = Counter('log2db_dimension_cache_total', 'Обращения к кэшу измерений', ['table', 'result'])
+DB_ROUND_TRIPS = Counter('log2db_db_round_trips_total', 'Запросы к БД при загрузке', ['operation'])
+BATCH_COMMIT_SECONDS = Histogram('log2db_batch_commit_seconds', 'Длительность вставки и коммита пакета, с')
+BATCH_ROWS = Counter('log2db_batch_rows_total', 'Вставлено строк фактов')
+DUPLICATE_LINES = Counter('log2db_duplicate_lines_total', 'Отброшено повторных строк', ['stage'])
+REJECTED_LINES = Counter('log2db_rejected_lines_total', 'Строк отправлено в карантин', ['reason'])
+FILES_PROCESSED = Counter('log2db_files_processed_total', 'Обработано файлов', ['status'])
+
+# --- Обслуживание базы ---
+MAINTENANCE_ROWS = Counter('log2db_maintenance_rows_total', 'Строк удалено обслуживанием', ['table', 'reason'])
+
+# --- Метрики дашборда ---
+DASHBOARD_CALLBACK_SECONDS = Histogram('log2db_dashboard_callback_seconds', 'Длительность колбэка дашборда с сериализацией, с', ['callback'])
+DASHBOARD_SPAN_SECONDS = Histogram('log2db_dashboard_span_seconds', 'Длительность этапов колбэка дашборда, с', ['callback', 'span'])
+
+# --- Маршрутизация чтения ---
+READ_ROUTING = Counter('log2db_read_routing_total', 'Выбор базы для чтения', ['endpoint', 'result'])
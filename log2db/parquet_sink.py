@@ -0,0 +1,145 @@
+"""Запись распарсенных логов в Parquet с Hive-партиционированием"""
+
+import os
+import time
+import uuid
+import logging
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from log2db.config import PARQUET_LAKE_DIR, PARQUET_PARTITION_BY_STATUS, PARQUET_FLUSH_ROWS, PARQUET_FLUSH_SECONDS
+
+# Схема совпадает с колонками export_to_dataframe, кроме log_id и производных от времени
+PARQUET_SCHEMA = pa.schema([
+    ('ip_address', pa.string()),
+    ('user_agent', pa.string()),
+    ('browser', pa.string()),
+    ('os', pa.string()),
+    ('device_type', pa.string()),
+    ('timestamp_utc', pa.timestamp('us', tz='UTC')),
+    ('request_type', pa.string()),
+    ('api_path', pa.string()),
+    ('protocol', pa.string()),
+    ('status_code', pa.int32()),
+    ('bytes_sent', pa.int64()),
+    ('referrer_url', pa.string()),
+    ('response_time', pa.int32()),
+])
+
+
+class ParquetSink:
+    """
+    Буферизует записи по партициям и сбрасывает их в Parquet-файлы:
+      - по достижении flush_rows записей или по истечении flush_seconds
+      - каждый файл сначала пишется во временный, затем атомарно переименовывается
+    Партиции: date=YYYY-MM-DD[/status_class=Nxx].
+    """
+
+    def __init__(self, base_dir=PARQUET_LAKE_DIR, partition_by_status=PARQUET_PARTITION_BY_STATUS,
+                 flush_rows=PARQUET_FLUSH_ROWS, flush_seconds=PARQUET_FLUSH_SECONDS):
+        self.base_dir = base_dir
+        self.partition_by_status = partition_by_status
+        self.flush_rows = flush_rows
+        self.flush_seconds = flush_seconds
+        self._partitions = {}
+        self._tables = {}
+        self._buffered = 0
+        self._last_flush = time.monotonic()
+        self.files_written = 0
+        self.rows_written = 0
+
+    def _partition_key(self, log_data):
+        key = (f"date={log_data.timestamp_utc:%Y-%m-%d}",)
+        if self.partition_by_status:
+            key += (f"status_class={log_data.status_code // 100}xx",)
+        return key
+
+    def append(self, log_data, browser, os_family, device_type):
+        """Добавляет распарсенную запись в буфер партиции."""
+        key = self._partition_key(log_data)
+        columns = self._partitions.get(key)
+        if columns is None:
+            columns = {name: [] for name in PARQUET_SCHEMA.names}
+            self._partitions[key] = columns
+        columns['ip_address'].append(log_data.ip_client)
+        columns['user_agent'].append(log_data.user_agent)
+        columns['browser'].append(browser)
+        columns['os'].append(os_family)
+        columns['device_type'].append(device_type)
+        columns['timestamp_utc'].append(log_data.timestamp_us)
+        columns['request_type'].append(log_data.request_type)
+        columns['api_path'].append(log_data.api_path)
+        columns['protocol'].append(log_data.protocol)
+        columns['status_code'].append(log_data.status_code)
+        columns['bytes_sent'].append(log_data.bytes_sent)
+        columns['referrer_url'].append(log_data.referrer)
+        columns['response_time'].append(log_data.response_time)
+        self._buffered += 1
+        self._maybe_flush()
+
+    def append_table(self, table):
+        """
+        Добавляет блок, разобранный columnar.parse_block (с колонками browser, os, device_type):
+        партиции вычисляются по колонкам, в буфер попадают срезы блока без разбора на записи.
+        """
+        if not table.num_rows:
+            return
+        table = table.rename_columns([{'ip_client': 'ip_address', 'referrer': 'referrer_url'}.get(name, name)
+                                      for name in table.column_names])
+        table = table.select(PARQUET_SCHEMA.names).cast(PARQUET_SCHEMA)
+        keys = pc.strftime(table['timestamp_utc'], format='date=%Y-%m-%d')
+        if self.partition_by_status:
+            status_class = pc.cast(pc.divide(table['status_code'], 100), pa.string())
+            keys = pc.binary_join_element_wise(keys, pc.binary_join_element_wise('status_class=', status_class, 'xx', ''), '/')
+        for key in pc.unique(keys).to_pylist():
+            self._tables.setdefault(tuple(key.split('/')), []).append(table.filter(pc.equal(keys, key)))
+        self._buffered += table.num_rows
+        self._maybe_flush()
+
+    def _maybe_flush(self):
+        if (self._buffered >= self.flush_rows
+                or time.monotonic() - self._last_flush >= self.flush_seconds):
+            self.flush()
+
+    def _write_partition(self, key, columns, tables):
+        partition_dir = os.path.join(self.base_dir, *key)
+        os.makedirs(partition_dir, exist_ok=True)
+        name = f"part-{uuid.uuid4().hex}.parquet"
+        tmp_path = os.path.join(partition_dir, f".{name}.tmp")
+        final_path = os.path.join(partition_dir, name)
+        if columns is not None:
+            tables = [pa.Table.from_pydict(columns, schema=PARQUET_SCHEMA), *tables]
+        table = pa.concat_tables(tables)
+        try:
+            with open(tmp_path, 'wb') as f:
+                pq.write_table(table, f, compression='zstd')
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, final_path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return table.num_rows
+
+    def flush(self):
+        """Записывает все буферизованные партиции в Parquet."""
+        if self._buffered:
+            keys = list(dict.fromkeys([*self._partitions, *self._tables]))
+            logging.info(f"Сброс {self._buffered} записей в Parquet ({len(keys)} партиций)...")
+            try:
+                for key in keys:
+                    written = self._write_partition(key, self._partitions.get(key), self._tables.get(key, []))
+                    self._partitions.pop(key, None)
+                    self._tables.pop(key, None)
+                    self._buffered -= written
+                    self.rows_written += written
+                    self.files_written += 1
+            except Exception as e:
+                logging.error(f"Ошибка записи Parquet в {self.base_dir}: {e}")
+                raise
+        self._last_flush = time.monotonic()
+
+    def close(self):
+        """Сбрасывает остаток буфера."""
+        self.flush()
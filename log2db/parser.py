@@ -1,65 +1,147 @@
 """Парсинг логов при подготовке к сохранению с БД"""
 
 import re
-from datetime import datetime, timezone
-import logging
+import sys
+from datetime import datetime, timezone, timedelta
+from functools import lru_cache
+from urllib.parse import urlsplit
+
+# Паттерны компилируются один раз при импорте модуля
+NGINX_PATTERN = re.compile(
+    r'(\S+) '                     # ip_client
+    r'\S+ '                       # remote logname
+    r'\S+ '                       # remote user
+    r'\[(\d{2}/\w{3}/\d{4}:\d{2}:\d{2}:\d{2} \+\d{4})\] '  # timestamp
+    r'"(\S+) (\S+) (\S+)" '       # request_type, api_path, protocol
+    r'(\d{3}) '                   # status_code
+    r'(\d+|-) '                   # bytes_sent
+    r'"([^"]*|-)" '               # referrer
+    r'"([^"]*)" '                 # user_agent
+    r'(\d+|-)'                    # response_time
+)
+ALT_PATTERN = re.compile(
+    r'(\S+) - - '                # ip_client
+    r'\[(\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2} \+\d{4})\] '  # timestamp
+    r'"(\S+) (\S+) (\S+)" '       # request_type, api_path, protocol
+    r'(\d{3}) '                  # status_code
+    r'(\d+|-) '                  # bytes_sent
+    r'"([^"]*|-)" '              # referrer
+    r'"([^"]*)" '                # user_agent
+    r'(\d+|-)'                   # response_time
+)
+NGINX_TIME_FORMAT = '%d/%b/%Y:%H:%M:%S %z'
+ALT_TIME_FORMAT = '%Y-%m-%d %H:%M:%S %z'
+
+# Причины отказа в разборе строки (для карантина)
+REJECT_NO_MATCH = 'no_match'
+REJECT_BAD_VALUE = 'bad_value'
+
+# Целые поля: больше 18 цифр не помещается в int64; response_time — integer в local_logs
+MAX_DIGITS = 18
+RESPONSE_TIME_MAX = 2**31 - 1
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+MICROSECOND = timedelta(microseconds=1)
+
+
+class LogRecord:
+    """
+    Разобранная строка лога. Поля в __slots__, без словаря на запись; время хранится
+    целым числом микросекунд от эпохи (timestamp_us), datetime создается только по запросу.
+    """
+    __slots__ = ('ip_client', 'timestamp_us', 'request_type', 'api_path', 'protocol', 'status_code',
+                 'bytes_sent', 'referrer', 'user_agent', 'response_time')
+
+    def __init__(self, ip_client, timestamp_us, request_type, api_path, protocol, status_code, bytes_sent,
+                 referrer, user_agent, response_time):
+        self.ip_client = ip_client
+        self.timestamp_us = timestamp_us
+        self.request_type = request_type
+        self.api_path = api_path
+        self.protocol = protocol
+        self.status_code = status_code
+        self.bytes_sent = bytes_sent
+        self.referrer = referrer
+        self.user_agent = user_agent
+        self.response_time = response_time
+
+    @property
+    def timestamp_utc(self):
+        return EPOCH + timedelta(microseconds=self.timestamp_us)
+
+    def as_dict(self):
+        return {'ip_client': self.ip_client, 'timestamp_utc': self.timestamp_utc, 'request_type': self.request_type,
+                'api_path': self.api_path, 'protocol': self.protocol, 'status_code': self.status_code,
+                'bytes_sent': self.bytes_sent, 'referrer': self.referrer, 'user_agent': self.user_agent,
+                'response_time': self.response_time}
+
+    def __repr__(self):
+        return f"LogRecord({', '.join(f'{name}={getattr(self, name)!r}' for name in self.__slots__)})"
+
+
+@lru_cache(maxsize=4096)
+def _timestamp_us(timestamp_str, time_format):
+    """Время строки в микросекундах от эпохи; в логах время повторяется, поэтому strptime кэшируется."""
+    return (datetime.strptime(timestamp_str, time_format) - EPOCH) // MICROSECOND
+
+
+def _to_int(text, limit=None):
+    """'-' -> 0, остальное — число; длиннее MAX_DIGITS цифр или больше limit — ValueError (как columnar._to_int)."""
+    if text == '-':
+        return 0
+    if len(text) > MAX_DIGITS or (limit is not None and int(text) > limit):
+        raise ValueError("number out of range")
+    return int(text)
+
+
+def try_parse_log_line(line):
+    """
+    Разбирает строку лога и возвращает (LogRecord, None) или (None, (причина, подробности)).
+    Ничего не пишет в журнал: отказы собирает и агрегирует вызывающая сторона.
+    Метод, протокол и User-Agent повторяются из строки в строку и интернируются,
+    чтобы записи пакета ссылались на одну строку.
+    """
+    match = ALT_PATTERN.match(line)
+    time_format = ALT_TIME_FORMAT
+    if not match:
+        match = NGINX_PATTERN.match(line)
+        time_format = NGINX_TIME_FORMAT
+    if not match:
+        return None, (REJECT_NO_MATCH, None)
+    try:
+        (ip_client, timestamp_str, request_type, api_path, protocol,
+         status_code, bytes_sent_str, referrer, user_agent, response_time_str) = match.groups()
+        timestamp_us = _timestamp_us(timestamp_str, time_format)
+        bytes_sent = _to_int(bytes_sent_str)
+        response_time = _to_int(response_time_str, RESPONSE_TIME_MAX)
+        referrer = None if referrer in ('-', '') else referrer
+        return LogRecord(ip_client, timestamp_us, sys.intern(request_type), api_path, sys.intern(protocol),
+                         int(status_code), bytes_sent, referrer, sys.intern(user_agent), response_time), None
+    except ValueError as e:
+        return None, (REJECT_BAD_VALUE, str(e))
 
 
 def parse_log_line(line):
     """
     Разбирает строку лога веб-сервера в структурированный формат.
     Поддерживаются два паттерна: для формата NGINX и альтернативного.
+    Возвращает None, если строку разобрать не удалось (см. try_parse_log_line).
     """
-    nginx_pattern = re.compile(
-        r'(\S+) '                     # ip_client
-        r'\S+ '                       # remote logname
-        r'\S+ '                       # remote user 
-        r'\[(\d{2}/\w{3}/\d{4}:\d{2}:\d{2}:\d{2} \+\d{4})\] '  # timestamp 
-        r'"(\S+) (\S+) (\S+)" '       # request_type, api_path, protocol 
-        r'(\d{3}) '                   # status_code
-        r'(\d+|-) '                   # bytes_sent 
-        r'"([^"]*|-)" '               # referrer 
-        r'"([^"]*)" '                 # user_agent
-        r'(\d+|-)'                    # response_time
-    )
-    alt_pattern = re.compile(
-        r'(\S+) - - '                # ip_client 
-        r'\[(\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2} \+\d{4})\] '  # timestamp
-        r'"(\S+) (\S+) (\S+)" '       # request_type, api_path, protocol
-        r'(\d{3}) '                  # status_code
-        r'(\d+|-) '                  # bytes_sent
-        r'"([^"]*|-)" '              # referrer 
-        r'"([^"]*)" '                # user_agent
-        r'(\d+|-)'                   # response_time
-    )
-    match = alt_pattern.match(line)
-    time_format = '%Y-%m-%d %H:%M:%S %z'
-    if not match:
-        match = nginx_pattern.match(line)
-        time_format = '%d/%b/%Y:%H:%M:%S %z'
-    if match:
-        try:
-            (ip_client, timestamp_str, request_type, api_path, protocol,
-             status_code, bytes_sent_str, referrer, user_agent, response_time_str) = match.groups()
-            timestamp_utc = datetime.strptime(timestamp_str, time_format).astimezone(timezone.utc)
-            bytes_sent = int(bytes_sent_str) if bytes_sent_str != '-' else 0
-            response_time = int(response_time_str) if response_time_str != '-' else 0
-            referrer = None if referrer in ('-', '') else referrer
-            return {
-                'ip_client': ip_client,
-                'timestamp_utc': timestamp_utc,
-                'request_type': request_type,
-                'api_path': api_path,
-                'protocol': protocol,
-                'status_code': int(status_code),
-                'bytes_sent': bytes_sent,
-                'referrer': referrer,
-                'user_agent': user_agent,
-                'response_time': response_time
-            }
-        except ValueError as e:
-            logging.warning(f"Ошибка при парсинге строки '{line.strip()}': {e}")
-            return None
-    else:
-        logging.warning(f"Не удалось распарсить строку: '{line.strip()[:100]}...'")
-        return None
+    return try_parse_log_line(line)[0]
+
+
+@lru_cache(maxsize=10000)
+def split_referrer(referrer):
+    """
+    (хост, путь) URL реферера для колонок referrer_host и referrer_path измерения dim_referrer:
+    хост — в нижнем регистре без порта, путь — без запроса и фрагмента ('/' для пустого пути).
+    Для строк без схемы и хоста — (None, None).
+    """
+    try:
+        parts = urlsplit(referrer)
+        host = parts.hostname
+    except ValueError:
+        return None, None
+    if not parts.scheme or not host:
+        return None, None
+    return host, parts.path or '/'
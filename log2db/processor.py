@@ -1,107 +1,516 @@
 """Обработка логов и сохранение в БД"""
 
 import os
+import time
 import asyncio
 import logging
-from log2db.parser import parse_log_line
-from log2db.db import get_or_insert_dimension, insert_batch, run_db_operation
+from contextlib import nullcontext
+from functools import lru_cache
+from log2db.parser import try_parse_log_line, split_referrer
+from log2db.db import (get_or_insert_dimension, insert_batch, copy_facts, resolve_fact_columns, drop_duplicate_lines,
+                       archive_raw_lines, acquire_ingest_lock, release_ingest_lock, run_db_operation)
+from log2db import async_db
+from log2db.columnar import parse_block, with_user_agents, buffered_rows
+from log2db.dedup import get_deduplicator, line_hash, with_line_hashes
+from log2db.parquet_sink import ParquetSink
+from log2db.raw_archive import RawArchive, with_raw_lines
+from log2db.quarantine import Quarantine, REJECT_ERROR, load_pending, mark_replayed
+from log2db.sketches import SketchAccumulator, write_sketches
+from log2db import metrics
+from log2db.profiling import profiled
 from user_agents import parse as ua_parse
-from log2db.config import BATCH_SIZE
-from log2db.cache import ip_cache, ua_cache, time_cache, req_type_cache, api_cache, protocol_cache, referrer_cache
+from log2db.config import (BATCH_SIZE, TIME_STORAGE_MODE, INGEST_SINKS, SKETCHES_ENABLED, DEDUP_ENABLED,
+                           RAW_ARCHIVE_ENABLED, API_TEMPLATES_ENABLED, API_LITERAL_PATHS)
+from log2db.api_templates import api_template
+from log2db.geoip import ip_geo
+from log2db.cache import default_caches
+from log2db.shards import ShardSession, get_shards, sharding_enabled
 
 
-def process_log_lines(conn, lines, batch_buffer):
+@lru_cache(maxsize=10000)
+def describe_user_agent(user_agent):
+    """Возвращает (browser, os, device_type) для строки User-Agent."""
+    ua = ua_parse(user_agent)
+    device_type = 'Mobile' if ua.is_mobile else ('Tablet' if ua.is_tablet else ('PC' if ua.is_pc else 'Other'))
+    return ua.browser.family, ua.os.family, device_type
+
+
+def clear_dimension_caches():
+    """Очищает кэши измерений основной базы (id действительны только в рамках одной обработки)."""
+    default_caches.clear()
+
+
+def resolve_fact(cursor, caches, log_data, browser, os_family, device_type):
+    """Разрешает измерения записи в id (через кэши базы) и возвращает строку фактов для local_logs."""
+    country_code, asn, as_org = ip_geo(log_data.ip_client)
+    ip_client_id = get_or_insert_dimension(cursor, caches.ip, 'dim_ip_client', {
+        'ip_address': log_data.ip_client,
+        'country_code': country_code,
+        'asn': asn,
+        'as_org': as_org,
+    })
+    user_agent_id = get_or_insert_dimension(cursor, caches.ua, 'dim_user_agent', {
+        'user_agent': log_data.user_agent,
+        'browser': browser,
+        'os': os_family,
+        'device_type': device_type
+    })
+    ts = log_data.timestamp_utc
+    time_id = None
+    if TIME_STORAGE_MODE != 'inline':
+        time_id = get_or_insert_dimension(cursor, caches.time, 'dim_time', {
+            'timestamp_utc': ts,
+            'year': ts.year, 'month': ts.month, 'day': ts.day,
+            'hour': ts.hour, 'minute': ts.minute, 'second': ts.second,
+            'weekday': ts.weekday()
+        })
+    request_type_id = get_or_insert_dimension(cursor, caches.req_type, 'dim_request_type', {'request_type': log_data.request_type})
+    api_path, api_template_id = log_data.api_path, None
+    if API_TEMPLATES_ENABLED:
+        template = api_template(api_path)
+        api_template_id = get_or_insert_dimension(cursor, caches.api_template, 'dim_api_template',
+                                                  {'api_template': template})
+        if not API_LITERAL_PATHS:
+            api_path = template
+    api_id = get_or_insert_dimension(cursor, caches.api, 'dim_api', {'api_path': api_path})
+    protocol_id = get_or_insert_dimension(cursor, caches.protocol, 'dim_protocol', {'protocol': log_data.protocol})
+    referrer_id = None
+    if log_data.referrer is not None:
+        referrer_host, referrer_path = split_referrer(log_data.referrer)
+        referrer_id = get_or_insert_dimension(cursor, caches.referrer, 'dim_referrer', {
+            'referrer_url': log_data.referrer,
+            'referrer_host': referrer_host,
+            'referrer_path': referrer_path,
+        })
+    return (
+        ip_client_id,
+        user_agent_id,
+        time_id,
+        ts,
+        request_type_id,
+        api_id,
+        api_template_id,
+        protocol_id,
+        log_data.status_code,
+        log_data.bytes_sent,
+        referrer_id,
+        log_data.response_time
+    )
+
+
+@profiled('process_log_lines')
+def process_log_lines(conn, lines, batch_buffer, parquet_sink=None, quarantine=None, line_numbers=None, shards=None,
+                      sketches=None):
     """
     Обрабатывает пакет строк лога:
       - Парсит строку
-      - Нормализует данные через измерения (dimensions)
+      - Передает запись в Parquet-приемник, если он задан
+      - Нормализует данные через измерения (dimensions), если задано соединение с БД
+        или сессия шардов (тогда запись уходит в курсор и буфер своего шарда)
       - Добавляет данные в буфер для пакетной вставки
+      - Учитывает запись в скетчах по часам (sketch_hourly), если задан накопитель скетчей
+        (с хэшем строки — после вставки в шард, см. insert_ready_batches)
+    Нераспознанные и необработанные строки передаются в карантин, если он задан.
+    line_numbers — номера строк в исходном файле (по умолчанию с 1).
     """
     processed_lines = 0
-    with conn.cursor() as cursor:
-        for line in lines:
-            log_data = parse_log_line(line.strip())
-            if log_data:
-                try:
-                    ip_client_id = get_or_insert_dimension(cursor, ip_cache, 'dim_ip_client', {'ip_address': log_data['ip_client']})
-                    ua = ua_parse(log_data['user_agent'])
-                    user_agent_id = get_or_insert_dimension(cursor, ua_cache, 'dim_user_agent', {
-                        'user_agent': log_data['user_agent'],
-                        'browser': ua.browser.family,
-                        'os': ua.os.family,
-                        'device_type': 'Mobile' if ua.is_mobile else ('Tablet' if ua.is_tablet else ('PC' if ua.is_pc else 'Other'))
-                    })
-                    ts = log_data['timestamp_utc']
-                    time_id = get_or_insert_dimension(cursor, time_cache, 'dim_time', {
-                        'timestamp_utc': ts,
-                        'year': ts.year, 'month': ts.month, 'day': ts.day,
-                        'hour': ts.hour, 'minute': ts.minute, 'second': ts.second,
-                        'weekday': ts.weekday()
-                    })
-                    request_type_id = get_or_insert_dimension(cursor, req_type_cache, 'dim_request_type', {'request_type': log_data['request_type']})
-                    api_id = get_or_insert_dimension(cursor, api_cache, 'dim_api', {'api_path': log_data['api_path']})
-                    protocol_id = get_or_insert_dimension(cursor, protocol_cache, 'dim_protocol', {'protocol': log_data['protocol']})
-                    referrer_id = None
-                    if log_data['referrer'] is not None:
-                        referrer_id = get_or_insert_dimension(cursor, referrer_cache, 'dim_referrer', {'referrer_url': log_data['referrer']})
-                    batch_buffer.append((
-                        ip_client_id,
-                        user_agent_id,
-                        time_id,
-                        request_type_id,
-                        api_id,
-                        protocol_id,
-                        log_data['status_code'],
-                        log_data['bytes_sent'],
-                        referrer_id,
-                        log_data['response_time']
-                    ))
+    parse_failures = 0
+    line_errors = 0
+    parse_seconds = ua_seconds = sink_seconds = dimension_seconds = sketch_seconds = 0.0
+    metrics.LINES_READ.inc(len(lines))
+    with (conn.cursor() if conn is not None else nullcontext()) as cursor:
+        for index, line in enumerate(lines):
+            started = time.perf_counter()
+            log_data, rejected = try_parse_log_line(line.strip())
+            parsed_at = time.perf_counter()
+            parse_seconds += parsed_at - started
+            if not log_data:
+                parse_failures += 1
+                if quarantine is not None:
+                    quarantine.add(line_numbers[index] if line_numbers is not None else index + 1, line, *rejected)
+                continue
+            try:
+                browser, os_family, device_type = describe_user_agent(log_data.user_agent)
+                ua_at = time.perf_counter()
+                ua_seconds += ua_at - parsed_at
+                if parquet_sink is not None:
+                    parquet_sink.append(log_data, browser, os_family, device_type)
+                    sink_seconds += time.perf_counter() - ua_at
+                hashed = None
+                if shards is not None:
+                    dimensions_started = time.perf_counter()
+                    shard_cursor, caches, shard_buffer = shards.target(log_data)
+                    fact = resolve_fact(shard_cursor, caches, log_data, browser, os_family, device_type)
+                    hashed = line_hash(line) if DEDUP_ENABLED else None
+                    shard_buffer.append((*fact, hashed) if hashed is not None else fact)
+                elif cursor is not None:
+                    dimensions_started = time.perf_counter()
+                    batch_buffer.append(resolve_fact(cursor, default_caches, log_data, browser, os_family, device_type))
+                else:
                     processed_lines += 1
-                except Exception as e:
+                    continue
+                dimensions_done = time.perf_counter()
+                dimension_seconds += dimensions_done - dimensions_started
+                if sketches is not None:
+                    if hashed is not None:
+                        sketches.defer(hashed, log_data)
+                    else:
+                        sketches.add(log_data)
+                    sketch_seconds += time.perf_counter() - dimensions_done
+                processed_lines += 1
+            except Exception as e:
+                line_errors += 1
+                if quarantine is not None:
+                    quarantine.add(line_numbers[index] if line_numbers is not None else index + 1, line, REJECT_ERROR, str(e))
+                else:
                     logging.error(f"Ошибка при обработке строки '{line.strip()}': {e}")
+    metrics.LINES_PROCESSED.inc(processed_lines)
+    metrics.PARSE_FAILURES.inc(parse_failures)
+    metrics.LINE_ERRORS.inc(line_errors)
+    metrics.STAGE_SECONDS.inc(parse_seconds, stage='parse')
+    metrics.STAGE_SECONDS.inc(ua_seconds, stage='user_agent')
+    metrics.STAGE_SECONDS.inc(sink_seconds, stage='parquet')
+    metrics.STAGE_SECONDS.inc(dimension_seconds, stage='dimensions')
+    metrics.STAGE_SECONDS.inc(sketch_seconds, stage='sketches')
     return processed_lines
 
 
-async def process_file_async(conn, filepath, is_uploaded_file=False):
+@profiled('parse_log_block')
+def parse_log_block(lines, quarantine=None, line_numbers=None, hashed=False, raw=False):
+    """
+    Колоночный разбор блока строк (log2db.columnar) без словаря на каждую строку:
+      - User-Agent разбирается один раз на уникальное значение блока
+      - нераспознанные строки передаются в карантин
+      - hashed — добавить колонку line_hash для дедупликации (log2db.dedup)
+      - raw — добавить колонку raw_line для архива исходных строк (log2db.raw_archive)
+    Возвращает pyarrow.Table разобранных записей для sink_log_block и resolve_fact_columns.
+    """
+    started = time.perf_counter()
+    metrics.LINES_READ.inc(len(lines))
+    table, line_index, rejected = parse_block(lines)
+    if hashed:
+        table = with_line_hashes(table, lines, line_index)
+    if raw:
+        table = with_raw_lines(table, lines, line_index)
+    parsed_at = time.perf_counter()
+    table = with_user_agents(table, describe_user_agent)
+    if quarantine is not None:
+        for index, reason, detail in rejected:
+            quarantine.add(line_numbers[index] if line_numbers is not None else index + 1, lines[index], reason, detail)
+    metrics.PARSE_FAILURES.inc(len(rejected))
+    metrics.STAGE_SECONDS.inc(parsed_at - started, stage='parse')
+    metrics.STAGE_SECONDS.inc(time.perf_counter() - parsed_at, stage='user_agent')
+    return table
+
+
+def sink_log_block(table, parquet_sink=None, sketches=None):
+    """
+    Передает разобранный блок целиком в Parquet-приемник и скетчи. Блок с колонкой line_hash
+    учитывается в скетчах после вставки фактов (insert_ready_batches), только строками, которые вставлены.
+    """
+    started = time.perf_counter()
+    if parquet_sink is not None:
+        parquet_sink.append_table(table)
+    sink_at = time.perf_counter()
+    if sketches is not None:
+        if 'line_hash' in table.column_names:
+            sketches.defer_columns(table)
+        else:
+            sketches.add_columns(table)
+    metrics.STAGE_SECONDS.inc(sink_at - started, stage='parquet')
+    metrics.STAGE_SECONDS.inc(time.perf_counter() - sink_at, stage='sketches')
+
+
+def process_log_block(conn, lines, fact_tables, parquet_sink=None, quarantine=None, line_numbers=None, sketches=None,
+                      dedup=None, archive=None):
+    """
+    Колоночный вариант process_log_lines для основной базы: блок разбирается parse_log_block,
+    повторные строки отбрасываются фильтром dedup (если задан), измерения разрешаются
+    по уникальным значениям, а таблица фактов добавляется в fact_tables для COPY.
+    С archive (raw_archive.RawArchive) исходные строки блока пишутся в архив, а факты получают log_id.
+    Ошибка измерений прерывает обработку блока целиком (в process_log_lines — только строки).
+    """
+    archive = archive if conn is not None else None
+    table = parse_log_block(lines, quarantine, line_numbers, hashed=dedup is not None, raw=archive is not None)
+    with (conn.cursor() if conn is not None else nullcontext()) as cursor:
+        if dedup is not None and cursor is not None:
+            started = time.perf_counter()
+            table = drop_duplicate_lines(cursor, dedup, table, fact_tables)
+            metrics.STAGE_SECONDS.inc(time.perf_counter() - started, stage='dedup')
+        sink_log_block(table, parquet_sink, sketches)
+        if cursor is not None and table.num_rows:
+            started = time.perf_counter()
+            facts = resolve_fact_columns(cursor, default_caches, table)
+            metrics.STAGE_SECONDS.inc(time.perf_counter() - started, stage='dimensions')
+            if archive is not None:
+                started = time.perf_counter()
+                facts = archive_raw_lines(cursor, archive, table, facts)
+                metrics.STAGE_SECONDS.inc(time.perf_counter() - started, stage='raw_archive')
+            fact_tables.append(facts)
+    metrics.LINES_PROCESSED.inc(table.num_rows)
+    return table.num_rows
+
+
+async def process_batch(db_conn, lines, batch_buffer, parquet_sink=None, quarantine=None, line_numbers=None,
+                        session=None, sketches=None, archive=None):
+    """
+    Обрабатывает пакет строк и возвращает число обработанных:
+      - при шардировании — построчно (process_log_lines), записи маршрутизируются по шардам
+      - иначе — колоночно (process_log_block), в batch_buffer копятся таблицы фактов
+    С асинхронным соединением (psycopg 3) в отдельных потоках выполняются только разбор блока и приемники,
+    а повторы и измерения проверяются запросами на цикле событий, не занимая поток на время обмена с БД.
+    Дедупликация (DEDUP_ENABLED) применяется при загрузке в основную базу; в шардах повторы
+    отбрасывает только уникальный индекс. Архив исходных строк (archive) ведется только для основной базы:
+    log_id в шардах независимы.
+    """
+    if session is not None:
+        return await run_db_operation(process_log_lines, None, lines, batch_buffer, parquet_sink, quarantine,
+                                      line_numbers, session, sketches)
+    dedup = get_deduplicator() if db_conn is not None else None
+    if not async_db.is_async_connection(db_conn):
+        return await run_db_operation(process_log_block, db_conn, lines, batch_buffer, parquet_sink, quarantine,
+                                      line_numbers, sketches, dedup, archive)
+    table = await run_db_operation(parse_log_block, lines, quarantine, line_numbers, dedup is not None,
+                                   archive is not None)
+    if dedup is not None:
+        started = time.perf_counter()
+        table = await async_db.drop_duplicate_lines(db_conn, dedup, table, batch_buffer)
+        metrics.STAGE_SECONDS.inc(time.perf_counter() - started, stage='dedup')
+    await run_db_operation(sink_log_block, table, parquet_sink, sketches)
+    if table.num_rows:
+        facts = await async_db.resolve_fact_columns(db_conn, default_caches, table)
+        if archive is not None:
+            started = time.perf_counter()
+            facts = await async_db.archive_raw_lines(db_conn, archive, table, facts)
+            metrics.STAGE_SECONDS.inc(time.perf_counter() - started, stage='raw_archive')
+        batch_buffer.append(facts)
+    metrics.LINES_PROCESSED.inc(table.num_rows)
+    return table.num_rows
+
+
+async def insert_ready_batches(db_conn, batch_buffer, session=None, min_rows=BATCH_SIZE, sketches=None):
+    """
+    Вставляет накопленные пакеты фактов: таблицы фактов — в основную базу через COPY,
+    при шардировании — параллельно во все шарды, набравшие min_rows записей.
+    Отложенные записи скетчей (с хэшем строки) учитываются по хэшам, которые вернула вставка.
+    Возвращает число записей, отброшенных уникальным индексом line_hash.
+    """
+    returning = sketches is not None and DEDUP_ENABLED
+    if session is not None:
+        batches = session.ready_batches(min_rows)
+        attempted = [[row[-1] for row in buffer] if returning else None for _, buffer in batches]
+        counts = [len(buffer) for _, buffer in batches]
+        results = await asyncio.gather(*(run_db_operation(insert_batch, shard_conn, buffer, returning)
+                                         for shard_conn, buffer in batches))
+        for hashes, (inserted, inserted_hashes) in zip(attempted, results):
+            if inserted_hashes is not None:
+                sketches.add_inserted(hashes, inserted_hashes)
+        return sum(counts) - sum(inserted for inserted, _ in results)
+    if not batch_buffer or buffered_rows(batch_buffer) < min_rows:
+        return 0
+    count = buffered_rows(batch_buffer)
+    if async_db.is_async_connection(db_conn):
+        inserted, hashes = await async_db.copy_facts(db_conn, batch_buffer, returning)
+    else:
+        inserted, hashes = await run_db_operation(copy_facts, db_conn, batch_buffer, returning)
+    if hashes is not None:
+        sketches.add_inserted_columns(hashes)
+    return count - inserted
+
+
+async def flush_sketches(conn, sketches):
+    """Сливает накопленные скетчи с базой через асинхронное соединение или в отдельном потоке."""
+    if async_db.is_async_connection(conn):
+        await async_db.write_sketches(conn, sketches)
+    else:
+        await run_db_operation(write_sketches, conn, sketches)
+
+
+async def rollback(conn):
+    if async_db.is_async_connection(conn):
+        await conn.rollback()
+    else:
+        await run_db_operation(conn.rollback)
+
+
+async def lock_ingest(conn):
+    """Берет разделяемую блокировку загрузки, чтобы чистка измерений (log2db.maintenance) ждала конца загрузки."""
+    if async_db.is_async_connection(conn):
+        await async_db.acquire_ingest_lock(conn)
+    else:
+        await run_db_operation(acquire_ingest_lock, conn)
+
+
+async def unlock_ingest(conn):
+    try:
+        if async_db.is_async_connection(conn):
+            await async_db.release_ingest_lock(conn)
+        else:
+            await run_db_operation(release_ingest_lock, conn)
+    except Exception as e:
+        logging.warning(f"Не удалось снять блокировку загрузки: {e}")
+
+
+@profiled('process_file_async')
+async def process_file_async(conn, filepath, is_uploaded_file=False, sinks=None):
     """
     Асинхронно обрабатывает лог-файл:
       - Читает файл
+      - conn — соединение psycopg2 или асинхронное psycopg 3 (тогда запросы к основной базе
+        выполняются на цикле событий, а факты вставляются через COPY)
       - Пакетно обрабатывает строки
-      - Вставляет данные в БД
+      - Вставляет данные в БД (или в шарды DATABASE_SHARDS, тогда conn не используется)
+        и/или пишет их в Parquet (см. INGEST_SINKS)
+      - Отправляет нераспознанные строки в карантин
+      - Пишет исходные строки в архив (RAW_ARCHIVE_ENABLED) до удаления загруженного файла
+      - Сливает скетчи по часам с sketch_hourly (SKETCHES_ENABLED)
       - Очищает кэш и удаляет файл, если требуется
     """
     filename = os.path.basename(filepath)
     logging.info(f"Начало асинхронной обработки файла: {filename}")
+    sinks = INGEST_SINKS if sinks is None else sinks
+    session = ShardSession(filename) if 'postgres' in sinks and sharding_enabled() else None
+    db_conn = conn if 'postgres' in sinks and session is None else None
+    parquet_sink = ParquetSink() if 'parquet' in sinks else None
+    sketches = SketchAccumulator() if SKETCHES_ENABLED and (db_conn is not None or session is not None) else None
+    archive = RawArchive(filename) if RAW_ARCHIVE_ENABLED and db_conn is not None else None
     total_processed = 0
     batch_buffer = []
+    locked = False
+    stats, stats_token = metrics.start_run()
     try:
+        if db_conn is not None:
+            await lock_ingest(db_conn)
+            locked = True
+        # Карантин и скетчи файла пишутся в основную базу или в шард исходного файла
+        service_conn = await run_db_operation(lambda: session.file_connection) if session is not None else db_conn
+        quarantine = Quarantine(service_conn, filename)
         with open(filepath, 'r', encoding='utf-8', errors='ignore') as f:
             lines = f.readlines()
             for i in range(0, len(lines), BATCH_SIZE):
                 batch_lines = lines[i:i + BATCH_SIZE]
-                processed_count = await run_db_operation(process_log_lines, conn, batch_lines, batch_buffer)
+                processed_count = await process_batch(db_conn, batch_lines, batch_buffer, parquet_sink, quarantine,
+                                                      range(i + 1, i + 1 + len(batch_lines)), session, sketches,
+                                                      archive)
                 total_processed += processed_count
-                if len(batch_buffer) >= BATCH_SIZE:
-                    await run_db_operation(insert_batch, conn, batch_buffer)
-            if batch_buffer:
-                await run_db_operation(insert_batch, conn, batch_buffer)
+                total_processed -= await insert_ready_batches(db_conn, batch_buffer, session, sketches=sketches)
+                if quarantine.should_flush:
+                    await quarantine.flush_async()
+                if sketches is not None and sketches.should_flush:
+                    await flush_sketches(service_conn, sketches)
+            total_processed -= await insert_ready_batches(db_conn, batch_buffer, session, min_rows=1,
+                                                          sketches=sketches)
+            if sketches is not None:
+                await flush_sketches(service_conn, sketches)
+            if parquet_sink is not None:
+                await run_db_operation(parquet_sink.close)
+            await quarantine.close_async()
         logging.info(f"Файл '{filename}' успешно обработан. Обработано {total_processed} строк.")
-        return {'status': 'success', 'filename': filename, 'processed': total_processed}
+        metrics.FILES_PROCESSED.inc(status='success')
+        return {'status': 'success', 'filename': filename, 'processed': total_processed,
+                'rejected': dict(quarantine.counts), 'metrics': stats.summary()}
     except FileNotFoundError:
         logging.error(f"Файл '{filename}' не найден по пути: {filepath}")
+        metrics.FILES_PROCESSED.inc(status='error')
         return {'status': 'error', 'filename': filename, 'message': 'File not found'}
     except Exception as e:
         logging.error(f"Ошибка при обработке файла '{filename}': {e}")
-        await run_db_operation(conn.rollback)
-        return {'status': 'error', 'filename': filename, 'message': f'Processing error: {e}'}
+        metrics.FILES_PROCESSED.inc(status='error')
+        if db_conn is not None:
+            await rollback(db_conn)
+        if session is not None:
+            await run_db_operation(session.rollback)
+        return {'status': 'error', 'filename': filename, 'message': f'Processing error: {e}',
+                'metrics': stats.summary()}
     finally:
-        # Очистка кэшей
-        ip_cache.clear(); ua_cache.clear(); time_cache.clear()
-        req_type_cache.clear(); api_cache.clear(); protocol_cache.clear(); referrer_cache.clear()
+        metrics.finish_run(stats_token)
+        if session is not None:
+            await run_db_operation(session.close)
+        if archive is not None:
+            archive.close()
+        clear_dimension_caches()
         logging.debug(f"Кэши очищены после обработки {filename}")
+        if locked:
+            await unlock_ingest(db_conn)
         if is_uploaded_file and os.path.exists(filepath):
             try:
                 os.remove(filepath)
                 logging.info(f"Удален загруженный файл: {filepath}")
             except OSError as e:
                 logging.warning(f"Не удалось удалить загруженный файл {filepath}: {e}")
+
+
+async def replay_quarantine(conn, source_file=None, sinks=None):
+    """
+    Повторно обрабатывает строки из карантина (например, после поддержки нового формата):
+    строки, которые теперь разбираются, загружаются и отмечаются как обработанные,
+    остальные остаются в карантине. При шардировании карантин каждого шарда
+    обрабатывается отдельно, а записи маршрутизируются по шардам как при загрузке.
+    """
+    sinks = INGEST_SINKS if sinks is None else sinks
+    if 'postgres' not in sinks or not sharding_enabled():
+        return await _replay_quarantine(conn if 'postgres' in sinks else None, source_file, sinks, sharded=False)
+    total = {'status': 'success', 'pending': 0, 'replayed': 0, 'remaining': 0}
+    for shard in get_shards():
+        async with shard.connection_async() as shard_conn:
+            result = await _replay_quarantine(shard_conn, source_file, sinks, sharded=True)
+        if result['status'] != 'success':
+            return result
+        for key in ('pending', 'replayed', 'remaining'):
+            total[key] += result[key]
+    return total
+
+
+async def _replay_quarantine(quarantine_conn, source_file, sinks, sharded):
+    pending = await run_db_operation(load_pending, quarantine_conn, source_file)
+    ready = [item for item in pending if try_parse_log_line(item.raw_line.strip())[0] is not None]
+    logging.info(f"Карантин: ожидают {len(pending)} строк, разбираются теперь {len(ready)}")
+    db_conn = None if sharded else quarantine_conn
+    parquet_sink = ParquetSink() if 'parquet' in sinks else None
+    sketches = SketchAccumulator() if SKETCHES_ENABLED and quarantine_conn is not None else None
+    total_processed = 0
+    batch_buffer = []
+    by_file = {}
+    for item in ready:
+        by_file.setdefault(item.source_file, []).append(item)
+    session = None
+    locked = False
+    try:
+        if db_conn is not None:
+            await lock_ingest(db_conn)
+            locked = True
+        for name, items in by_file.items():
+            session = ShardSession(name) if sharded else None
+            quarantine = Quarantine(quarantine_conn, name)
+            for i in range(0, len(items), BATCH_SIZE):
+                batch = items[i:i + BATCH_SIZE]
+                total_processed += await process_batch(db_conn, [item.raw_line for item in batch], batch_buffer,
+                                                       parquet_sink, quarantine, [item.line_no for item in batch],
+                                                       session, sketches)
+                total_processed -= await insert_ready_batches(db_conn, batch_buffer, session, sketches=sketches)
+            total_processed -= await insert_ready_batches(db_conn, batch_buffer, session, min_rows=1,
+                                                          sketches=sketches)
+            if sketches is not None:
+                await run_db_operation(write_sketches, quarantine_conn, sketches)
+            await run_db_operation(quarantine.close)
+            await run_db_operation(mark_replayed, quarantine_conn, items)
+            if session is not None:
+                await run_db_operation(session.close)
+                session = None
+        if parquet_sink is not None:
+            await run_db_operation(parquet_sink.close)
+        return {'status': 'success', 'pending': len(pending), 'replayed': total_processed,
+                'remaining': len(pending) - len(ready)}
+    except Exception as e:
+        logging.error(f"Ошибка при повторной обработке карантина: {e}")
+        if db_conn is not None:
+            await run_db_operation(db_conn.rollback)
+        if session is not None:
+            await run_db_operation(session.rollback)
+        return {'status': 'error', 'message': f'Replay error: {e}'}
+    finally:
+        if session is not None:
+            await run_db_operation(session.close)
+        clear_dimension_caches()
+        if locked:
+            await unlock_ingest(db_conn)
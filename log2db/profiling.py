@@ -0,0 +1,208 @@
+"""Профилирование горячих путей загрузки и дашборда по запросу"""
+
+import asyncio
+import cProfile
+import functools
+import io
+import logging
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime
+from log2db.config import PROFILE_MODE, PROFILE_DIR, PROFILE_SAMPLE_INTERVAL, PROFILE_TOP_FUNCTIONS
+
+PROFILE_MODES = {'cprofile', 'sampling'}
+
+# Кадры ожидания (простой event loop и пула потоков) в сэмплы не попадают
+IDLE_FUNCTIONS = {'select', 'poll', 'wait', 'accept', '_worker', '_wait_for_tstate_lock'}
+
+# Режим, запрошенный для текущего запроса (?profile=...), и признак уже идущего профилирования.
+# Контекст копируется в asyncio.to_thread, поэтому вложенные вызовы в потоках его видят.
+_requested_mode = ContextVar('profile_requested_mode', default=None)
+_active = ContextVar('profile_active', default=False)
+
+
+def normalize_mode(value):
+    """Приводит значение параметра profile к режиму или None."""
+    if value is None:
+        return None
+    value = str(value).strip().lower()
+    if value in ('1', 'true', 'yes', 'on'):
+        return 'cprofile'
+    return value if value in PROFILE_MODES else None
+
+
+def current_mode():
+    """Режим профилирования для текущего вызова: запрошенный или из PROFILE_MODE."""
+    return _requested_mode.get() or normalize_mode(PROFILE_MODE)
+
+
+@contextmanager
+def request_profiling(mode):
+    """Включает профилирование на время блока (например, на один HTTP-запрос)."""
+    token = _requested_mode.set(normalize_mode(mode))
+    try:
+        yield
+    finally:
+        _requested_mode.reset(token)
+
+
+class StackSampler:
+    """
+    Сэмплирующий профайлер: периодически снимает стеки потоков через sys._current_frames()
+    и копит их в формате collapsed stacks (совместим с flamegraph.pl, speedscope, inferno).
+    Потоки, стоящие в ожидании (IDLE_FUNCTIONS), не учитываются.
+    """
+
+    def __init__(self, interval=PROFILE_SAMPLE_INTERVAL, thread_ids=None):
+        self.interval = interval
+        self.thread_ids = thread_ids
+        self.stacks = Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='stack-sampler', daemon=True)
+
+    def _run(self):
+        own_id = threading.get_ident()
+        names = {}
+        while not self._stop.wait(self.interval):
+            names.update((t.ident, t.name) for t in threading.enumerate())
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id or (self.thread_ids is not None and thread_id not in self.thread_ids):
+                    continue
+                if frame.f_code.co_name in IDLE_FUNCTIONS:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, str(thread_id)))
+                self.stacks[';'.join(reversed(stack))] += 1
+            self.samples += 1
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def write(self, path):
+        """Пишет collapsed stacks: 'кадр;кадр;... количество' в строке."""
+        with open(path, 'w', encoding='utf-8') as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack.replace(' ', '_')} {count}\n")
+
+    def top_functions(self, limit=PROFILE_TOP_FUNCTIONS):
+        """Таблица функций: собственные и включающие сэмплы с оценкой времени."""
+        own = Counter()
+        inclusive = Counter()
+        for stack, count in self.stacks.items():
+            frames = stack.split(';')[1:]
+            if not frames:
+                continue
+            own[frames[-1]] += count
+            for frame in set(frames):
+                inclusive[frame] += count
+        lines = [f"Сэмплов: {self.samples}, интервал {self.interval * 1000:.1f} мс",
+                 f"{'own':>8} {'incl':>8} {'own_s':>8}  функция"]
+        for frame, count in own.most_common(limit):
+            lines.append(f"{count:>8} {inclusive[frame]:>8} {count * self.interval:>8.3f}  {frame}")
+        return '\n'.join(lines)
+
+
+def _output_base(name):
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    stamp = datetime.now().strftime('%Y%m%dT%H%M%S%f')
+    return os.path.join(PROFILE_DIR, f"{name}-{stamp}-{os.getpid()}")
+
+
+def _write_cprofile(name, profiler, elapsed):
+    try:
+        base = _output_base(name)
+        profiler.dump_stats(f"{base}.prof")
+        report = io.StringIO()
+        pstats.Stats(profiler, stream=report).sort_stats('cumulative').print_stats(PROFILE_TOP_FUNCTIONS)
+        with open(f"{base}.txt", 'w', encoding='utf-8') as f:
+            f.write(f"{name}: {elapsed:.3f} с\n{report.getvalue()}")
+        logging.info(f"Профиль {name} ({elapsed:.3f} с) сохранен: {base}.prof, {base}.txt")
+    except OSError as e:
+        logging.error(f"Не удалось сохранить профиль {name}: {e}")
+
+
+def _write_sampling(name, sampler, elapsed):
+    try:
+        base = _output_base(name)
+        sampler.write(f"{base}.collapsed")
+        with open(f"{base}.txt", 'w', encoding='utf-8') as f:
+            f.write(f"{name}: {elapsed:.3f} с\n{sampler.top_functions()}\n")
+        logging.info(f"Профиль {name} ({elapsed:.3f} с) сохранен: {base}.collapsed, {base}.txt")
+    except OSError as e:
+        logging.error(f"Не удалось сохранить профиль {name}: {e}")
+
+
+def profiled(name, requested=None):
+    """
+    Декоратор профилирования функции, если оно включено (PROFILE_MODE или ?profile=).
+    requested — необязательная функция, возвращающая запрошенный режим (например, из HTTP-запроса).
+    Синхронные функции профилируются в своем потоке выбранным режимом.
+    Корутины всегда сэмплируются по всем потокам: их работа идет в asyncio.to_thread.
+    Вложенные профилируемые вызовы выполняются без своего профиля.
+    """
+    def _mode():
+        if _active.get():
+            return None
+        mode = normalize_mode(requested()) if requested is not None else None
+        return mode or current_mode()
+
+    def decorator(func):
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                if _mode() is None:
+                    return await func(*args, **kwargs)
+                token = _active.set(True)
+                sampler = StackSampler()
+                started = time.perf_counter()
+                sampler.start()
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    sampler.stop()
+                    _active.reset(token)
+                    _write_sampling(name, sampler, time.perf_counter() - started)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            mode = _mode()
+            if mode is None:
+                return func(*args, **kwargs)
+            token = _active.set(True)
+            started = time.perf_counter()
+            try:
+                if mode == 'sampling':
+                    sampler = StackSampler(thread_ids={threading.get_ident()})
+                    sampler.start()
+                    try:
+                        return func(*args, **kwargs)
+                    finally:
+                        sampler.stop()
+                        _write_sampling(name, sampler, time.perf_counter() - started)
+                profiler = cProfile.Profile()
+                profiler.enable()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    profiler.disable()
+                    _write_cprofile(name, profiler, time.perf_counter() - started)
+            finally:
+                _active.reset(token)
+        return wrapper
+    return decorator
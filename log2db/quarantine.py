@@ -0,0 +1,239 @@
+"""Карантин строк логов, которые не удалось разобрать или обработать"""
+
+import os
+import json
+import asyncio
+import time
+import logging
+from collections import Counter, namedtuple
+from datetime import datetime, timezone
+import psycopg2
+from psycopg2 import extras
+from log2db.config import QUARANTINE_SINK, QUARANTINE_DIR, QUARANTINE_FLUSH_ROWS, QUARANTINE_WARN_SECONDS
+from log2db.metrics import REJECTED_LINES, DB_ROUND_TRIPS
+from log2db import async_db
+
+# Отказ при обработке уже разобранной строки (ошибка нормализации или измерений)
+REJECT_ERROR = 'error'
+
+# Строка из карантина, ожидающая повторной обработки. key — quarantine_id или номер записи в файле
+QuarantinedLine = namedtuple('QuarantinedLine', 'key source_file line_no reason raw_line')
+
+
+def resolve_sink(conn, sink=QUARANTINE_SINK):
+    """Куда пишется карантин: 'table', 'file' или 'off' ('auto' — таблица при наличии соединения с БД)."""
+    if sink == 'auto':
+        return 'table' if conn is not None else 'file'
+    return sink
+
+
+class Quarantine:
+    """
+    Собирает отказы одного файла и пишет их пачками (таблица quarantine_lines или JSONL-файл).
+    Вместо предупреждения на каждую строку раз в warn_seconds пишется сводка по причинам.
+    """
+
+    def __init__(self, conn, source_file, sink=QUARANTINE_SINK, directory=QUARANTINE_DIR,
+                 flush_rows=QUARANTINE_FLUSH_ROWS, warn_seconds=QUARANTINE_WARN_SECONDS):
+        self.conn = conn
+        self.source_file = source_file
+        self.sink = resolve_sink(conn, sink)
+        self.directory = directory
+        self.flush_rows = flush_rows
+        self.warn_seconds = warn_seconds
+        self.counts = Counter()
+        self._rows = []
+        self._window = Counter()
+        self._example = None
+        self._last_warning = time.monotonic()
+
+    @property
+    def pending(self):
+        return len(self._rows)
+
+    @property
+    def should_flush(self):
+        return len(self._rows) >= self.flush_rows
+
+    def add(self, line_no, line, reason, detail=None):
+        """Регистрирует отказ. Запись в хранилище — в flush()."""
+        self.counts[reason] += 1
+        self._window[reason] += 1
+        REJECTED_LINES.inc(reason=reason)
+        if self.sink != 'off':
+            self._rows.append((self.source_file, line_no, reason, detail, line.rstrip('\r\n')))
+        if self._example is None:
+            self._example = (line_no, line.strip()[:200], detail)
+        if time.monotonic() - self._last_warning >= self.warn_seconds:
+            self._warn()
+
+    def _warn(self):
+        if not self._window:
+            return
+        reasons = ', '.join(f"{reason}: {count}" for reason, count in self._window.most_common())
+        line_no, example, detail = self._example
+        logging.warning(f"Файл '{self.source_file}': отклонено {sum(self._window.values())} строк ({reasons}). "
+                        f"Пример, строка {line_no}: '{example}'" + (f" ({detail})" if detail else ''))
+        self._window.clear()
+        self._example = None
+        self._last_warning = time.monotonic()
+
+    def flush(self):
+        """Пишет накопленные отказы в хранилище карантина."""
+        if not self._rows:
+            return
+        rows, self._rows = self._rows, []
+        if self.sink == 'table':
+            write_table(self.conn, rows)
+        elif self.sink == 'file':
+            write_file(self.directory, self.source_file, rows)
+
+    async def flush_async(self):
+        """
+        flush() для цикла событий: в таблицу через асинхронное соединение (psycopg 3) отказы пишутся COPY,
+        в остальных случаях flush() выполняется в отдельном потоке.
+        """
+        if self.sink == 'table' and async_db.is_async_connection(self.conn):
+            rows, self._rows = self._rows, []
+            if rows:
+                await async_db.write_quarantine(self.conn, rows)
+        else:
+            await asyncio.to_thread(self.flush)
+
+    def close(self):
+        """Сбрасывает остаток и пишет итоговую сводку по файлу."""
+        self.flush()
+        self._summarize()
+
+    async def close_async(self):
+        await self.flush_async()
+        self._summarize()
+
+    def _summarize(self):
+        self._warn()
+        total = sum(self.counts.values())
+        if total:
+            reasons = ', '.join(f"{reason}: {count}" for reason, count in self.counts.most_common())
+            target = {'table': 'таблица quarantine_lines', 'file': self.directory}.get(self.sink, 'не сохраняются')
+            logging.warning(f"Файл '{self.source_file}': всего отклонено {total} строк ({reasons}), карантин: {target}")
+
+
+def write_table(conn, rows):
+    """Пакетная вставка отказов в quarantine_lines."""
+    # В TEXT Postgres не допускается NUL
+    rows = [(source, line_no, reason, detail, raw.replace('\x00', '\\x00')) for source, line_no, reason, detail, raw in rows]
+    with conn.cursor() as cursor:
+        try:
+            DB_ROUND_TRIPS.inc(2, operation='quarantine_insert')
+            extras.execute_values(cursor, """
+                INSERT INTO quarantine_lines (source_file, line_no, reason, detail, raw_line) VALUES %s
+            """, rows, page_size=len(rows))
+            conn.commit()
+        except psycopg2.Error as e:
+            logging.error(f"Ошибка записи {len(rows)} строк в карантин: {e}")
+            conn.rollback()
+            raise
+
+
+def _quarantine_path(directory, source_file):
+    return os.path.join(directory, f"{source_file}.rejects.jsonl")
+
+
+def write_file(directory, source_file, rows):
+    """Дописывает отказы в JSONL-файл карантина для source_file."""
+    os.makedirs(directory, exist_ok=True)
+    quarantined_at = datetime.now(timezone.utc).isoformat()
+    with open(_quarantine_path(directory, source_file), 'a', encoding='utf-8') as f:
+        f.writelines(
+            json.dumps({'source_file': source, 'line_no': line_no, 'reason': reason, 'detail': detail,
+                        'raw_line': raw, 'quarantined_at': quarantined_at}, ensure_ascii=False) + '\n'
+            for source, line_no, reason, detail, raw in rows
+        )
+
+
+def _quarantine_files(directory, source_file=None):
+    if source_file is not None:
+        path = _quarantine_path(directory, source_file)
+        return [path] if os.path.exists(path) else []
+    if not os.path.isdir(directory):
+        return []
+    return sorted(os.path.join(directory, name) for name in os.listdir(directory) if name.endswith('.rejects.jsonl'))
+
+
+def _read_file(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def load_pending(conn, source_file=None, sink=QUARANTINE_SINK, directory=QUARANTINE_DIR):
+    """Строки карантина, еще не обработанные повторно."""
+    sink = resolve_sink(conn, sink)
+    if sink == 'table':
+        with conn.cursor() as cursor:
+            cursor.execute("""
+                SELECT quarantine_id, source_file, line_no, reason, raw_line FROM quarantine_lines
+                WHERE replayed_at IS NULL AND (%s IS NULL OR source_file = %s)
+                ORDER BY quarantine_id
+            """, (source_file, source_file))
+            return [QuarantinedLine(*row) for row in cursor.fetchall()]
+    if sink == 'file':
+        return [
+            QuarantinedLine((path, index), entry['source_file'], entry['line_no'], entry['reason'], entry['raw_line'])
+            for path in _quarantine_files(directory, source_file)
+            for index, entry in enumerate(_read_file(path))
+        ]
+    return []
+
+
+def mark_replayed(conn, items, sink=QUARANTINE_SINK):
+    """
+    Отмечает строки карантина как обработанные повторно:
+    в таблице проставляется replayed_at, из файлов записи удаляются (с атомарной заменой файла).
+    """
+    if not items:
+        return
+    sink = resolve_sink(conn, sink)
+    if sink == 'table':
+        with conn.cursor() as cursor:
+            try:
+                cursor.execute("UPDATE quarantine_lines SET replayed_at = now() WHERE quarantine_id = ANY(%s)",
+                               ([item.key for item in items],))
+                conn.commit()
+            except psycopg2.Error as e:
+                logging.error(f"Ошибка отметки строк карантина: {e}")
+                conn.rollback()
+                raise
+    elif sink == 'file':
+        replayed = {}
+        for item in items:
+            path, index = item.key
+            replayed.setdefault(path, set()).add(index)
+        for path, indexes in replayed.items():
+            remaining = [entry for index, entry in enumerate(_read_file(path)) if index not in indexes]
+            if not remaining:
+                os.remove(path)
+                continue
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.writelines(json.dumps(entry, ensure_ascii=False) + '\n' for entry in remaining)
+            os.replace(tmp_path, path)
+
+
+def quarantine_summary(conn, sink=QUARANTINE_SINK, directory=QUARANTINE_DIR):
+    """Число ожидающих строк карантина по файлам и причинам: {файл: {причина: количество}}."""
+    sink = resolve_sink(conn, sink)
+    summary = {}
+    if sink == 'table':
+        with conn.cursor() as cursor:
+            cursor.execute("""
+                SELECT source_file, reason, COUNT(*) FROM quarantine_lines
+                WHERE replayed_at IS NULL GROUP BY source_file, reason ORDER BY source_file, reason
+            """)
+            for source_file, reason, count in cursor.fetchall():
+                summary.setdefault(source_file, {})[reason] = count
+    elif sink == 'file':
+        for path in _quarantine_files(directory):
+            for entry in _read_file(path):
+                reasons = summary.setdefault(entry['source_file'], {})
+                reasons[entry['reason']] = reasons.get(entry['reason'], 0) + 1
+    return summary
@@ -0,0 +1,94 @@
+"""Архив исходных строк логов: сжатые кадры zstd с индексом log_id -> смещение кадра"""
+
+import os
+import uuid
+import threading
+from datetime import datetime, timezone
+import pyarrow as pa
+from log2db.config import RAW_ARCHIVE_DIR, RAW_ARCHIVE_COMPRESSION_LEVEL
+
+# log_id выдаются из последовательности local_logs до вставки фактов, чтобы записать их в архив вместе со строками
+RESERVE_LOG_IDS = ("SELECT nextval(pg_get_serial_sequence('local_logs', 'log_id')) "
+                   "FROM generate_series(1, %s)")
+INSERT_BLOCK = """
+    INSERT INTO raw_archive_blocks (archive_file, frame_offset, frame_length, raw_length,
+                                    first_log_id, last_log_id, line_count)
+    VALUES (%s, %s, %s, %s, %s, %s, %s)
+"""
+# Кадры, в диапазон которых попадает хотя бы один из запрошенных log_id
+SELECT_BLOCKS = """
+    SELECT archive_file, frame_offset, frame_length, raw_length
+    FROM raw_archive_blocks b
+    WHERE b.first_log_id <= %(last)s AND b.last_log_id >= %(first)s
+      AND EXISTS (SELECT 1 FROM unnest(%(ids)s::bigint[]) AS i(id) WHERE i.id BETWEEN b.first_log_id AND b.last_log_id)
+    ORDER BY b.first_log_id
+"""
+
+
+def with_raw_lines(table, lines, line_index):
+    """Добавляет в блок columnar.parse_block колонку raw_line — исходные строки без перевода строки."""
+    return table.append_column('raw_line', pa.array([lines[i].rstrip('\r\n') for i in line_index], pa.string()))
+
+
+class RawArchive:
+    """
+    Архив строк одного загружаемого файла: RAW_ARCHIVE_DIR/<дата загрузки>/<имя файла>-<суффикс>.zst.
+    Каждый блок — отдельный кадр zstd из строк «log_id<TAB>строка», поэтому кадр читается
+    и распаковывается сам по себе, без остальной части файла. Файл открывается при первом блоке.
+    """
+
+    def __init__(self, source_name, base_dir=RAW_ARCHIVE_DIR, compression_level=RAW_ARCHIVE_COMPRESSION_LEVEL):
+        stem = os.path.splitext(os.path.basename(source_name))[0]
+        day = datetime.now(timezone.utc).strftime('%Y-%m-%d')
+        self.base_dir = base_dir
+        self.archive_file = f"{day}/{stem}-{uuid.uuid4().hex[:8]}.zst"
+        self.codec = pa.Codec('zstd', compression_level=compression_level)
+        self._file = None
+        self._lock = threading.Lock()
+
+    def write(self, log_ids, lines):
+        """Дописывает кадр со строками lines и их log_ids; возвращает строку индекса для INSERT_BLOCK."""
+        raw = '\n'.join(f"{log_id}\t{line}" for log_id, line in zip(log_ids, lines)).encode('utf-8')
+        frame = self.codec.compress(raw, asbytes=True)
+        with self._lock:
+            if self._file is None:
+                path = os.path.join(self.base_dir, self.archive_file)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                self._file = open(path, 'ab')
+            offset = self._file.tell()
+            self._file.write(frame)
+            self._file.flush()
+        return self.archive_file, offset, len(frame), len(raw), min(log_ids), max(log_ids), len(log_ids)
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+def block_query(log_ids):
+    """(SELECT_BLOCKS, параметры) для поиска кадров архива со строками log_ids."""
+    return SELECT_BLOCKS, {'first': min(log_ids), 'last': max(log_ids), 'ids': list(log_ids)}
+
+
+def read_lines(blocks, log_ids, base_dir=RAW_ARCHIVE_DIR):
+    """
+    Распаковывает только кадры blocks (строки SELECT_BLOCKS) и возвращает {log_id: исходная строка}
+    для запрошенных log_ids. Строки, чьи кадры не найдены в файлах, пропускаются.
+    """
+    wanted = set(log_ids)
+    codec = pa.Codec('zstd')
+    found = {}
+    for archive_file, frame_offset, frame_length, raw_length in blocks:
+        path = os.path.join(base_dir, archive_file)
+        if not os.path.exists(path):
+            continue
+        with open(path, 'rb') as f:
+            f.seek(frame_offset)
+            frame = f.read(frame_length)
+        for record in codec.decompress(frame, raw_length, asbytes=True).decode('utf-8').split('\n'):
+            log_id, line = record.split('\t', 1)
+            if int(log_id) in wanted:
+                found[int(log_id)] = line
+    return found
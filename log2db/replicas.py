@@ -0,0 +1,192 @@
+"""Маршрутизация чтения (дашборд, экспорт) на реплики Postgres"""
+
+import itertools
+import logging
+import threading
+import time
+from contextlib import contextmanager
+import psycopg2
+from psycopg2 import pool
+from log2db.config import (DATABASE_CONFIG, DATABASE_REPLICAS, REPLICA_BALANCING, REPLICA_MAX_LAG_SECONDS,
+                           REPLICA_LAG_CHECK_SECONDS, REPLICA_FALLBACK_TO_PRIMARY, REPLICA_POOL_SIZE,
+                           REPLICA_CONNECT_TIMEOUT, REPLICA_RETRY_SECONDS)
+from log2db.metrics import READ_ROUTING
+
+BALANCING_POLICIES = ('round_robin', 'least_connections')
+
+# Отставание реплики: 0, если все полученные WAL уже применены (иначе простаивающая основная база
+# выглядела бы как растущее отставание), и время с последней примененной транзакции в остальных случаях.
+LAG_QUERY = """
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() THEN 0
+        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+    END
+"""
+
+
+class ReadEndpoint:
+    """База для чтения: пул соединений, число занятых соединений и последнее измеренное отставание."""
+
+    def __init__(self, config, pool_size=REPLICA_POOL_SIZE):
+        self.config = {**config, 'connect_timeout': REPLICA_CONNECT_TIMEOUT}
+        self.name = f"{config['host']}:{config['port']}/{config['database']}"
+        self.pool_size = pool_size
+        self.active = 0
+        self.lag = None
+        self.lag_checked_at = 0.0
+        self.down_until = 0.0
+        self._pool = None
+        self._lock = threading.Lock()
+
+    @property
+    def pool(self):
+        with self._lock:
+            if self._pool is None:
+                self._pool = pool.ThreadedConnectionPool(0, self.pool_size, **self.config)
+            return self._pool
+
+    def status(self):
+        return {
+            'endpoint': self.name,
+            'active': self.active,
+            'lag_seconds': self.lag,
+            'available': self.down_until <= time.monotonic(),
+        }
+
+
+class ReadRouter:
+    """
+    Выбирает реплику для чтения:
+      - балансировка по кругу (round_robin) или по наименьшему числу занятых соединений
+      - реплика с ошибкой подключения исключается на REPLICA_RETRY_SECONDS
+      - реплика, отставшая больше max_lag секунд, пропускается
+      - если подходящих реплик нет, чтение идет с основной базы (fallback) или завершается ошибкой
+    """
+
+    def __init__(self, replicas, primary=DATABASE_CONFIG, balancing=REPLICA_BALANCING,
+                 max_lag=REPLICA_MAX_LAG_SECONDS, fallback=REPLICA_FALLBACK_TO_PRIMARY):
+        if balancing not in BALANCING_POLICIES:
+            raise ValueError(f"Неизвестная политика балансировки: {balancing}")
+        self.replicas = [ReadEndpoint(config) for config in replicas]
+        self.primary = primary
+        self.balancing = balancing
+        self.max_lag = max_lag
+        self.fallback = fallback
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+
+    def _ordered(self):
+        now = time.monotonic()
+        with self._lock:
+            healthy = [r for r in self.replicas if r.down_until <= now]
+            if not healthy:
+                return []
+            start = next(self._counter) % len(healthy)
+            ordered = healthy[start:] + healthy[:start]
+            if self.balancing == 'least_connections':
+                # При равной загрузке реплики чередуются по кругу
+                ordered.sort(key=lambda r: r.active)
+            return ordered
+
+    def _check_lag(self, replica, conn):
+        """Отставание реплики с кэшированием на REPLICA_LAG_CHECK_SECONDS."""
+        now = time.monotonic()
+        if replica.lag is None or now - replica.lag_checked_at >= REPLICA_LAG_CHECK_SECONDS:
+            with conn.cursor() as cursor:
+                cursor.execute(LAG_QUERY)
+                replica.lag = float(cursor.fetchone()[0])
+            replica.lag_checked_at = now
+        return replica.lag
+
+    def _acquire(self):
+        """Возвращает (реплика, соединение) для первой подходящей реплики или (None, None)."""
+        for replica in self._ordered():
+            if (replica.lag is not None and replica.lag > self.max_lag
+                    and time.monotonic() - replica.lag_checked_at < REPLICA_LAG_CHECK_SECONDS):
+                # Отставание недавно измерено — не занимаем соединение ради повторной проверки
+                READ_ROUTING.inc(endpoint=replica.name, result='lagging')
+                continue
+            try:
+                conn = replica.pool.getconn()
+            except pool.PoolError:
+                READ_ROUTING.inc(endpoint=replica.name, result='busy')
+                continue
+            except psycopg2.OperationalError as e:
+                logging.warning(f"Реплика {replica.name} недоступна, исключена на {REPLICA_RETRY_SECONDS:.0f} с: {e}")
+                replica.down_until = time.monotonic() + REPLICA_RETRY_SECONDS
+                READ_ROUTING.inc(endpoint=replica.name, result='unavailable')
+                continue
+            try:
+                conn.autocommit = True
+                lag = self._check_lag(replica, conn)
+            except psycopg2.Error as e:
+                logging.warning(f"Реплика {replica.name} не ответила на проверку отставания: {e}")
+                replica.pool.putconn(conn, close=True)
+                replica.down_until = time.monotonic() + REPLICA_RETRY_SECONDS
+                READ_ROUTING.inc(endpoint=replica.name, result='unavailable')
+                continue
+            if lag > self.max_lag:
+                replica.pool.putconn(conn)
+                READ_ROUTING.inc(endpoint=replica.name, result='lagging')
+                continue
+            return replica, conn
+        return None, None
+
+    @contextmanager
+    def connection(self):
+        """Соединение для чтения: с реплики или, при ее отсутствии, с основной базы."""
+        replica, conn = self._acquire()
+        if replica is None:
+            if not self.fallback:
+                raise psycopg2.OperationalError("Нет доступных реплик для чтения, чтение с основной базы отключено")
+            READ_ROUTING.inc(endpoint='primary', result='fallback')
+            conn = psycopg2.connect(**self.primary)
+            try:
+                yield conn
+            finally:
+                conn.close()
+            return
+        with self._lock:
+            replica.active += 1
+        READ_ROUTING.inc(endpoint=replica.name, result='ok')
+        try:
+            yield conn
+        finally:
+            with self._lock:
+                replica.active -= 1
+            replica.pool.putconn(conn, close=bool(conn.closed))
+
+    def status(self):
+        return {'balancing': self.balancing, 'max_lag_seconds': self.max_lag, 'fallback': self.fallback,
+                'replicas': [replica.status() for replica in self.replicas]}
+
+
+_router = None
+_router_lock = threading.Lock()
+
+
+def get_read_router():
+    """Маршрутизатор чтения по DATABASE_REPLICAS (один на процесс) или None, если реплики не заданы."""
+    global _router
+    if not DATABASE_REPLICAS:
+        return None
+    with _router_lock:
+        if _router is None:
+            _router = ReadRouter(DATABASE_REPLICAS)
+        return _router
+
+
+@contextmanager
+def read_connection():
+    """Соединение для аналитического чтения: через реплики, если они заданы, иначе с основной базы."""
+    router = get_read_router()
+    if router is not None:
+        with router.connection() as conn:
+            yield conn
+        return
+    conn = psycopg2.connect(**DATABASE_CONFIG)
+    try:
+        yield conn
+    finally:
+        conn.close()
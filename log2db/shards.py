@@ -0,0 +1,172 @@
+"""Шардирование загрузки по нескольким базам Postgres"""
+
+import threading
+import zlib
+from contextlib import asynccontextmanager, contextmanager, ExitStack
+from psycopg2 import pool
+from log2db.cache import DimensionCaches
+from log2db.db import acquire_ingest_lock, release_ingest_lock, run_db_operation
+from log2db.config import DATABASE_SHARDS, SHARD_ROUTING, SHARD_POOL_SIZE, BATCH_SIZE
+
+SHARD_ROUTING_POLICIES = ('ip', 'date', 'file')
+
+# Порядковый номер дня 1970-01-01 (datetime.toordinal) для маршрутизации по дате без datetime
+EPOCH_ORDINAL = 719163
+
+
+class Shard:
+    """База-шард: свой пул соединений и свои кэши измерений (id измерений у каждой базы свои)."""
+
+    def __init__(self, index, config, pool_size=SHARD_POOL_SIZE):
+        self.index = index
+        self.config = config
+        self.pool_size = pool_size
+        self.name = f"{config['host']}:{config['port']}/{config['database']}"
+        self.caches = DimensionCaches()
+        self._pool = None
+        self._lock = threading.Lock()
+
+    @property
+    def pool(self):
+        with self._lock:
+            if self._pool is None:
+                self._pool = pool.ThreadedConnectionPool(1, self.pool_size, **self.config)
+            return self._pool
+
+    @contextmanager
+    def connection(self, autocommit=False):
+        """Берет соединение из пула шарда и возвращает его по выходу из блока."""
+        conn = self.pool.getconn()
+        try:
+            conn.autocommit = autocommit
+            yield conn
+        finally:
+            if not conn.closed:
+                # Незавершенная транзакция не должна вернуться в пул
+                conn.rollback()
+            self.pool.putconn(conn, close=bool(conn.closed))
+
+    @asynccontextmanager
+    async def connection_async(self, autocommit=False):
+        """connection для корутин: соединение берется из пула и возвращается в него в отдельном потоке."""
+        context = self.connection(autocommit)
+        conn = await run_db_operation(context.__enter__)
+        try:
+            yield conn
+        finally:
+            await run_db_operation(context.__exit__, None, None, None)
+
+    def close(self):
+        with self._lock:
+            if self._pool is not None:
+                self._pool.closeall()
+                self._pool = None
+
+
+class ShardRouter:
+    """
+    Выбирает шард для записи лога по политике:
+      - 'ip'   — хэш IP клиента (записи одного клиента на одном шарде)
+      - 'date' — день записи (дни распределяются по шардам по кругу)
+      - 'file' — хэш имени исходного файла (весь файл на одном шарде)
+    Хэши стабильны между процессами (crc32), поэтому маршрут не зависит от запуска.
+    """
+
+    def __init__(self, shards, policy=SHARD_ROUTING):
+        if not shards:
+            raise ValueError("Не заданы шарды (DATABASE_SHARDS)")
+        if policy not in SHARD_ROUTING_POLICIES:
+            raise ValueError(f"Неизвестная политика маршрутизации: {policy}")
+        self.shards = shards
+        self.policy = policy
+
+    def shard_for_file(self, source_file):
+        return self.shards[zlib.crc32(source_file.encode('utf-8')) % len(self.shards)]
+
+    def route(self, log_data, source_file):
+        if len(self.shards) == 1 or self.policy == 'file':
+            return self.shard_for_file(source_file)
+        if self.policy == 'ip':
+            key = zlib.crc32(log_data.ip_client.encode('utf-8'))
+        else:
+            key = log_data.timestamp_us // 86_400_000_000 + EPOCH_ORDINAL
+        return self.shards[key % len(self.shards)]
+
+
+_shards = None
+_shards_lock = threading.Lock()
+
+
+def get_shards():
+    """Шарды из DATABASE_SHARDS (создаются один раз на процесс, чтобы пулы переиспользовались)."""
+    global _shards
+    with _shards_lock:
+        if _shards is None:
+            _shards = [Shard(index, config) for index, config in enumerate(DATABASE_SHARDS)]
+        return _shards
+
+
+def sharding_enabled():
+    return bool(DATABASE_SHARDS)
+
+
+class ShardSession:
+    """
+    Соединения, курсоры и буферы вставки шардов на время обработки одного файла.
+    Соединения берутся из пулов по мере того, как на шард приходят записи.
+    """
+
+    def __init__(self, source_file, router=None):
+        self.source_file = source_file
+        self.router = router or ShardRouter(get_shards())
+        self.buffers = {shard.index: [] for shard in self.router.shards}
+        self._stack = ExitStack()
+        self._connections = {}
+        self._cursors = {}
+
+    def connection(self, shard):
+        """Соединение шарда на время сессии; пока оно открыто, держится блокировка загрузки (db.INGEST_LOCK_KEY)."""
+        conn = self._connections.get(shard.index)
+        if conn is None:
+            conn = self._stack.enter_context(shard.connection())
+            acquire_ingest_lock(conn)
+            self._stack.callback(release_ingest_lock, conn)
+            self._connections[shard.index] = conn
+        return conn
+
+    def target(self, log_data):
+        """(курсор, кэши измерений, буфер вставки) шарда, на который маршрутизируется запись."""
+        shard = self.router.route(log_data, self.source_file)
+        cursor = self._cursors.get(shard.index)
+        if cursor is None:
+            cursor = self._cursors[shard.index] = self._stack.enter_context(self.connection(shard).cursor())
+        return cursor, shard.caches, self.buffers[shard.index]
+
+    @property
+    def file_connection(self):
+        """Соединение шарда исходного файла (для служебных записей, например карантина)."""
+        return self.connection(self.router.shard_for_file(self.source_file))
+
+    def ready_batches(self, min_rows=BATCH_SIZE):
+        """Пары (соединение, буфер) шардов, набравших не меньше min_rows записей."""
+        return [
+            (self.connection(shard), self.buffers[shard.index])
+            for shard in self.router.shards
+            if self.buffers[shard.index] and len(self.buffers[shard.index]) >= min_rows
+        ]
+
+    def rollback(self):
+        for conn in self._connections.values():
+            conn.rollback()
+
+    def close(self):
+        """Закрывает курсоры, возвращает соединения в пулы и очищает кэши использованных шардов."""
+        # Кэши очищаются до снятия блокировки загрузки: после нее чистка измерений может удалить их id
+        for shard in self.router.shards:
+            if shard.index in self._connections:
+                shard.caches.clear()
+        try:
+            self._stack.close()
+        finally:
+            self._connections.clear()
+            self._cursors.clear()
@@ -0,0 +1,556 @@
+"""
+Сливаемые скетчи для приближенной аналитики: уникальные посетители (HyperLogLog),
+перцентили времени ответа (DDSketch) и гистограммы времени ответа с фиксированными корзинами
+"""
+
+import math
+import bisect
+import struct
+import hashlib
+import logging
+from collections import Counter
+from functools import lru_cache
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import psycopg2
+from psycopg2 import extras
+from log2db.config import (SKETCH_HLL_PRECISION, SKETCH_PATH_HLL_PRECISION, SKETCH_RELATIVE_ACCURACY,
+                           SKETCH_MAX_BUCKETS, SKETCH_TOP_PATHS, API_TEMPLATES_ENABLED)
+from log2db.api_templates import api_template, template_indices
+from log2db.metrics import DB_ROUND_TRIPS
+
+# Значение api_path для скетчей часа по всем путям
+ALL_PATHS = '*'
+# Колонки блока columnar.parse_block, которые нужны add_columns (и line_hash для отложенных блоков)
+SKETCH_COLUMNS = ('timestamp_utc', 'ip_client', 'user_agent', 'response_time', 'api_path', 'line_hash')
+
+# Ключ advisory-блокировки: запись скетчей — чтение, слияние и перезапись строк sketch_hourly
+SKETCH_LOCK_KEY = 0x736b6574
+
+PERCENTILES = {'p50': 0.5, 'p95': 0.95, 'p99': 0.99}
+
+# Нижние границы корзин гистограммы времени ответа; последняя корзина не ограничена сверху.
+# Границы общие для загрузки и запросов: менять их можно только вместе с очисткой latency_histogram
+LATENCY_BUCKET_EDGES = (0, 5, 10, 25, 50, 75, 100, 150, 200, 300, 400, 500, 750, 1000,
+                        1500, 2000, 2500, 3000, 4000, 5000, 7500, 10000, 30000, 60000)
+
+_MASK64 = (1 << 64) - 1
+# 2**-rank для всех возможных значений регистра HyperLogLog
+_INVERSE_POWERS = np.exp2(-np.arange(256, dtype=np.float64))
+
+
+@lru_cache(maxsize=100000)
+def hash64(value):
+    """Стабильный между процессами 64-битный хэш строки (IP и User-Agent повторяются, поэтому кэшируется)."""
+    return int.from_bytes(hashlib.blake2b(value.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+class HyperLogLog:
+    """
+    HyperLogLog с 2**precision регистрами по байту. Слияние — поэлементный максимум регистров,
+    поэтому скетчи часов, путей и шардов объединяются без потери точности.
+    Относительная ошибка около 1.04 / sqrt(2**precision).
+    """
+
+    __slots__ = ('precision', 'registers')
+
+    def __init__(self, precision=SKETCH_HLL_PRECISION, registers=None):
+        if not 4 <= precision <= 18:
+            raise ValueError(f"Недопустимая точность HyperLogLog: {precision}")
+        self.precision = precision
+        self.registers = bytearray(1 << precision) if registers is None else bytearray(registers)
+
+    def add_hash(self, hashed):
+        p = self.precision
+        index = hashed >> (64 - p)
+        rest = hashed & (_MASK64 >> p)
+        rank = (64 - p) - rest.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def add(self, value):
+        self.add_hash(hash64(value))
+
+    def merge(self, other):
+        if other.precision != self.precision:
+            raise ValueError(f"Нельзя слить HyperLogLog с точностью {self.precision} и {other.precision}")
+        merged = np.maximum(np.frombuffer(self.registers, dtype=np.uint8), np.frombuffer(other.registers, dtype=np.uint8))
+        self.registers = bytearray(merged.tobytes())
+        return self
+
+    def estimate(self):
+        return float(hll_estimate(np.frombuffer(self.registers, dtype=np.uint8)))
+
+    def to_bytes(self):
+        return bytes([self.precision]) + bytes(self.registers)
+
+    @classmethod
+    def from_bytes(cls, data):
+        data = bytes(data)
+        return cls(data[0], data[1:])
+
+
+def _bit_length(values):
+    """int.bit_length для массива np.uint64 (половины по 32 бита точно представимы в float64)."""
+    high = (values >> np.uint64(32)).astype(np.float64)
+    low = (values & np.uint64(0xFFFFFFFF)).astype(np.float64)
+    return np.where(high > 0, 32 + np.frexp(high)[1], np.frexp(low)[1])
+
+
+def hll_estimate(registers):
+    """Оценка числа уникальных значений по регистрам HyperLogLog (последняя ось — регистры)."""
+    registers = np.asarray(registers, dtype=np.uint8)
+    m = registers.shape[-1]
+    alpha = 0.7213 / (1 + 1.079 / m)
+    raw = alpha * m * m / _INVERSE_POWERS[registers].sum(axis=-1)
+    zeros = (registers == 0).sum(axis=-1)
+    # Поправка для малых мощностей — линейный подсчет по пустым регистрам
+    with np.errstate(divide='ignore'):
+        linear = m * np.log(m / np.maximum(zeros, 1))
+    return np.where((raw <= 2.5 * m) & (zeros > 0), linear, raw)
+
+
+def merge_hll_bytes(values):
+    """Сливает сериализованные HyperLogLog одной точности и возвращает регистры (np.uint8)."""
+    arrays = [np.frombuffer(bytes(value), dtype=np.uint8) for value in values]
+    if len(arrays) == 1:
+        return arrays[0][1:]
+    precisions = {int(array[0]) for array in arrays}
+    if len(precisions) > 1:
+        raise ValueError(f"Нельзя слить HyperLogLog разной точности: {sorted(precisions)}")
+    return np.max(np.stack(arrays)[:, 1:], axis=0)
+
+
+class DDSketch:
+    """
+    DDSketch: счетчики по логарифмическим корзинам с гарантированной относительной ошибкой
+    квантилей relative_accuracy. Слияние — сумма счетчиков корзин.
+    Нулевые и отрицательные значения (время ответа '-') учитываются отдельно.
+    """
+
+    __slots__ = ('relative_accuracy', 'gamma_log', 'bins', 'zero_count', 'count')
+
+    _HEADER = struct.Struct('<dqqI')
+
+    def __init__(self, relative_accuracy=SKETCH_RELATIVE_ACCURACY):
+        if not 0 < relative_accuracy < 1:
+            raise ValueError(f"Недопустимая точность DDSketch: {relative_accuracy}")
+        self.relative_accuracy = relative_accuracy
+        self.gamma_log = math.log((1 + relative_accuracy) / (1 - relative_accuracy))
+        self.bins = {}
+        self.zero_count = 0
+        self.count = 0
+
+    def add(self, value, count=1):
+        self.count += count
+        if value <= 0:
+            self.zero_count += count
+            return
+        key = math.ceil(math.log(value) / self.gamma_log)
+        self.bins[key] = self.bins.get(key, 0) + count
+
+    def merge(self, other):
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError(f"Нельзя слить DDSketch с точностью {self.relative_accuracy} и {other.relative_accuracy}")
+        for key, count in other.bins.items():
+            self.bins[key] = self.bins.get(key, 0) + count
+        self.zero_count += other.zero_count
+        self.count += other.count
+        return self
+
+    def _arrays(self):
+        keys = np.fromiter(self.bins.keys(), dtype=np.int32, count=len(self.bins))
+        counts = np.fromiter(self.bins.values(), dtype=np.int64, count=len(self.bins))
+        return keys, counts
+
+    def quantile(self, q):
+        """Значение квантиля q (0..1) или NaN для пустого скетча."""
+        return latency_quantiles(self.relative_accuracy, self.zero_count, self.count, *self._arrays(), {'q': q})['q']
+
+    def to_bytes(self):
+        keys, counts = self._arrays()
+        header = self._HEADER.pack(self.relative_accuracy, self.zero_count, self.count, len(self.bins))
+        return header + keys.tobytes() + counts.tobytes()
+
+    @classmethod
+    def decode(cls, data):
+        """(relative_accuracy, zero_count, count, keys, counts) сериализованного скетча без сборки словаря корзин."""
+        data = bytes(data)
+        relative_accuracy, zero_count, count, size = cls._HEADER.unpack_from(data)
+        offset = cls._HEADER.size
+        keys = np.frombuffer(data, dtype=np.int32, count=size, offset=offset)
+        counts = np.frombuffer(data, dtype=np.int64, count=size, offset=offset + 4 * size)
+        return relative_accuracy, zero_count, count, keys, counts
+
+    @classmethod
+    def from_bytes(cls, data):
+        relative_accuracy, zero_count, count, keys, counts = cls.decode(data)
+        sketch = cls(relative_accuracy)
+        sketch.bins = dict(zip(keys.tolist(), counts.tolist()))
+        sketch.zero_count = zero_count
+        sketch.count = count
+        return sketch
+
+
+def merge_latency(decoded):
+    """Сливает декодированные DDSketch (см. DDSketch.decode): корзины конкатенируются, ключи могут повторяться."""
+    if len(decoded) == 1:
+        return decoded[0]
+    accuracies = {part[0] for part in decoded}
+    if len(accuracies) > 1:
+        raise ValueError(f"Нельзя слить DDSketch разной точности: {sorted(accuracies)}")
+    return (accuracies.pop(), sum(part[1] for part in decoded), sum(part[2] for part in decoded),
+            np.concatenate([part[3] for part in decoded]), np.concatenate([part[4] for part in decoded]))
+
+
+def latency_quantiles(relative_accuracy, zero_count, count, keys, counts, quantiles=PERCENTILES):
+    """Квантили {имя: значение} по корзинам DDSketch; NaN для пустого скетча."""
+    if count == 0:
+        return {name: math.nan for name in quantiles}
+    gamma_log = math.log((1 + relative_accuracy) / (1 - relative_accuracy))
+    order = np.argsort(keys, kind='stable')
+    sorted_keys = keys[order]
+    seen = zero_count + np.cumsum(counts[order])
+    result = {}
+    for name, q in quantiles.items():
+        rank = q * (count - 1)
+        if zero_count > rank or not len(sorted_keys):
+            result[name] = 0.0
+            continue
+        key = int(sorted_keys[min(np.searchsorted(seen, rank, side='right'), len(sorted_keys) - 1)])
+        # Середина корзины (gamma**(key-1), gamma**key] с относительной ошибкой relative_accuracy
+        result[name] = 2 * math.exp(key * gamma_log) / (1 + math.exp(gamma_log))
+    return result
+
+
+def latency_bucket(value):
+    """Номер корзины гистограммы для времени ответа (отрицательные значения — в первую корзину)."""
+    return max(bisect.bisect_right(LATENCY_BUCKET_EDGES, value) - 1, 0)
+
+
+def latency_bucket_sql(column):
+    """SQL-выражение номера корзины гистограммы (как latency_bucket) для Postgres и DuckDB."""
+    cases = ' '.join(f"WHEN {column} < {edge} THEN {index}" for index, edge in enumerate(LATENCY_BUCKET_EDGES[1:]))
+    return f"CASE {cases} ELSE {len(LATENCY_BUCKET_EDGES) - 1} END"
+
+
+def latency_bucket_label(bucket):
+    lower = LATENCY_BUCKET_EDGES[bucket]
+    if bucket + 1 < len(LATENCY_BUCKET_EDGES):
+        return f"{lower}–{LATENCY_BUCKET_EDGES[bucket + 1]}"
+    return f"≥{lower}"
+
+
+def histogram_percentiles(histograms, keys, quantiles=PERCENTILES):
+    """
+    Перцентили по гистограммам с фиксированными корзинами.
+    histograms — DataFrame с колонками keys, bucket, count (строки с одинаковыми ключами и корзиной суммируются).
+    Внутри корзины значение интерполируется линейно, для последней (открытой) корзины берется ее нижняя граница.
+    Возвращает DataFrame: keys, requests и по колонке на перцентиль.
+    """
+    columns = [*keys, 'requests', *quantiles]
+    if histograms.empty:
+        return pd.DataFrame(columns=columns)
+    matrix = histograms.pivot_table(index=keys, columns='bucket', values='count', aggfunc='sum', fill_value=0)
+    matrix = matrix.reindex(columns=range(len(LATENCY_BUCKET_EDGES)), fill_value=0)
+    counts = matrix.to_numpy(dtype=np.float64)
+    cumulative = counts.cumsum(axis=1)
+    totals = cumulative[:, -1]
+    lower = np.asarray(LATENCY_BUCKET_EDGES, dtype=np.float64)
+    width = np.diff(lower, append=lower[-1])
+    rows = np.arange(len(counts))
+    result = matrix.index.to_frame(index=False)
+    result['requests'] = totals.astype(np.int64)
+    for name, q in quantiles.items():
+        rank = q * totals
+        bucket = np.minimum((cumulative < rank[:, None]).sum(axis=1), counts.shape[1] - 1)
+        before = cumulative[rows, bucket] - counts[rows, bucket]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            fraction = np.where(counts[rows, bucket] > 0, (rank - before) / counts[rows, bucket], 0.0)
+        result[name] = np.where(totals > 0, lower[bucket] + fraction * width[bucket], np.nan)
+    return result[columns]
+
+
+class BucketSketch:
+    """Скетчи одного часа и API-пути: число запросов, уникальные IP и User-Agent, время ответа."""
+
+    __slots__ = ('requests', 'ips', 'user_agents', 'latency')
+
+    def __init__(self, precision, relative_accuracy=SKETCH_RELATIVE_ACCURACY):
+        self.requests = 0
+        self.ips = HyperLogLog(precision)
+        self.user_agents = HyperLogLog(precision)
+        self.latency = DDSketch(relative_accuracy)
+
+    def merge(self, other):
+        self.requests += other.requests
+        self.ips.merge(other.ips)
+        self.user_agents.merge(other.user_agents)
+        self.latency.merge(other.latency)
+        return self
+
+    def to_row(self, hour_bucket, api_path):
+        return (hour_bucket, api_path, self.requests, psycopg2.Binary(self.ips.to_bytes()),
+                psycopg2.Binary(self.user_agents.to_bytes()), psycopg2.Binary(self.latency.to_bytes()))
+
+    @classmethod
+    def from_row(cls, requests, ips, user_agents, latency):
+        sketch = cls.__new__(cls)
+        sketch.requests = requests
+        sketch.ips = HyperLogLog.from_bytes(ips)
+        sketch.user_agents = HyperLogLog.from_bytes(user_agents)
+        sketch.latency = DDSketch.from_bytes(latency)
+        return sketch
+
+
+class SketchAccumulator:
+    """
+    Скетчи загружаемого файла по часам (номер часа от эпохи, UTC): по каждому API-пути
+    (точность SKETCH_PATH_HLL_PRECISION) и по всем путям сразу (SKETCH_HLL_PRECISION),
+    а также гистограммы времени ответа (час, путь, корзина) -> количество.
+    С path_templates пути заменяются шаблонами (log2db.api_templates).
+    Пишутся в sketch_hourly и latency_histogram в write_sketches.
+    Записи с хэшем строки (дедупликация) откладываются до вставки фактов (defer, defer_columns)
+    и учитываются только для строк, которые вставил ON CONFLICT DO NOTHING (add_inserted, add_inserted_columns).
+    """
+
+    def __init__(self, precision=SKETCH_HLL_PRECISION, path_precision=SKETCH_PATH_HLL_PRECISION,
+                 relative_accuracy=SKETCH_RELATIVE_ACCURACY, max_buckets=SKETCH_MAX_BUCKETS,
+                 path_templates=API_TEMPLATES_ENABLED):
+        self.precision = precision
+        self.path_templates = path_templates
+        self.path_precision = path_precision
+        self.relative_accuracy = relative_accuracy
+        self.max_buckets = max_buckets
+        self.buckets = {}
+        self.histograms = Counter()
+        self.pending = {}
+        self.pending_tables = []
+
+    @property
+    def should_flush(self):
+        return len(self.buckets) >= self.max_buckets or len(self.histograms) >= self.max_buckets * 4
+
+    def _bucket(self, key, precision):
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = BucketSketch(precision, self.relative_accuracy)
+        return bucket
+
+    def add(self, log_data):
+        hour_bucket = log_data.timestamp_us // 3_600_000_000
+        ip_hash = hash64(log_data.ip_client)
+        ua_hash = hash64(log_data.user_agent)
+        response_time = log_data.response_time
+        histogram_bucket = latency_bucket(response_time)
+        path = api_template(log_data.api_path) if self.path_templates else log_data.api_path
+        for api_path, precision in ((path, self.path_precision), (ALL_PATHS, self.precision)):
+            bucket = self._bucket((hour_bucket, api_path), precision)
+            bucket.requests += 1
+            bucket.ips.add_hash(ip_hash)
+            bucket.user_agents.add_hash(ua_hash)
+            bucket.latency.add(response_time)
+            self.histograms[(hour_bucket, api_path, histogram_bucket)] += 1
+
+    def add_columns(self, table):
+        """
+        add для блока, разобранного columnar.parse_block: хэши считаются по уникальным IP и User-Agent,
+        а регистры HyperLogLog, корзины DDSketch и гистограммы всех групп (час, путь) — массивами за раз.
+        """
+        if not table.num_rows:
+            return
+        hours = table['timestamp_utc'].cast(pa.int64()).to_numpy() // 3_600_000_000
+        ip_hashes = _dictionary_hashes(table['ip_client'])
+        ua_hashes = _dictionary_hashes(table['user_agent'])
+        response_times = table['response_time'].to_numpy()
+        histogram_buckets = np.maximum(np.searchsorted(LATENCY_BUCKET_EDGES, response_times, side='right') - 1, 0)
+        positive = response_times > 0
+        gamma_log = math.log((1 + self.relative_accuracy) / (1 - self.relative_accuracy))
+        latency_keys = np.ceil(np.log(response_times[positive]) / gamma_log).astype(np.int64)
+        paths = table['api_path'].combine_chunks()
+        path_names = paths.dictionary.to_pylist()
+        path_indices = paths.indices.to_numpy().astype(np.int64)
+        if self.path_templates:
+            path_names, path_indices = template_indices(path_names, path_indices)
+        path_names.append(ALL_PATHS)
+        for indices, precision in ((path_indices, self.path_precision),
+                                   (np.full(len(path_indices), len(path_names) - 1), self.precision)):
+            groups, inverse = np.unique(hours * len(path_names) + indices, return_inverse=True)
+            inverse = inverse.ravel()
+            count = len(groups)
+            requests = np.bincount(inverse, minlength=count)
+            zeros = np.bincount(inverse[~positive], minlength=count)
+            ips = _hll_registers(ip_hashes, inverse, count, precision)
+            user_agents = _hll_registers(ua_hashes, inverse, count, precision)
+            sketches = []
+            for group, key in enumerate(groups.tolist()):
+                hour, path = divmod(key, len(path_names))
+                bucket = self._bucket((hour, path_names[path]), precision)
+                bucket.requests += int(requests[group])
+                bucket.ips.merge(HyperLogLog(precision, ips[group].tobytes()))
+                bucket.user_agents.merge(HyperLogLog(precision, user_agents[group].tobytes()))
+                bucket.latency.count += int(requests[group])
+                bucket.latency.zero_count += int(zeros[group])
+                sketches.append(bucket.latency)
+            if len(latency_keys):
+                low = int(latency_keys.min())
+                span = int(latency_keys.max()) - low + 1
+                pairs, pair_counts = np.unique(inverse[positive] * span + (latency_keys - low), return_counts=True)
+                for pair, pair_count in zip(pairs.tolist(), pair_counts.tolist()):
+                    group, key = divmod(pair, span)
+                    bins = sketches[group].bins
+                    bins[key + low] = bins.get(key + low, 0) + pair_count
+            buckets_count = len(LATENCY_BUCKET_EDGES)
+            cells, cell_counts = np.unique(inverse * buckets_count + histogram_buckets, return_counts=True)
+            for cell, cell_count in zip(cells.tolist(), cell_counts.tolist()):
+                group, histogram_bucket = divmod(cell, buckets_count)
+                hour, path = divmod(int(groups[group]), len(path_names))
+                self.histograms[(hour, path_names[path], histogram_bucket)] += cell_count
+
+    def defer(self, line_hash, log_data):
+        """Откладывает запись до вставки строки с хэшем line_hash."""
+        self.pending[line_hash] = log_data
+
+    def add_inserted(self, attempted, inserted):
+        """Учитывает отложенные записи строк inserted; остальные хэши attempted отброшены уникальным индексом."""
+        inserted = set(inserted)
+        for hashed in attempted:
+            log_data = self.pending.pop(hashed, None)
+            if log_data is not None and hashed in inserted:
+                self.add(log_data)
+
+    def defer_columns(self, table):
+        """Откладывает блок с колонкой line_hash до вставки его фактов (db.copy_facts)."""
+        if table.num_rows:
+            self.pending_tables.append(table.select(list(SKETCH_COLUMNS)))
+
+    def add_inserted_columns(self, inserted):
+        """Учитывает строки отложенных блоков с хэшами inserted; отложенные блоки вставлены все сразу."""
+        value_set = pa.array(inserted, pa.string())
+        for table in self.pending_tables:
+            self.add_columns(table.filter(pc.is_in(table['line_hash'], value_set=value_set)))
+        self.pending_tables.clear()
+
+    def clear(self):
+        self.buckets.clear()
+        self.histograms.clear()
+
+
+def _hll_registers(hashes, groups, count, precision):
+    """Регистры HyperLogLog групп строк (groups — номер группы строки): массив (count, 2**precision)."""
+    index = (hashes >> np.uint64(64 - precision)).astype(np.intp)
+    rank = (64 - precision) - _bit_length(hashes & np.uint64(_MASK64 >> precision)) + 1
+    registers = np.zeros(count << precision, dtype=np.uint8)
+    np.maximum.at(registers, (groups << precision) + index, rank.astype(np.uint8))
+    return registers.reshape(count, 1 << precision)
+
+
+def _dictionary_hashes(column):
+    """hash64 значений словарной колонки для каждой строки (np.uint64)."""
+    array = column.combine_chunks()
+    hashes = np.fromiter((hash64(value) for value in array.dictionary.to_pylist()), dtype=np.uint64,
+                         count=len(array.dictionary))
+    return hashes[array.indices.to_numpy()]
+
+
+def write_sketches(conn, accumulator):
+    """
+    Сливает скетчи накопителя со строками sketch_hourly и перезаписывает их,
+    гистограммы добавляет к счетчикам latency_histogram.
+    Запись сериализуется advisory-блокировкой, чтобы параллельные загрузки не потеряли слияние.
+    """
+    if not accumulator.buckets:
+        return
+    keys = list(accumulator.buckets)
+    with conn.cursor() as cursor:
+        try:
+            DB_ROUND_TRIPS.inc(5, operation='sketch_upsert')
+            cursor.execute("SELECT pg_advisory_xact_lock(%s)", (SKETCH_LOCK_KEY,))
+            cursor.execute("""
+                SELECT s.hour_bucket, s.api_path, s.requests, s.ip_hll, s.ua_hll, s.latency
+                FROM sketch_hourly s
+                JOIN unnest(%s::bigint[], %s::text[]) AS k(hour_bucket, api_path)
+                  ON s.hour_bucket = k.hour_bucket AND s.api_path = k.api_path
+            """, ([hour for hour, _ in keys], [path for _, path in keys]))
+            for hour_bucket, api_path, *stored in cursor.fetchall():
+                accumulator.buckets[(hour_bucket, api_path)].merge(BucketSketch.from_row(*stored))
+            rows = [bucket.to_row(*key) for key, bucket in accumulator.buckets.items()]
+            extras.execute_values(cursor, """
+                INSERT INTO sketch_hourly (hour_bucket, api_path, requests, ip_hll, ua_hll, latency) VALUES %s
+                ON CONFLICT (hour_bucket, api_path) DO UPDATE SET
+                    requests = EXCLUDED.requests, ip_hll = EXCLUDED.ip_hll,
+                    ua_hll = EXCLUDED.ua_hll, latency = EXCLUDED.latency
+            """, rows, page_size=1000)
+            # Гистограммы аддитивны и сливаются прямо в базе
+            extras.execute_values(cursor, """
+                INSERT INTO latency_histogram (hour_bucket, api_path, bucket, count) VALUES %s
+                ON CONFLICT (hour_bucket, api_path, bucket) DO UPDATE SET
+                    count = latency_histogram.count + EXCLUDED.count
+            """, [(*key, count) for key, count in accumulator.histograms.items()], page_size=5000)
+            conn.commit()
+            logging.debug(f"Скетчи записаны: {len(rows)} строк sketch_hourly, "
+                          f"{len(accumulator.histograms)} корзин latency_histogram")
+        except psycopg2.Error as e:
+            logging.error(f"Ошибка записи скетчей: {e}")
+            conn.rollback()
+            raise
+    accumulator.clear()
+
+
+def top_paths(counts, limit=SKETCH_TOP_PATHS):
+    """Самые частые API-пути по числу запросов (counts — api_path, requests, возможно с нескольких шардов)."""
+    if counts.empty:
+        return []
+    totals = counts.groupby('api_path')['requests'].sum().sort_values(ascending=False)
+    return totals.head(limit).index.tolist()
+
+
+def summarize_sketches(rows):
+    """
+    Сливает строки sketch_hourly (hour_bucket, api_path, requests, ip_hll, ua_hll, latency)
+    и возвращает {'hourly': по часам, 'paths': по API-путям, 'totals': за весь диапазон}.
+    Строки одного часа и пути (например, с разных шардов) сливаются.
+    """
+    totals, paths = {}, {}
+    for hour_bucket, api_path, requests, ip_hll, ua_hll, latency in rows:
+        target = totals if api_path == ALL_PATHS else paths
+        key = hour_bucket if api_path == ALL_PATHS else api_path
+        target.setdefault(key, []).append((requests, ip_hll, ua_hll, latency))
+
+    def _merge(parts):
+        requests = sum(part[0] for part in parts)
+        ips = merge_hll_bytes(part[1] for part in parts)
+        user_agents = merge_hll_bytes(part[2] for part in parts)
+        latency = merge_latency([DDSketch.decode(part[3]) for part in parts])
+        return requests, ips, user_agents, latency
+
+    hourly_rows = []
+    hourly_ips, hourly_uas, hourly_latency = [], [], []
+    for hour_bucket in sorted(totals):
+        requests, ips, user_agents, latency = _merge(totals[hour_bucket])
+        hourly_rows.append({'hour_bucket': hour_bucket, 'requests': requests, **latency_quantiles(*latency)})
+        hourly_ips.append(ips)
+        hourly_uas.append(user_agents)
+        hourly_latency.append(latency)
+    hourly = pd.DataFrame(hourly_rows, columns=['hour_bucket', 'requests', *PERCENTILES])
+    hourly['unique_ips'] = np.rint(hll_estimate(np.stack(hourly_ips))).astype(np.int64) if hourly_ips else []
+    hourly['unique_user_agents'] = np.rint(hll_estimate(np.stack(hourly_uas))).astype(np.int64) if hourly_uas else []
+
+    path_rows = []
+    for api_path, parts in paths.items():
+        requests, ips, _, latency = _merge(parts)
+        path_rows.append({'api_path': api_path, 'requests': requests,
+                          'unique_ips': int(round(float(hll_estimate(ips)))), **latency_quantiles(*latency)})
+    path_frame = pd.DataFrame(path_rows, columns=['api_path', 'requests', 'unique_ips', *PERCENTILES])
+
+    if not hourly_rows:
+        summary = {'requests': 0, 'unique_ips': 0, 'unique_user_agents': 0, **{name: math.nan for name in PERCENTILES}}
+    else:
+        summary = {'requests': int(hourly['requests'].sum()),
+                   'unique_ips': int(round(float(hll_estimate(np.max(hourly_ips, axis=0))))),
+                   'unique_user_agents': int(round(float(hll_estimate(np.max(hourly_uas, axis=0))))),
+                   **latency_quantiles(*merge_latency(hourly_latency))}
+    return {'hourly': hourly, 'paths': path_frame.sort_values('requests', ascending=False, ignore_index=True),
+            'totals': summary}
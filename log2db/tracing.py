@@ -0,0 +1,140 @@
+"""Трассировка колбэков дашборда: спаны, журнал медленных запросов и последние трассы"""
+
+import functools
+import inspect
+import logging
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from log2db.config import DASHBOARD_SLOW_CALLBACK_SECONDS, DASHBOARD_TRACE_BUFFER
+from log2db.metrics import DASHBOARD_CALLBACK_SECONDS, DASHBOARD_SPAN_SECONDS
+
+# Трасса текущего колбэка. Без активной трассы span() и add_span() ничего не делают.
+_current = ContextVar('dashboard_trace', default=None)
+
+# Последние завершенные трассы (кольцевой буфер)
+_recent = deque(maxlen=DASHBOARD_TRACE_BUFFER)
+_lock = threading.Lock()
+
+
+class Trace:
+    """Трасса одного вызова колбэка: параметры, общее время и спаны по этапам."""
+
+    def __init__(self, name, params):
+        self.name = name
+        self.params = params
+        self.started_at = datetime.now(timezone.utc)
+        self.started = time.perf_counter()
+        self.returned = None
+        self.duration = None
+        self.error = None
+        self.spans = []
+        self._depth = 0
+
+    def add_span(self, name, seconds, ended=None):
+        """Добавляет уже замеренный спан длительностью seconds, закончившийся в ended (perf_counter)."""
+        offset = (ended if ended is not None else time.perf_counter()) - self.started - seconds
+        self.spans.append({'name': name, 'depth': self._depth,
+                           'offset': round(offset, 6), 'seconds': round(seconds, 6)})
+
+    @contextmanager
+    def span(self, name):
+        started = time.perf_counter()
+        entry = {'name': name, 'depth': self._depth, 'offset': round(started - self.started, 6), 'seconds': None}
+        self.spans.append(entry)
+        self._depth += 1
+        try:
+            yield
+        finally:
+            self._depth -= 1
+            entry['seconds'] = round(time.perf_counter() - started, 6)
+
+    def mark_returned(self):
+        """Отмечает возврат из колбэка; время после него до finish() — сериализация ответа."""
+        self.returned = time.perf_counter()
+
+    def finish(self):
+        """Завершает трассу: метрики, буфер последних трасс и журнал медленных колбэков."""
+        self.duration = time.perf_counter() - self.started
+        DASHBOARD_CALLBACK_SECONDS.observe(self.duration, callback=self.name)
+        for entry in self.spans:
+            if entry['seconds'] is not None:
+                DASHBOARD_SPAN_SECONDS.observe(entry['seconds'], callback=self.name, span=entry['name'])
+        with _lock:
+            _recent.append(self)
+        if self.duration >= DASHBOARD_SLOW_CALLBACK_SECONDS:
+            breakdown = ', '.join(f"{'>' * s['depth']}{s['name']}={s['seconds']:.3f}"
+                                  for s in self.spans if s['seconds'] is not None)
+            logging.warning(f"Медленный колбэк {self.name}: {self.duration:.3f} с, "
+                            f"параметры: {self.params}, этапы: {breakdown or 'нет'}")
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'started_at': self.started_at.isoformat(),
+            'duration': round(self.duration, 6) if self.duration is not None else None,
+            'params': self.params,
+            'error': self.error,
+            'spans': self.spans,
+        }
+
+
+@contextmanager
+def span(name):
+    """Спан этапа в текущей трассе; без трассы — пустой блок."""
+    trace = _current.get()
+    if trace is None:
+        yield
+        return
+    with trace.span(name):
+        yield
+
+
+def add_span(name, seconds, ended=None):
+    """Добавляет в текущую трассу спан уже замеренной длительности."""
+    trace = _current.get()
+    if trace is not None:
+        trace.add_span(name, seconds, ended)
+
+
+def traced(name, defer=None):
+    """
+    Декоратор трассировки колбэка. Аргументы вызова сохраняются как параметры трассы.
+    defer — необязательная функция, принимающая трассу и возвращающая True,
+    если трассу завершит вызывающая сторона (например, после сериализации HTTP-ответа).
+    Внутри уже идущей трассы вызов записывается как спан.
+    """
+    def decorator(func):
+        signature = inspect.signature(func)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _current.get() is not None:
+                with span(name):
+                    return func(*args, **kwargs)
+            bound = signature.bind_partial(*args, **kwargs)
+            trace = Trace(name, {k: v for k, v in bound.arguments.items() if v is not None})
+            token = _current.set(trace)
+            try:
+                return func(*args, **kwargs)
+            except Exception as e:
+                trace.error = f"{type(e).__name__}: {e}"
+                raise
+            finally:
+                _current.reset(token)
+                trace.mark_returned()
+                if defer is None or not defer(trace):
+                    trace.finish()
+        return wrapper
+    return decorator
+
+
+def slowest_traces(limit=20, name=None):
+    """Самые медленные из последних трасс (по убыванию длительности)."""
+    with _lock:
+        traces = [t for t in _recent if name is None or t.name == name]
+    traces.sort(key=lambda t: t.duration, reverse=True)
+    return [t.to_dict() for t in traces[:limit]]
@@ -0,0 +1,100 @@
+"""Потоковая выгрузка результатов запросов Postgres в Arrow через COPY"""
+
+import os
+import threading
+import time
+import pyarrow as pa
+import pyarrow.csv as pacsv
+from log2db.tracing import add_span
+
+# Строковые значения измерений: повторяются, поэтому храним словарем (в pandas — category)
+DICT_STRING = pa.dictionary(pa.int32(), pa.string())
+
+READ_BLOCK_SIZE = 4 << 20
+
+
+def epoch_us_sql(expr):
+    """SQL-выражение, переводящее timestamptz в микросекунды от эпохи (для выгрузки через COPY)."""
+    return f"(EXTRACT(EPOCH FROM {expr}) * 1000000)::bigint"
+
+
+def copy_query_batches(conn, query, params=None, column_types=None, timestamp_columns=()):
+    """
+    Выполняет запрос через COPY ... TO STDOUT и отдает результат пачками pyarrow.RecordBatch.
+    Текст COPY разбирается векторно CSV-читателем Arrow по мере поступления,
+    без промежуточных кортежей Python. Колонки timestamp_columns должны
+    приходить как микросекунды от эпохи (см. epoch_us_sql) и приводятся к timestamp[us, UTC].
+    """
+    with conn.cursor() as cursor:
+        sql_text = cursor.mogrify(query, params).decode() if params else query
+    copy_sql = f"COPY ({sql_text}) TO STDOUT WITH (FORMAT csv, HEADER true)"
+
+    read_fd, write_fd = os.pipe()
+    errors = []
+
+    def _produce():
+        try:
+            with os.fdopen(write_fd, 'wb') as sink, conn.cursor() as cursor:
+                cursor.copy_expert(copy_sql, sink)
+        except Exception as e:
+            errors.append(e)
+
+    producer = threading.Thread(target=_produce, name='copy-to-arrow', daemon=True)
+    producer.start()
+    try:
+        with os.fdopen(read_fd, 'rb') as source:
+            try:
+                reader = pacsv.open_csv(
+                    source,
+                    read_options=pacsv.ReadOptions(block_size=READ_BLOCK_SIZE, use_threads=False),
+                    convert_options=pacsv.ConvertOptions(
+                        column_types=column_types or {},
+                        # NULL в COPY CSV — только пустое поле без кавычек; 'NA', 'null', 'nan' и т.п. — строки
+                        null_values=[''],
+                        strings_can_be_null=True,
+                        quoted_strings_can_be_null=False,
+                    ),
+                )
+                empty = True
+                for batch in reader:
+                    empty = False
+                    if timestamp_columns:
+                        batch = _cast_timestamps(batch, timestamp_columns)
+                    yield batch
+                if empty:
+                    # Пустой результат: одна пустая пачка, чтобы сохранить схему
+                    batch = pa.RecordBatch.from_pylist([], schema=reader.schema)
+                    yield _cast_timestamps(batch, timestamp_columns) if timestamp_columns else batch
+            except pa.ArrowInvalid:
+                if not errors:
+                    raise
+    finally:
+        producer.join()
+    if errors:
+        raise errors[0]
+
+
+def _cast_timestamps(batch, timestamp_columns):
+    arrays = list(batch.columns)
+    for name in timestamp_columns:
+        index = batch.schema.get_field_index(name)
+        arrays[index] = arrays[index].cast(pa.timestamp('us', tz='UTC'))
+    return pa.RecordBatch.from_arrays(arrays, names=batch.schema.names)
+
+
+def fetch_arrow_table(conn, query, params=None, column_types=None, timestamp_columns=()):
+    """
+    Выполняет запрос через COPY и собирает результат в pyarrow.Table.
+    В трассу дашборда пишутся спаны sql (до первой пачки) и transfer (прием строк).
+    """
+    started = time.perf_counter()
+    first = None
+    batches = []
+    for batch in copy_query_batches(conn, query, params, column_types, timestamp_columns):
+        if first is None:
+            first = time.perf_counter()
+        batches.append(batch)
+    finished = time.perf_counter()
+    add_span('sql', first - started, ended=first)
+    add_span('transfer', finished - first, ended=finished)
+    return pa.Table.from_batches(batches)
@@ -0,0 +1,26 @@
+"""Выбор аналитического бэкенда для дашборда и экспорта"""
+
+import importlib
+from log2db.config import ANALYTICS_BACKEND
+
+# Каждый бэкенд — модуль с функциями connect, export_to_arrow, export_to_dataframe, fetch_logs,
+# dashboard_aggregates, approx_aggregates, latency_histograms, timeseries и time_bounds
+# и кортежем SKETCH_FILTERS — фильтрами, которые применяют approx_aggregates и latency_histograms
+BACKEND_MODULES = {
+    'postgres': 'log_export.export',
+    'duckdb': 'log_export.duckdb_backend',
+    'sharded': 'log_export.sharded_backend',
+}
+
+
+def get_backend(name=None):
+    """Возвращает модуль аналитического бэкенда по имени (по умолчанию ANALYTICS_BACKEND)."""
+    name = (name or ANALYTICS_BACKEND).lower()
+    if name not in BACKEND_MODULES:
+        raise ValueError(f"Неизвестный аналитический бэкенд: {name}")
+    return importlib.import_module(BACKEND_MODULES[name])
+
+
+def ignored_sketch_filters(backend, filters):
+    """Заданные фильтры (normalize_filters), которые скетчи бэкенда не применяют."""
+    return [name for name, value in filters.items() if value is not None and name not in backend.SKETCH_FILTERS]
@@ -0,0 +1,117 @@
+"""Постраничный просмотр записей логов по ключу (timestamp_utc, log_id) без OFFSET"""
+
+import json
+from datetime import datetime, timedelta, timezone
+from log2db.config import LOGS_FETCH_ROWS
+from log2db.tracing import span
+from log_export.arrow_fetch import epoch_us_sql
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+# Колонки записи в ответе /logs
+LOG_RECORD_COLUMNS = ('log_id', 'timestamp_utc', 'ip_address', 'request_type', 'api_path', 'protocol',
+                      'status_code', 'bytes_sent', 'referrer_url', 'user_agent', 'response_time')
+
+# Время — из local_logs (не из dim_time): по нему построены составные индексы (..., timestamp_utc, log_id)
+_KEY = "(l.timestamp_utc, l.log_id)"
+_KEY_VALUE = "(TIMESTAMPTZ 'epoch' + %s * INTERVAL '1 microsecond', %s)"
+
+
+def encode_cursor(timestamp_us, log_id):
+    """Курсор следующей страницы: ключ последней отданной записи."""
+    return f"{timestamp_us}_{log_id}"
+
+
+def decode_cursor(cursor):
+    """(микросекунды от эпохи, log_id) из курсора encode_cursor; ValueError, если курсор испорчен."""
+    try:
+        timestamp_us, log_id = cursor.split('_')
+        return int(timestamp_us), int(log_id)
+    except (AttributeError, ValueError):
+        raise ValueError(f"Некорректный курсор страницы: {cursor}")
+
+
+def _escape_like(value):
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def page_query(filters, path_prefix=None, ip=None, after=None, limit=100, descending=False,
+               api_ids=None, referrer_ids=None):
+    """
+    Запрос страницы записей: условия на факты задаются через id измерений (значения измерений
+    разрешаются подзапросами до сканирования фактов), страница выбирается по ключу
+    (timestamp_utc, log_id) после курсора after и лишь затем соединяется с измерениями.
+    filters — normalize_filters (start_date, end_date, status_code, request_type); api_ids и referrer_ids —
+    уже разрешенные id измерений (log_export.search). Возвращает (запрос, параметры).
+    """
+    conditions, params = [], []
+    if filters.get('start_date') is not None:
+        conditions.append("l.timestamp_utc >= %s")
+        params.append(filters['start_date'].to_pydatetime())
+    if filters.get('end_date') is not None:
+        conditions.append("l.timestamp_utc <= %s")
+        params.append(filters['end_date'].to_pydatetime())
+    if filters.get('status_code') is not None:
+        conditions.append("l.status_code = %s")
+        params.append(filters['status_code'])
+    if filters.get('request_type') is not None:
+        conditions.append("l.request_type_id = (SELECT request_type_id FROM dim_request_type WHERE request_type = %s)")
+        params.append(filters['request_type'])
+    if ip:
+        conditions.append("l.ip_client_id = (SELECT ip_client_id FROM dim_ip_client WHERE ip_address = %s)")
+        params.append(ip)
+    if path_prefix:
+        conditions.append("l.api_id = ANY(ARRAY(SELECT api_id FROM dim_api WHERE api_path LIKE %s))")
+        params.append(_escape_like(path_prefix) + '%')
+    if api_ids is not None:
+        conditions.append("l.api_id = ANY(%s)")
+        params.append(list(api_ids))
+    if referrer_ids is not None:
+        conditions.append("l.referrer_id = ANY(%s)")
+        params.append(list(referrer_ids))
+    if after is not None:
+        conditions.append(f"{_KEY} {'<' if descending else '>'} {_KEY_VALUE}")
+        params.extend(after)
+    direction = 'DESC' if descending else 'ASC'
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    query = f"""
+        SELECT l.log_id, {epoch_us_sql('l.timestamp_utc')}, ip.ip_address, rt.request_type, api.api_path,
+               p.protocol, l.status_code, l.bytes_sent, r.referrer_url, ua.user_agent, l.response_time
+        FROM (
+            SELECT * FROM local_logs l {where}
+            ORDER BY l.timestamp_utc {direction}, l.log_id {direction}
+            LIMIT %s
+        ) l
+        JOIN dim_ip_client ip ON l.ip_client_id = ip.ip_client_id
+        JOIN dim_request_type rt ON l.request_type_id = rt.request_type_id
+        JOIN dim_api api ON l.api_id = api.api_id
+        JOIN dim_protocol p ON l.protocol_id = p.protocol_id
+        JOIN dim_user_agent ua ON l.user_agent_id = ua.user_agent_id
+        LEFT JOIN dim_referrer r ON l.referrer_id = r.referrer_id
+        ORDER BY l.timestamp_utc {direction}, l.log_id {direction}
+    """
+    return query, (*params, limit)
+
+
+def iter_log_lines(conn, filters, path_prefix=None, ip=None, after=None, limit=100, descending=False,
+                   fetch_rows=LOGS_FETCH_ROWS, api_ids=None, referrer_ids=None):
+    """
+    Страница записей в виде JSON Lines: записи читаются серверным курсором по fetch_rows строк
+    и отдаются по мере чтения. Последняя строка — {"next_cursor": ...}: курсор следующей страницы
+    или null, если записей больше нет.
+    """
+    query, params = page_query(filters, path_prefix, ip, after, limit, descending, api_ids, referrer_ids)
+    count, last_key = 0, None
+    with conn.cursor(name='logs_page') as cursor:
+        cursor.itersize = fetch_rows
+        with span('query:logs_page'):
+            cursor.execute(query, params)
+        for row in cursor:
+            record = dict(zip(LOG_RECORD_COLUMNS, row))
+            timestamp_us = record['timestamp_utc']
+            record['timestamp_utc'] = (EPOCH + timedelta(microseconds=timestamp_us)).isoformat()
+            count += 1
+            last_key = (timestamp_us, record['log_id'])
+            yield json.dumps(record, ensure_ascii=False) + '\n'
+    next_cursor = encode_cursor(*last_key) if count == limit else None
+    yield json.dumps({'next_cursor': next_cursor}) + '\n'
@@ -0,0 +1,73 @@
+"""Компактное представление строк логов в pandas"""
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+from pandas.api.types import union_categoricals
+
+# Компоненты времени выводятся из timestamp_utc и в компактном виде не хранятся
+TIME_PART_COLUMNS = ['year', 'month', 'day', 'hour', 'minute', 'second', 'weekday']
+
+
+def ids_to_numpy(column):
+    """Переводит колонку идентификаторов Arrow в int64 numpy, NULL — в -1."""
+    return pc.fill_null(column, -1).to_numpy().astype(np.int64, copy=False)
+
+
+def categorical_from_ids(ids, dim_ids, values):
+    """
+    Строит pandas.Categorical по идентификаторам измерения:
+    dim_ids — отсортированные id строк измерения, values — значения в том же порядке.
+    Отсутствующие и NULL id становятся NaN.
+    """
+    dim_values = pd.Categorical(values)
+    if len(dim_ids) == 0:
+        return pd.Categorical.from_codes(np.full(len(ids), -1, dtype=np.int8), categories=dim_values.categories)
+    positions = np.searchsorted(dim_ids, ids).clip(0, len(dim_ids) - 1)
+    codes = dim_values.codes[positions]
+    codes[(ids < 0) | (dim_ids[positions] != ids)] = -1
+    return pd.Categorical.from_codes(codes, categories=dim_values.categories)
+
+
+def downcast_integers(df):
+    """Сужает целочисленные колонки до минимально достаточного типа."""
+    for name in df.columns:
+        if pd.api.types.is_integer_dtype(df[name]) and not isinstance(df[name].dtype, pd.CategoricalDtype):
+            kind = 'unsigned' if len(df) and df[name].min() >= 0 else 'integer'
+            df[name] = pd.to_numeric(df[name], downcast=kind)
+    return df
+
+
+def compact_logs_frame(table):
+    """
+    Компактный DataFrame из выгрузки логов (pyarrow.Table):
+    строки — category, целые — минимальных типов, компоненты времени отброшены.
+    """
+    table = table.drop_columns([name for name in TIME_PART_COLUMNS if name in table.column_names])
+    for index, field in enumerate(table.schema):
+        if pa.types.is_string(field.type) or pa.types.is_large_string(field.type):
+            table = table.set_column(index, field.name, table[field.name].dictionary_encode())
+    return downcast_integers(table.to_pandas())
+
+
+def concat_compact_frames(frames):
+    """
+    Объединяет компактные DataFrame из нескольких источников (например, шардов):
+    категории колонок объединяются, целые сужаются заново.
+    """
+    frames = [frame for frame in frames if frame is not None]
+    if len(frames) == 1:
+        return frames[0]
+    columns = {}
+    for name in frames[0].columns:
+        if isinstance(frames[0][name].dtype, pd.CategoricalDtype):
+            columns[name] = pd.Series(union_categoricals([frame[name] for frame in frames], ignore_order=True))
+        else:
+            columns[name] = pd.concat([frame[name] for frame in frames], ignore_index=True)
+    return downcast_integers(pd.DataFrame(columns))
+
+
+def memory_usage_mb(df):
+    """Полный объем памяти DataFrame в мегабайтах."""
+    return df.memory_usage(deep=True).sum() / 2 ** 20
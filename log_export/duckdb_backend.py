@@ -0,0 +1,198 @@
+"""Аналитический бэкенд на встроенной DuckDB (файл базы или каталог Parquet)"""
+
+import os
+import logging
+from contextlib import contextmanager
+import duckdb
+import pandas as pd
+import pyarrow as pa
+from log2db.config import DUCKDB_PATH, DUCKDB_PARQUET_DIR, SKETCH_TOP_PATHS
+from log_export.compact import compact_logs_frame
+from log2db.tracing import span
+from log_export.queries import build_where, dashboard_queries, histogram_hours, timeseries_query
+from log2db.sketches import ALL_PATHS, latency_bucket_sql
+
+# Колонки совпадают с export_to_dataframe Postgres-бэкенда
+EXPORT_COLUMNS = """
+    {log_id} AS log_id,
+    ip_address, user_agent, browser, os, device_type,
+    timestamp_utc,
+    EXTRACT(YEAR FROM timestamp_utc AT TIME ZONE 'UTC')::int AS year,
+    EXTRACT(MONTH FROM timestamp_utc AT TIME ZONE 'UTC')::int AS month,
+    EXTRACT(DAY FROM timestamp_utc AT TIME ZONE 'UTC')::int AS day,
+    EXTRACT(HOUR FROM timestamp_utc AT TIME ZONE 'UTC')::int AS hour,
+    EXTRACT(MINUTE FROM timestamp_utc AT TIME ZONE 'UTC')::int AS minute,
+    EXTRACT(SECOND FROM timestamp_utc AT TIME ZONE 'UTC')::int AS second,
+    (EXTRACT(ISODOW FROM timestamp_utc AT TIME ZONE 'UTC')::int - 1) AS weekday,
+    request_type, api_path, protocol, status_code, bytes_sent, referrer_url, response_time
+"""
+
+COLUMNS = {
+    'ts': 'timestamp_utc',
+    'epoch': 'epoch(timestamp_utc)',
+    'hour_bucket': 'epoch_us(timestamp_utc) // 3600000000',
+    'status_code': 'status_code',
+    'request_type': 'request_type',
+    'api_path': 'api_path',
+    'response_time': 'response_time',
+}
+
+SOURCE = "FROM logs"
+
+# Приближенные уникальные значения и перцентили (встроенные HyperLogLog и t-digest DuckDB)
+APPROX_COLUMNS = """
+    COUNT(*) AS requests,
+    approx_count_distinct(ip_address) AS unique_ips,
+    approx_count_distinct(user_agent) AS unique_user_agents,
+    CAST(approx_quantile(response_time, 0.5) AS DOUBLE) AS p50,
+    CAST(approx_quantile(response_time, 0.95) AS DOUBLE) AS p95,
+    CAST(approx_quantile(response_time, 0.99) AS DOUBLE) AS p99
+"""
+
+# Скетчи строятся при запросе по строкам озера, поэтому применяются все фильтры дашборда
+SKETCH_FILTERS = ('start_date', 'end_date', 'status_code', 'request_type')
+
+CATEGORICAL_COLUMNS = ('ip_address', 'user_agent', 'browser', 'os', 'device_type',
+                       'request_type', 'api_path', 'protocol', 'referrer_url')
+
+
+@contextmanager
+def connect(path=None, parquet_dir=None):
+    """
+    Открывает DuckDB. Данные доступны как отношение logs:
+      - представление над read_parquet, если задан каталог Parquet-озера
+      - таблица или представление logs в файле базы иначе
+    """
+    parquet_dir = DUCKDB_PARQUET_DIR if parquet_dir is None else parquet_dir
+    if parquet_dir:
+        conn = duckdb.connect()
+        pattern = os.path.join(parquet_dir, '**', '*.parquet').replace("'", "''")
+        conn.execute(f"""
+            CREATE VIEW logs AS
+            SELECT * FROM read_parquet('{pattern}', hive_partitioning = true, union_by_name = true)
+        """)
+    else:
+        conn = duckdb.connect(path or DUCKDB_PATH, read_only=True)
+    try:
+        yield conn
+    finally:
+        conn.close()
+
+
+def fetch_arrow(conn, query, params=None):
+    """Выполняет запрос и возвращает результат как pyarrow.Table (спаны sql и transfer)."""
+    with span('sql'):
+        cursor = conn.execute(query, params or [])
+    with span('transfer'):
+        result = cursor.arrow()
+        if isinstance(result, pa.RecordBatchReader):
+            result = result.read_all()
+    return result
+
+
+def _export_query(conn, where=""):
+    columns = {row[0] for row in conn.execute("DESCRIBE logs").fetchall()}
+    log_id = 'log_id' if 'log_id' in columns else 'CAST(NULL AS BIGINT)'
+    return f"SELECT {EXPORT_COLUMNS.format(log_id=log_id)} {SOURCE} {where}"
+
+
+def export_to_arrow(conn, where="", params=None):
+    """Извлекает данные из DuckDB в pyarrow.Table, строки измерений — словарями"""
+    table = fetch_arrow(conn, _export_query(conn, where), params)
+    for name in CATEGORICAL_COLUMNS:
+        index = table.schema.get_field_index(name)
+        table = table.set_column(index, name, table[name].dictionary_encode())
+    return table
+
+
+def export_to_dataframe(conn, where="", params=None):
+    """Извлекает данные из DuckDB в pandas DataFrame"""
+    return export_to_arrow(conn, where, params).to_pandas()
+
+
+def fetch_logs(conn, filters):
+    """Извлекает записи логов с фильтрацией на стороне DuckDB в компактном виде"""
+    where, params = build_where(filters, COLUMNS, placeholder='?')
+    table = fetch_arrow(conn, _export_query(conn, where), params)
+    with span('frame'):
+        return compact_logs_frame(table)
+
+
+def dashboard_aggregates(conn, filters):
+    """Считает частичные агрегаты для графиков дашборда в DuckDB"""
+    where, params = build_where(filters, COLUMNS, placeholder='?')
+    logging.debug(f"Агрегаты дашборда в DuckDB с фильтром: {where or 'без фильтра'}")
+    aggregates = {}
+    for name, query in dashboard_queries(SOURCE, COLUMNS, where).items():
+        with span(f'query:{name}'):
+            table = fetch_arrow(conn, query, params)
+            with span('frame'):
+                aggregates[name] = table.to_pandas()
+    return aggregates
+
+
+def approx_aggregates(conn, filters):
+    """
+    Уникальные посетители и перцентили времени ответа в DuckDB.
+    Скетчи строятся при запросе по данным озера, поэтому применяются все фильтры.
+    """
+    where, params = build_where(filters, COLUMNS, placeholder='?')
+    queries = {
+        'hourly': f"SELECT {COLUMNS['hour_bucket']} AS hour_bucket, {APPROX_COLUMNS} {SOURCE} {where} GROUP BY 1 ORDER BY 1",
+        'paths': f"""
+            SELECT api_path, {APPROX_COLUMNS} {SOURCE} {where}
+            GROUP BY 1 ORDER BY requests DESC LIMIT {int(SKETCH_TOP_PATHS)}
+        """,
+        'totals': f"SELECT {APPROX_COLUMNS} {SOURCE} {where}",
+    }
+    approx = {}
+    for name, query in queries.items():
+        with span(f'query:{name}'):
+            table = fetch_arrow(conn, query, params)
+            with span('frame'):
+                approx[name] = table.to_pandas()
+    approx['totals'] = approx['totals'].to_dict('records')[0]
+    return approx
+
+
+def latency_histograms(conn, filters):
+    """
+    Гистограммы времени ответа в DuckDB в том же виде, что у Postgres-бэкенда:
+    по всем путям ('*') и по самым частым путям, с учетом всех фильтров.
+    """
+    where, params = build_where(filters, COLUMNS, placeholder='?')
+    hours = histogram_hours(filters)
+    path_condition = f"{where} {'AND' if where else 'WHERE'} api_path IN (SELECT api_path {SOURCE} {where} GROUP BY 1 ORDER BY COUNT(*) DESC LIMIT {int(SKETCH_TOP_PATHS)})"
+    query = f"""
+        SELECT {COLUMNS['hour_bucket']} // {hours} * {hours} AS hour_bucket, '{ALL_PATHS}' AS api_path,
+               {latency_bucket_sql('response_time')} AS bucket, COUNT(*) AS count
+        {SOURCE} {where}
+        GROUP BY 1, 3
+        UNION ALL
+        SELECT {COLUMNS['hour_bucket']} // {hours} * {hours} AS hour_bucket, api_path,
+               {latency_bucket_sql('response_time')} AS bucket, COUNT(*) AS count
+        {SOURCE} {path_condition}
+        GROUP BY 1, 2, 3
+    """
+    with span('query:latency_histogram'):
+        table = fetch_arrow(conn, query, params * 3)
+        with span('frame'):
+            return table.to_pandas()
+
+
+def timeseries(conn, filters, bucket_seconds):
+    """Частичные агрегаты временного ряда по корзинам bucket_seconds секунд в DuckDB"""
+    where, params = build_where(filters, COLUMNS, placeholder='?')
+    table = fetch_arrow(conn, timeseries_query(SOURCE, COLUMNS, where, bucket_seconds), params)
+    with span('frame'):
+        return table.to_pandas()
+
+
+def time_bounds(conn, filters):
+    """Время первой и последней записи под фильтром (pd.Timestamp в UTC) или (None, None)"""
+    where, params = build_where(filters, COLUMNS, placeholder='?')
+    with span('sql'):
+        first, last = conn.execute(f"SELECT MIN(timestamp_utc), MAX(timestamp_utc) {SOURCE} {where}", params).fetchone()
+    if first is None:
+        return None, None
+    return pd.Timestamp(first).tz_convert('UTC'), pd.Timestamp(last).tz_convert('UTC')
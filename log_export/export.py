@@ -1,13 +1,143 @@
 import os
+import asyncio
 import logging
-import psycopg2
+import numpy as np
+from contextlib import contextmanager
+import pyarrow as pa
+import pyarrow.parquet as pq
+from log2db import async_db
+from log2db.config import EXPORT_DIR, ASYNC_DB_ENABLED, ANALYTICS_BACKEND, DATABASE_REPLICAS
+from log2db.raw_archive import block_query, read_lines
+from log2db.db import fact_time_source
+from log2db.replicas import read_connection
 import pandas as pd
-from log2db.config import DATABASE_CONFIG, EXPORT_DIR
+from log_export.arrow_fetch import DICT_STRING, epoch_us_sql, fetch_arrow_table
+from log_export.compact import categorical_from_ids, downcast_integers, ids_to_numpy
+from log_export.queries import build_where, dashboard_queries, histogram_hours, timeseries_query
+from log2db.sketches import ALL_PATHS, summarize_sketches, top_paths
+from log2db.tracing import span
 
+# Скетчи sketch_hourly и latency_histogram хранятся по часам и API-путям, без статус-кода и типа запроса
+SKETCH_FILTERS = ('start_date', 'end_date')
 
-def export_to_dataframe(conn):
-    """Извлекает данные из базы данных в pandas DataFrame"""
-    query = """
+# Типы колонок выгрузки в Arrow
+EXPORT_COLUMN_TYPES = {
+    'log_id': pa.int64(),
+    'ip_address': DICT_STRING,
+    'user_agent': DICT_STRING,
+    'browser': DICT_STRING,
+    'os': DICT_STRING,
+    'device_type': DICT_STRING,
+    'timestamp_utc': pa.int64(),
+    'year': pa.int16(),
+    'month': pa.int8(),
+    'day': pa.int8(),
+    'hour': pa.int8(),
+    'minute': pa.int8(),
+    'second': pa.int8(),
+    'weekday': pa.int8(),
+    'request_type': DICT_STRING,
+    'api_path': DICT_STRING,
+    'protocol': DICT_STRING,
+    'status_code': pa.int16(),
+    'bytes_sent': pa.int64(),
+    'referrer_url': DICT_STRING,
+    'response_time': pa.int32(),
+}
+
+# Типы колонок фактов для компактной выгрузки дашборда
+DASHBOARD_FACT_TYPES = {
+    'log_id': pa.int64(),
+    'ip_client_id': pa.int64(),
+    'user_agent_id': pa.int64(),
+    'timestamp_utc': pa.int64(),
+    'request_type_id': pa.int64(),
+    'api_id': pa.int64(),
+    'protocol_id': pa.int64(),
+    'status_code': pa.int16(),
+    'bytes_sent': pa.int64(),
+    'referrer_id': pa.int64(),
+    'response_time': pa.int32(),
+}
+
+# Порядок колонок компактной выгрузки (как в export_to_dataframe, без компонент времени)
+COMPACT_LOG_COLUMNS = [
+    'log_id', 'ip_address', 'user_agent', 'browser', 'os', 'device_type', 'timestamp_utc',
+    'request_type', 'api_path', 'protocol', 'status_code', 'bytes_sent', 'referrer_url', 'response_time',
+]
+
+# Колонка id факта -> (таблица измерения, колонки значений)
+DASHBOARD_DIMENSIONS = {
+    'ip_client_id': ('dim_ip_client', ['ip_address']),
+    'user_agent_id': ('dim_user_agent', ['user_agent', 'browser', 'os', 'device_type']),
+    'request_type_id': ('dim_request_type', ['request_type']),
+    'api_id': ('dim_api', ['api_path']),
+    'protocol_id': ('dim_protocol', ['protocol']),
+    'referrer_id': ('dim_referrer', ['referrer_url']),
+}
+
+# Источник фактов для агрегатов дашборда в схеме "звезда" Postgres.
+# Пути группируются по шаблону (dim_api_template), у фактов без шаблона — по исходному пути.
+# LEFT JOIN по первичному ключу планировщик отбрасывает в запросах, не использующих его колонки
+FACT_SOURCE = """
+    FROM local_logs l
+    JOIN dim_request_type rt ON l.request_type_id = rt.request_type_id
+    JOIN dim_api api ON l.api_id = api.api_id
+    LEFT JOIN dim_api_template tpl ON l.api_template_id = tpl.api_template_id
+    LEFT JOIN dim_ip_client ip ON l.ip_client_id = ip.ip_client_id
+    {time_join}
+"""
+
+# Типы колонок частичных агрегатов дашборда
+AGGREGATE_COLUMN_TYPES = {
+    'hour_bucket': pa.int64(),
+    'count': pa.int64(),
+    'status_code': pa.int16(),
+    'request_type': pa.string(),
+    'api_path': pa.string(),
+    'country_code': pa.string(),
+    'response_time_sum': pa.float64(),
+    'response_time_count': pa.int64(),
+}
+
+# Типы колонок частичных агрегатов временного ряда
+TIMESERIES_COLUMN_TYPES = {
+    'bucket': pa.int64(),
+    'count': pa.int64(),
+    'errors': pa.int64(),
+    'response_time_sum': pa.float64(),
+}
+
+
+@contextmanager
+def connect():
+    """
+    Открывает соединение с Postgres для чтения и освобождает его по выходу из блока.
+    Если заданы реплики (DATABASE_REPLICAS), чтение идет с них, не нагружая запись.
+    """
+    with read_connection() as conn:
+        yield conn
+
+
+def _dashboard_columns():
+    ts_expr, time_join = fact_time_source()
+    columns = {
+        'ts': ts_expr,
+        'epoch': f'EXTRACT(EPOCH FROM {ts_expr})',
+        'hour_bucket': f'FLOOR(EXTRACT(EPOCH FROM {ts_expr}) / 3600)::bigint',
+        'status_code': 'l.status_code',
+        'request_type': 'rt.request_type',
+        'api_path': 'COALESCE(tpl.api_template, api.api_path)',
+        'country_code': 'ip.country_code',
+        'response_time': 'l.response_time',
+    }
+    return FACT_SOURCE.format(time_join=time_join), columns
+
+
+def export_query(where="", timestamp_sql=epoch_us_sql):
+    """Запрос полной выгрузки логов с измерениями; timestamp_sql(выражение) задает вид колонки timestamp_utc."""
+    ts_expr, time_join = fact_time_source()
+    return f"""
     SELECT
         l.log_id,
         ip.ip_address,
@@ -15,8 +145,14 @@ def export_to_dataframe(conn):
         ua.browser,
         ua.os,
         ua.device_type,
-        t.timestamp_utc,
-        t.year, t.month, t.day, t.hour, t.minute, t.second, t.weekday,
+        {timestamp_sql(ts_expr)} AS timestamp_utc,
+        EXTRACT(YEAR FROM {ts_expr} AT TIME ZONE 'UTC')::int AS year,
+        EXTRACT(MONTH FROM {ts_expr} AT TIME ZONE 'UTC')::int AS month,
+        EXTRACT(DAY FROM {ts_expr} AT TIME ZONE 'UTC')::int AS day,
+        EXTRACT(HOUR FROM {ts_expr} AT TIME ZONE 'UTC')::int AS hour,
+        EXTRACT(MINUTE FROM {ts_expr} AT TIME ZONE 'UTC')::int AS minute,
+        FLOOR(EXTRACT(SECOND FROM {ts_expr} AT TIME ZONE 'UTC'))::int AS second,
+        (EXTRACT(ISODOW FROM {ts_expr} AT TIME ZONE 'UTC')::int - 1) AS weekday,
         rt.request_type,
         api.api_path,
         proto.protocol,
@@ -27,14 +163,201 @@ def export_to_dataframe(conn):
     FROM local_logs l
     JOIN dim_ip_client ip ON l.ip_client_id = ip.ip_client_id
     JOIN dim_user_agent ua ON l.user_agent_id = ua.user_agent_id
-    JOIN dim_time t ON l.time_id = t.time_id
+    {time_join}
     JOIN dim_request_type rt ON l.request_type_id = rt.request_type_id
     JOIN dim_api api ON l.api_id = api.api_id
     JOIN dim_protocol proto ON l.protocol_id = proto.protocol_id
     LEFT JOIN dim_referrer ref ON l.referrer_id = ref.referrer_id
+    {where}
+    """
+
+
+def export_to_arrow(conn, where="", params=None):
+    """
+    Извлекает данные из базы данных в pyarrow.Table через COPY,
+    строки измерений — словарями (category в pandas).
+    """
+    return fetch_arrow_table(conn, export_query(where), params, EXPORT_COLUMN_TYPES, timestamp_columns=('timestamp_utc',))
+
+
+def export_to_dataframe(conn, where="", params=None):
+    """Извлекает данные из базы данных в pandas DataFrame"""
+    return export_to_arrow(conn, where, params).to_pandas()
+
+
+def fetch_logs(conn, filters):
+    """
+    Извлекает записи логов с фильтрацией на стороне БД в компактном виде:
+    из фактов берутся только id измерений, строки подтягиваются по уникальным id
+    и раскладываются в category; компоненты времени не выгружаются.
+    """
+    source, columns = _dashboard_columns()
+    where, params = build_where(filters, columns)
+    query = f"""
+        SELECT l.log_id, l.ip_client_id, l.user_agent_id, {epoch_us_sql(columns['ts'])} AS timestamp_utc,
+               l.request_type_id, l.api_id, l.protocol_id, l.status_code, l.bytes_sent,
+               l.referrer_id, l.response_time
+        {source} {where}
+    """
+    facts = fetch_arrow_table(conn, query, params, DASHBOARD_FACT_TYPES, timestamp_columns=('timestamp_utc',))
+
+    data = {'log_id': facts['log_id'].to_numpy()}
+    for id_column, (table, value_columns) in DASHBOARD_DIMENSIONS.items():
+        ids = ids_to_numpy(facts[id_column])
+        dim_ids = np.unique(ids[ids >= 0])
+        id_name = f'{table[4:]}_id'
+        with span(f'dimension:{table}'):
+            dim = fetch_arrow_table(
+                conn,
+                f"SELECT {id_name}, {', '.join(value_columns)} FROM {table} WHERE {id_name} = ANY(%s) ORDER BY {id_name}",
+                (dim_ids.tolist(),),
+                {id_name: pa.int64(), **{name: pa.string() for name in value_columns}},
+            )
+            with span('frame'):
+                sorted_ids = ids_to_numpy(dim[id_name])
+                for name in value_columns:
+                    data[name] = categorical_from_ids(ids, sorted_ids, dim[name].to_numpy(zero_copy_only=False))
+    with span('frame'):
+        data['timestamp_utc'] = facts['timestamp_utc'].to_pandas()
+        for name in ('status_code', 'bytes_sent', 'response_time'):
+            data[name] = facts[name].to_numpy(zero_copy_only=False)
+        return downcast_integers(pd.DataFrame({name: data[name] for name in COMPACT_LOG_COLUMNS}))
+
+
+def dashboard_aggregates(conn, filters):
+    """Считает частичные агрегаты для графиков дашборда на стороне БД"""
+    source, columns = _dashboard_columns()
+    where, params = build_where(filters, columns)
+    aggregates = {}
+    for name, query in dashboard_queries(source, columns, where).items():
+        with span(f'query:{name}'):
+            table = fetch_arrow_table(conn, query, params, AGGREGATE_COLUMN_TYPES)
+            with span('frame'):
+                aggregates[name] = table.to_pandas()
+    return aggregates
+
+
+def timeseries(conn, filters, bucket_seconds):
+    """Частичные агрегаты временного ряда по корзинам bucket_seconds секунд (см. timeseries_query)"""
+    source, columns = _dashboard_columns()
+    where, params = build_where(filters, columns)
+    table = fetch_arrow_table(conn, timeseries_query(source, columns, where, bucket_seconds), params,
+                              TIMESERIES_COLUMN_TYPES)
+    with span('frame'):
+        return table.to_pandas()
+
+
+def time_bounds(conn, filters):
+    """Время первой и последней записи под фильтром (pd.Timestamp в UTC) или (None, None)"""
+    source, columns = _dashboard_columns()
+    where, params = build_where(filters, columns)
+    with span('sql'), conn.cursor() as cursor:
+        cursor.execute(f"SELECT MIN({columns['ts']}), MAX({columns['ts']}) {source} {where}", params)
+        first, last = cursor.fetchone()
+    if first is None:
+        return None, None
+    return pd.Timestamp(first).tz_convert('UTC'), pd.Timestamp(last).tz_convert('UTC')
+
+
+def fetch_raw_lines(conn, filters, log_ids=None, after_id=0, limit=1000):
+    """
+    Исходные строки фактов под фильтром дашборда (или с log_id из log_ids) из архива строк (log2db.raw_archive):
+    log_id выбираются по возрастанию начиная после after_id, распаковываются только кадры архива с этими log_id.
+    Возвращает (строки [{'log_id', 'line'}], последний просмотренный log_id или None, число фактов без строки в архиве).
+    """
+    source, columns = _dashboard_columns()
+    where, params = build_where(filters, columns)
+    conditions = [where[len('WHERE '):]] if where else []
+    conditions.append("l.log_id > %s")
+    params.append(after_id)
+    if log_ids is not None:
+        conditions.append("l.log_id = ANY(%s)")
+        params.append(list(log_ids))
+    with conn.cursor() as cursor:
+        with span('query:raw_log_ids'):
+            cursor.execute(f"SELECT l.log_id {source} WHERE {' AND '.join(conditions)} ORDER BY l.log_id LIMIT %s",
+                           (*params, limit))
+            selected = [row[0] for row in cursor.fetchall()]
+        if not selected:
+            return [], None, 0
+        with span('query:raw_blocks'):
+            cursor.execute(*block_query(selected))
+            blocks = cursor.fetchall()
+    with span('decompress'):
+        found = read_lines(blocks, selected)
+    lines = [{'log_id': log_id, 'line': found[log_id]} for log_id in selected if log_id in found]
+    return lines, selected[-1], len(selected) - len(lines)
+
+
+def _sketch_hours(filters):
+    """Диапазон номеров часов sketch_hourly для фильтра дат (None — без границы)."""
+    start, end = filters.get('start_date'), filters.get('end_date')
+    return (int(start.timestamp()) // 3600 if start is not None else None,
+            int(end.timestamp()) // 3600 if end is not None else None)
+
+
+def sketch_path_counts(conn, filters):
+    """Число запросов по API-путям из sketch_hourly за диапазон дат"""
+    first, last = _sketch_hours(filters)
+    with span('sql'), conn.cursor() as cursor:
+        cursor.execute("""
+            SELECT api_path, SUM(requests)::bigint FROM sketch_hourly
+            WHERE api_path <> %s
+              AND (%s::bigint IS NULL OR hour_bucket >= %s) AND (%s::bigint IS NULL OR hour_bucket <= %s)
+            GROUP BY api_path
+        """, (ALL_PATHS, first, first, last, last))
+        return pd.DataFrame(cursor.fetchall(), columns=['api_path', 'requests'])
+
+
+def load_sketches(conn, filters, paths):
+    """Строки sketch_hourly за диапазон дат: по всем путям и по путям из paths"""
+    first, last = _sketch_hours(filters)
+    with span('sql'), conn.cursor() as cursor:
+        cursor.execute("""
+            SELECT hour_bucket, api_path, requests, ip_hll, ua_hll, latency FROM sketch_hourly
+            WHERE (api_path = %s OR api_path = ANY(%s))
+              AND (%s::bigint IS NULL OR hour_bucket >= %s) AND (%s::bigint IS NULL OR hour_bucket <= %s)
+        """, (ALL_PATHS, list(paths), first, first, last, last))
+        return cursor.fetchall()
+
+
+def approx_aggregates(conn, filters):
+    """
+    Уникальные посетители и перцентили времени ответа по скетчам sketch_hourly,
+    слитым за диапазон дат (с точностью до часа). Фильтры статуса и типа запроса
+    к скетчам не применяются (SKETCH_FILTERS): скетчи хранятся только по часам и путям.
     """
-    df = pd.read_sql_query(query, conn)
-    return df
+    if filters.get('status_code') is not None or filters.get('request_type') is not None:
+        logging.debug("Скетчи строятся без фильтров статус-кода и типа запроса")
+    with span('query:sketch_paths'):
+        paths = top_paths(sketch_path_counts(conn, filters))
+    with span('query:sketches'):
+        rows = load_sketches(conn, filters, paths)
+    with span('merge'):
+        return summarize_sketches(rows)
+
+
+def latency_histograms(conn, filters, paths=None):
+    """
+    Частичные гистограммы времени ответа из latency_histogram: (hour_bucket, api_path, bucket, count),
+    где hour_bucket — начало временной корзины (час или сутки, см. histogram_hours),
+    api_path '*' — все пути, остальные — самые частые пути (или пути из paths).
+    Как и скетчи, строятся только с фильтром дат (SKETCH_FILTERS).
+    """
+    first, last = _sketch_hours(filters)
+    hours = histogram_hours(filters)
+    if paths is None:
+        with span('query:sketch_paths'):
+            paths = top_paths(sketch_path_counts(conn, filters))
+    with span('query:latency_histogram'), span('sql'), conn.cursor() as cursor:
+        cursor.execute("""
+            SELECT hour_bucket / %s * %s AS hour_bucket, api_path, bucket, SUM(count)::bigint
+            FROM latency_histogram
+            WHERE (api_path = %s OR api_path = ANY(%s))
+              AND (%s::bigint IS NULL OR hour_bucket >= %s) AND (%s::bigint IS NULL OR hour_bucket <= %s)
+            GROUP BY 1, 2, 3
+        """, (hours, hours, ALL_PATHS, list(paths), first, first, last, last))
+        return pd.DataFrame(cursor.fetchall(), columns=['hour_bucket', 'api_path', 'bucket', 'count'])
 
 
 def export_to_csv(df, filename="exported_logs.csv"):
@@ -45,20 +368,25 @@ def export_to_csv(df, filename="exported_logs.csv"):
     return csv_path
 
 
-def export_to_parquet(df, filename="exported_logs.parquet"):
-    """Сохраняет DataFrame в Parquet"""
+def export_to_parquet(data, filename="exported_logs.parquet"):
+    """Сохраняет DataFrame или pyarrow.Table в Parquet"""
     parquet_path = os.path.join(EXPORT_DIR, filename)
-    df.to_parquet(parquet_path, index=False)
+    if isinstance(data, pa.Table):
+        pq.write_table(data, parquet_path)
+    else:
+        data.to_parquet(parquet_path, index=False)
     logging.info(f"Данные успешно экспортированы в Parquet: {parquet_path}")
     return parquet_path
 
 
 def export_all_csv():
-    """Подключается к БД, экспортирует данные в CSV и возвращает путь к файлу"""
+    """Подключается к аналитическому бэкенду, экспортирует данные в CSV и возвращает путь к файлу"""
+    from log_export.backends import get_backend
     try:
         logging.info("Подключение к базе данных для экспорта в CSV...")
-        with psycopg2.connect(**DATABASE_CONFIG) as conn:
-            df = export_to_dataframe(conn)
+        backend = get_backend()
+        with backend.connect() as conn:
+            df = backend.export_to_dataframe(conn)
             csv_path = export_to_csv(df)
             logging.info("Экспорт в CSV завершен.")
             return csv_path
@@ -67,13 +395,46 @@ def export_all_csv():
         raise
 
 
+def csv_timestamp_sql(ts_expr):
+    """
+    SQL-выражение timestamp_utc в том виде, в каком его пишет pandas.to_csv в export_all_csv:
+    '2024-01-01 12:00:00+00:00', доли секунды — '.ffffff' (время из логов их не имеет).
+    """
+    utc = f"({ts_expr} AT TIME ZONE 'UTC')"
+    return (f"to_char({utc}, 'YYYY-MM-DD HH24:MI:SS') || "
+            f"CASE WHEN date_trunc('second', {utc}) <> {utc} THEN to_char({utc}, '.US') ELSE '' END || '+00:00'")
+
+
+async def export_all_csv_async(filename="exported_logs.csv"):
+    """
+    Экспорт в CSV без блокировки цикла событий. Для Postgres без реплик строки выгружаются
+    потоково через COPY ... TO STDOUT по асинхронному соединению, не собираясь в DataFrame;
+    для остальных бэкендов export_all_csv выполняется в отдельном потоке.
+    Время пишется в формате pandas (csv_timestamp_sql), так что файл не зависит от пути выгрузки.
+    """
+    if not ASYNC_DB_ENABLED or ANALYTICS_BACKEND != 'postgres' or DATABASE_REPLICAS:
+        return await asyncio.to_thread(export_all_csv)
+    try:
+        logging.info("Подключение к базе данных для экспорта в CSV...")
+        csv_path = os.path.join(EXPORT_DIR, filename)
+        async with async_db.connection() as conn:
+            await async_db.copy_to_csv(conn, export_query(timestamp_sql=csv_timestamp_sql), None, csv_path)
+        logging.info(f"Данные успешно экспортированы в CSV: {csv_path}")
+        return csv_path
+    except Exception as e:
+        logging.error(f"Ошибка при экспорте в CSV: {e}")
+        raise
+
+
 def export_all_parquet():
-    """Подключается к БД, экспортирует данные в Parquet и возвращает путь к файлу"""
+    """Подключается к аналитическому бэкенду, экспортирует данные в Parquet и возвращает путь к файлу"""
+    from log_export.backends import get_backend
     try:
         logging.info("Подключение к базе данных для экспорта в Parquet...")
-        with psycopg2.connect(**DATABASE_CONFIG) as conn:
-            df = export_to_dataframe(conn)
-            parquet_path = export_to_parquet(df)
+        backend = get_backend()
+        with backend.connect() as conn:
+            table = backend.export_to_arrow(conn)
+            parquet_path = export_to_parquet(table)
             logging.info("Экспорт в Parquet завершен.")
             return parquet_path
     except Exception as e:
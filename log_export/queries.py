@@ -0,0 +1,160 @@
+"""Общие SQL-запросы и фильтры для аналитических бэкендов"""
+
+import pandas as pd
+
+DASHBOARD_TIMEZONE = 'Europe/Amsterdam'
+
+
+def normalize_filters(start_date=None, end_date=None, status_code=None, request_type=None):
+    """
+    Приводит параметры фильтров дашборда к единому виду:
+    даты — к pd.Timestamp в UTC, 'all' и пустые значения — к None.
+    """
+    if isinstance(start_date, str) and start_date.lower() == "all":
+        start_date = None
+    if isinstance(end_date, str) and end_date.lower() == "all":
+        end_date = None
+
+    if start_date is not None:
+        start_date = pd.to_datetime(start_date)
+        if start_date.tzinfo is None:
+            start_date = start_date.tz_localize("UTC")
+    if end_date is not None:
+        end_date = pd.to_datetime(end_date)
+        if end_date.tzinfo is None:
+            end_date = end_date.tz_localize("UTC")
+
+    if not status_code or status_code == 'all':
+        status_code = None
+    else:
+        status_code = int(status_code)
+    if not request_type or request_type == 'all':
+        request_type = None
+
+    return {
+        'start_date': start_date,
+        'end_date': end_date,
+        'status_code': status_code,
+        'request_type': request_type,
+    }
+
+
+# До какого диапазона дат гистограммы времени ответа строятся по часам; длиннее — по суткам
+HOURLY_HISTOGRAM_MAX_DAYS = 14
+
+
+def histogram_hours(filters):
+    """Ширина временной корзины гистограмм в часах (1 или 24) по диапазону дат фильтра."""
+    start, end = filters.get('start_date'), filters.get('end_date')
+    if start is None or end is None or end - start > pd.Timedelta(days=HOURLY_HISTOGRAM_MAX_DAYS):
+        return 24
+    return 1
+
+
+def hourly_counts_local(hourly, timezone=DASHBOARD_TIMEZONE):
+    """Переводит количества по часам от эпохи (UTC) в количества по часу суток в заданной таймзоне."""
+    hours = pd.to_datetime(hourly['hour_bucket'] * 3600, unit='s', utc=True).dt.tz_convert(timezone).dt.hour
+    return hourly.assign(hour=hours).groupby('hour', as_index=False)['count'].sum()
+
+
+def build_where(filters, columns, placeholder='%s'):
+    """
+    Собирает условие WHERE и параметры по фильтрам.
+    columns — отображение логических колонок (ts, status_code, request_type) на SQL-выражения.
+    """
+    conditions = []
+    params = []
+    if filters.get('start_date') is not None:
+        conditions.append(f"{columns['ts']} >= {placeholder}")
+        params.append(filters['start_date'].to_pydatetime())
+    if filters.get('end_date') is not None:
+        conditions.append(f"{columns['ts']} <= {placeholder}")
+        params.append(filters['end_date'].to_pydatetime())
+    if filters.get('status_code') is not None:
+        conditions.append(f"{columns['status_code']} = {placeholder}")
+        params.append(filters['status_code'])
+    if filters.get('request_type') is not None:
+        conditions.append(f"{columns['request_type']} = {placeholder}")
+        params.append(filters['request_type'])
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    return where, params
+
+
+def dashboard_queries(source, columns, where):
+    """
+    Возвращает запросы частичных агрегатов для графиков дашборда.
+    Все агрегаты аддитивны (количества и суммы), поэтому их можно объединять между источниками.
+    Часы считаются в UTC (номер часа от эпохи), перевод в DASHBOARD_TIMEZONE — в hourly_counts_local.
+    Агрегат по странам (country) считается, если источник знает страну клиента (columns['country_code']).
+    """
+    queries = {
+        'hourly': f"""
+            SELECT {columns['hour_bucket']} AS hour_bucket, COUNT(*) AS count
+            {source} {where}
+            GROUP BY 1
+        """,
+        'status': f"""
+            SELECT {columns['status_code']} AS status_code, COUNT(*) AS count
+            {source} {where}
+            GROUP BY 1
+        """,
+        'api': f"""
+            SELECT {columns['api_path']} AS api_path,
+                   COUNT(*) AS count,
+                   CAST(SUM({columns['response_time']}) AS DOUBLE PRECISION) AS response_time_sum,
+                   COUNT({columns['response_time']}) AS response_time_count
+            {source} {where}
+            GROUP BY 1
+        """,
+        'status_by_type': f"""
+            SELECT {columns['request_type']} AS request_type, {columns['status_code']} AS status_code,
+                   COUNT(*) AS count
+            {source} {where}
+            GROUP BY 1, 2
+        """,
+    }
+    if 'country_code' in columns:
+        queries['country'] = f"""
+            SELECT {columns['country_code']} AS country_code, COUNT(*) AS count
+            {source} {where}
+            GROUP BY 1
+        """
+    return queries
+
+
+def timeseries_query(source, columns, where, bucket_seconds):
+    """
+    Запрос частичных агрегатов временного ряда по корзинам bucket_seconds секунд:
+    начало корзины (секунды от эпохи), число запросов, ошибок (5xx) и сумма времени ответа.
+    columns['epoch'] — время записи в секундах от эпохи.
+    """
+    bucket_seconds = int(bucket_seconds)
+    return f"""
+        SELECT CAST(FLOOR({columns['epoch']} / {bucket_seconds}) AS BIGINT) * {bucket_seconds} AS bucket,
+               COUNT(*) AS count,
+               COUNT(*) FILTER (WHERE {columns['status_code']} >= 500) AS errors,
+               CAST(SUM({columns['response_time']}) AS DOUBLE PRECISION) AS response_time_sum
+        {source} {where}
+        GROUP BY 1
+    """
+
+
+# Ключи группировки частичных агрегатов dashboard_queries
+AGGREGATE_KEYS = {
+    'hourly': ['hour_bucket'],
+    'status': ['status_code'],
+    'api': ['api_path'],
+    'status_by_type': ['request_type', 'status_code'],
+    'country': ['country_code'],
+}
+
+
+def merge_aggregates(parts):
+    """Объединяет частичные агрегаты нескольких источников суммированием по ключам."""
+    if len(parts) == 1:
+        return parts[0]
+    return {
+        name: pd.concat([part[name] for part in parts], ignore_index=True)
+                .groupby(keys, as_index=False, dropna=False).sum()
+        for name, keys in AGGREGATE_KEYS.items() if name in parts[0]
+    }
@@ -0,0 +1,56 @@
+"""Поиск записей по путям API и реферерам: сначала id подходящих значений измерений, затем факты по id"""
+
+from log2db.config import SEARCH_MAX_IDS
+from log2db.tracing import span
+from log_export.browse import _escape_like
+
+
+def like_pattern(pattern):
+    """
+    Шаблон поиска -> шаблон LIKE: * — любая подстрока, остальные символы (включая % и _) буквальны.
+    Шаблон без * ищется как префикс: такой поиск использует индекс text_pattern_ops,
+    шаблоны с * в начале или середине — триграммный индекс pg_trgm, если он есть.
+    """
+    escaped = '%'.join(_escape_like(part) for part in pattern.split('*'))
+    return escaped if '*' in pattern else escaped + '%'
+
+
+def _resolve_ids(cursor, table, id_column, condition, params, max_ids):
+    cursor.execute(f"SELECT {id_column} FROM {table} WHERE {condition} ORDER BY {id_column} LIMIT %s",
+                   (*params, max_ids + 1))
+    ids = [row[0] for row in cursor.fetchall()]
+    return ids[:max_ids], len(ids) > max_ids
+
+
+def resolve_search_ids(conn, path=None, referrer=None, referrer_host=None, max_ids=SEARCH_MAX_IDS):
+    """
+    Разрешает критерии поиска в id измерений:
+      - path — шаблон пути API (like_pattern) -> api_ids
+      - referrer — шаблон URL реферера (like_pattern) -> referrer_ids
+      - referrer_host — хост реферера: сам хост и его поддомены (или шаблон с *) -> referrer_ids
+    Возвращает ({'api_ids': [...] или None, 'referrer_ids': [...] или None}, усечен ли какой-либо список).
+    None — критерий не задан; пустой список — по критерию ничего не найдено.
+    """
+    ids, truncated = {'api_ids': None, 'referrer_ids': None}, False
+    with conn.cursor() as cursor, span('query:search_ids'):
+        if path:
+            ids['api_ids'], cut = _resolve_ids(cursor, 'dim_api', 'api_id', "api_path LIKE %s",
+                                               (like_pattern(path),), max_ids)
+            truncated |= cut
+        conditions, params = [], []
+        if referrer:
+            conditions.append("referrer_url LIKE %s")
+            params.append(like_pattern(referrer))
+        if referrer_host:
+            host = referrer_host.lower()
+            if '*' in host:
+                conditions.append("referrer_host LIKE %s")
+                params.append(like_pattern(host))
+            else:
+                conditions.append("(referrer_host = %s OR referrer_host LIKE %s)")
+                params.extend((host, '%.' + _escape_like(host)))
+        if conditions:
+            ids['referrer_ids'], cut = _resolve_ids(cursor, 'dim_referrer', 'referrer_id', ' AND '.join(conditions),
+                                                    params, max_ids)
+            truncated |= cut
+    return ids, truncated
@@ -0,0 +1,98 @@
+"""Аналитический бэкенд поверх шардов Postgres: запрос ко всем шардам и слияние результатов"""
+
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, ExitStack
+import pandas as pd
+import pyarrow as pa
+import log_export.export as postgres
+from log_export.compact import concat_compact_frames
+from log_export.queries import merge_aggregates
+from log2db.shards import get_shards
+from log2db.sketches import summarize_sketches, top_paths
+from log2db.tracing import add_span
+
+# Скетчи шардов — те же sketch_hourly и latency_histogram, что у Postgres-бэкенда
+SKETCH_FILTERS = postgres.SKETCH_FILTERS
+
+
+@contextmanager
+def connect():
+    """Берет по соединению из пула каждого шарда (DATABASE_SHARDS) и возвращает их по выходу из блока."""
+    shards = get_shards()
+    if not shards:
+        raise ValueError("Бэкенд 'sharded' требует DATABASE_SHARDS")
+    with ExitStack() as stack:
+        yield [(shard, stack.enter_context(shard.connection())) for shard in shards]
+
+
+def _scatter(conns, func, *args):
+    """
+    Выполняет func(conn, *args) на всех шардах параллельно и возвращает результаты в порядке шардов.
+    Время каждого шарда пишется в трассу дашборда спаном shard:<имя>.
+    """
+    def _run(shard, conn):
+        started = time.perf_counter()
+        result = func(conn, *args)
+        return result, time.perf_counter() - started, shard
+
+    with ThreadPoolExecutor(max_workers=len(conns), thread_name_prefix='shard-query') as executor:
+        outcomes = list(executor.map(lambda item: _run(*item), conns))
+    for _, seconds, shard in outcomes:
+        add_span(f'shard:{shard.name}', seconds)
+    return [result for result, _, _ in outcomes]
+
+
+def export_to_arrow(conns, where="", params=None):
+    """Выгрузка со всех шардов в один pyarrow.Table (log_id уникален в пределах шарда)"""
+    tables = _scatter(conns, postgres.export_to_arrow, where, params)
+    return pa.concat_tables(tables)
+
+
+def export_to_dataframe(conns, where="", params=None):
+    """Выгрузка со всех шардов в pandas DataFrame"""
+    return export_to_arrow(conns, where, params).to_pandas()
+
+
+def fetch_logs(conns, filters):
+    """Компактные записи логов со всех шардов с объединением категорий"""
+    return concat_compact_frames(_scatter(conns, postgres.fetch_logs, filters))
+
+
+def dashboard_aggregates(conns, filters):
+    """Частичные агрегаты дашборда со всех шардов, сложенные по ключам"""
+    parts = _scatter(conns, postgres.dashboard_aggregates, filters)
+    logging.debug(f"Агрегаты дашборда собраны с {len(parts)} шардов")
+    return merge_aggregates(parts)
+
+
+def approx_aggregates(conns, filters):
+    """Скетчи со всех шардов: общий топ путей, затем слияние скетчей одного часа и пути между шардами"""
+    counts = _scatter(conns, postgres.sketch_path_counts, filters)
+    paths = top_paths(pd.concat(counts, ignore_index=True))
+    parts = _scatter(conns, postgres.load_sketches, filters, paths)
+    return summarize_sketches([row for rows in parts for row in rows])
+
+
+def latency_histograms(conns, filters):
+    """Гистограммы времени ответа со всех шардов по общему топу путей, сложенные по корзинам"""
+    counts = _scatter(conns, postgres.sketch_path_counts, filters)
+    paths = top_paths(pd.concat(counts, ignore_index=True))
+    parts = _scatter(conns, postgres.latency_histograms, filters, paths)
+    return (pd.concat(parts, ignore_index=True)
+            .groupby(['hour_bucket', 'api_path', 'bucket'], as_index=False)['count'].sum())
+
+
+def timeseries(conns, filters, bucket_seconds):
+    """Частичные агрегаты временного ряда со всех шардов, сложенные по корзинам"""
+    parts = _scatter(conns, postgres.timeseries, filters, bucket_seconds)
+    return pd.concat(parts, ignore_index=True).groupby('bucket', as_index=False).sum()
+
+
+def time_bounds(conns, filters):
+    """Время первой и последней записи по всем шардам"""
+    bounds = [bound for bound in _scatter(conns, postgres.time_bounds, filters) if bound[0] is not None]
+    if not bounds:
+        return None, None
+    return min(first for first, _ in bounds), max(last for _, last in bounds)
@@ -0,0 +1,205 @@
+"""Временные ряды по логам: автоматический размер корзины, кэш корзин и прореживание LTTB для отображения"""
+
+import math
+import time
+import logging
+import threading
+from collections import OrderedDict
+from contextlib import ExitStack
+import numpy as np
+import pandas as pd
+from log2db.config import (TIMESERIES_MAX_BUCKETS, TIMESERIES_MAX_POINTS, TIMESERIES_CACHE_SECONDS,
+                           TIMESERIES_CACHE_CHUNKS)
+from log2db.tracing import span
+from log_export.backends import get_backend
+from log_export.queries import normalize_filters
+
+# Размеры корзин по возрастанию, с
+BUCKET_SECONDS = {'second': 1, 'minute': 60, 'hour': 3600, 'day': 86400}
+
+# Сколько корзин хранится в одной записи кэша
+CHUNK_BUCKETS = 1000
+
+# Метрики ряда, доступные для отображения
+METRICS = ('count', 'errors', 'avg_response_time')
+
+
+def choose_bucket(start, end, max_buckets=TIMESERIES_MAX_BUCKETS):
+    """Самая мелкая корзина (second/minute/hour/day), при которой диапазон укладывается в max_buckets корзин."""
+    span_seconds = max((end - start).total_seconds(), 1)
+    for name, seconds in BUCKET_SECONDS.items():
+        if span_seconds / seconds <= max_buckets:
+            return name
+    return 'day'
+
+
+def lttb(x, y, threshold):
+    """
+    Прореживание ряда алгоритмом Largest-Triangle-Three-Buckets: оставляет threshold точек,
+    сохраняя форму графика (пики и провалы). Возвращает индексы выбранных точек.
+    """
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    edges = np.linspace(1, n - 1, threshold - 1).astype(np.int64)
+    selected = np.empty(threshold, dtype=np.int64)
+    selected[0], selected[-1] = 0, n - 1
+    previous = 0
+    for i in range(threshold - 2):
+        start, end = edges[i], edges[i + 1]
+        next_end = edges[i + 2] if i + 2 < len(edges) else n
+        # Вершина следующей корзины — среднее ее точек
+        next_x = x[end:next_end].mean() if next_end > end else x[-1]
+        next_y = y[end:next_end].mean() if next_end > end else y[-1]
+        area = np.abs((x[previous] - next_x) * (y[start:end] - y[previous])
+                      - (x[previous] - x[start:end]) * (next_y - y[previous]))
+        previous = start + int(np.argmax(area))
+        selected[i + 1] = previous
+    return selected
+
+
+class ChunkCache:
+    """
+    LRU-кэш частичных агрегатов по кускам из CHUNK_BUCKETS корзин.
+    При приближении и сдвиге диапазона запрашиваются только куски, которых нет в кэше.
+    Записи устаревают через ttl секунд, чтобы подхватывать новые загруженные логи.
+    """
+
+    def __init__(self, max_chunks=TIMESERIES_CACHE_CHUNKS, ttl=TIMESERIES_CACHE_SECONDS):
+        self.max_chunks = max_chunks
+        self.ttl = ttl
+        self._chunks = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._chunks.get(key)
+            if entry is None:
+                return None
+            stored_at, frame = entry
+            if time.monotonic() - stored_at > self.ttl:
+                del self._chunks[key]
+                return None
+            self._chunks.move_to_end(key)
+            return frame
+
+    def put(self, key, frame):
+        with self._lock:
+            self._chunks[key] = (time.monotonic(), frame)
+            self._chunks.move_to_end(key)
+            while len(self._chunks) > self.max_chunks:
+                self._chunks.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._chunks.clear()
+
+
+chunk_cache = ChunkCache()
+
+
+def _missing_ranges(chunks):
+    """Группирует номера отсутствующих кусков в непрерывные диапазоны [первый, последний]."""
+    ranges = []
+    for chunk in chunks:
+        if ranges and ranges[-1][1] == chunk - 1:
+            ranges[-1][1] = chunk
+        else:
+            ranges.append([chunk, chunk])
+    return ranges
+
+
+def load_buckets(backend, connection, filters, bucket, cache=chunk_cache):
+    """
+    Частичные агрегаты корзин размера bucket за диапазон фильтра (корзины — начало в секундах от эпохи).
+    Берет куски из кэша, отсутствующие запрашивает у бэкенда одним запросом на непрерывный диапазон.
+    connection() возвращает соединение бэкенда и вызывается, только если кэша не хватило.
+    """
+    seconds = BUCKET_SECONDS[bucket]
+    chunk_seconds = seconds * CHUNK_BUCKETS
+    first = int(filters['start_date'].timestamp()) // chunk_seconds
+    last = int(filters['end_date'].timestamp()) // chunk_seconds
+    base_key = (backend.__name__, bucket, filters.get('status_code'), filters.get('request_type'))
+    frames = {}
+    for chunk in range(first, last + 1):
+        frame = cache.get((*base_key, chunk))
+        if frame is not None:
+            frames[chunk] = frame
+    missing = [chunk for chunk in range(first, last + 1) if chunk not in frames]
+    logging.debug(f"Временной ряд ({bucket}): кусков в кэше {len(frames)}, запрашивается {len(missing)}")
+    for range_first, range_last in _missing_ranges(missing):
+        chunk_filters = {
+            **filters,
+            'start_date': pd.Timestamp(range_first * chunk_seconds, unit='s', tz='UTC'),
+            # Граница включительная: последняя секунда куска
+            'end_date': pd.Timestamp((range_last + 1) * chunk_seconds - 1, unit='s', tz='UTC')
+                        + pd.Timedelta(microseconds=999999),
+        }
+        with span(f'query:timeseries:{bucket}'):
+            fetched = backend.timeseries(connection(), chunk_filters, seconds)
+        chunk_ids = fetched['bucket'].to_numpy() // chunk_seconds
+        for chunk in range(range_first, range_last + 1):
+            frame = fetched[chunk_ids == chunk].reset_index(drop=True)
+            cache.put((*base_key, chunk), frame)
+            frames[chunk] = frame
+    combined = pd.concat([frames[chunk] for chunk in sorted(frames)], ignore_index=True)
+    start, end = filters['start_date'].timestamp(), filters['end_date'].timestamp()
+    return combined[(combined['bucket'] + seconds > start) & (combined['bucket'] <= end)].reset_index(drop=True)
+
+
+def build_series(buckets, start, end, bucket, metric='count'):
+    """Ряд метрики по всем корзинам диапазона: пустые корзины — 0 запросов (среднее время — NaN)."""
+    seconds = BUCKET_SECONDS[bucket]
+    index = np.arange(int(start.timestamp()) // seconds * seconds, int(end.timestamp()) + 1, seconds, dtype=np.int64)
+    frame = buckets.set_index('bucket').reindex(index, fill_value=0)
+    if metric == 'avg_response_time':
+        with np.errstate(divide='ignore', invalid='ignore'):
+            values = np.where(frame['count'] > 0, frame['response_time_sum'] / frame['count'], np.nan)
+    else:
+        values = frame[metric].to_numpy(dtype=np.float64)
+    return index, values
+
+
+def get_timeseries(start_date, end_date, status_code=None, request_type=None, metric='count',
+                   max_points=TIMESERIES_MAX_POINTS, backend_name=None):
+    """
+    Временной ряд метрики (count, errors, avg_response_time) для графика:
+      - размер корзины выбирается по диапазону (choose_bucket)
+      - агрегаты корзин считаются на стороне бэкенда и кэшируются кусками
+      - для отображения ряд прореживается LTTB до max_points точек
+    Без дат диапазон берется по границам данных. Возвращает {'bucket', 'metric', 'points': [[мс от эпохи, значение], ...]}.
+    """
+    if metric not in METRICS:
+        raise ValueError(f"Неизвестная метрика временного ряда: {metric}")
+    filters = normalize_filters(start_date, end_date, status_code, request_type)
+    backend = get_backend(backend_name)
+    with ExitStack() as stack:
+        opened = []
+
+        def connection():
+            # Соединение открывается при первом обращении к бэкенду: при попадании в кэш оно не нужно
+            if not opened:
+                with span('connect'):
+                    opened.append(stack.enter_context(backend.connect()))
+            return opened[0]
+
+        if filters['start_date'] is None or filters['end_date'] is None:
+            with span('query:time_bounds'):
+                first, last = backend.time_bounds(connection(), filters)
+            if first is None:
+                return {'bucket': None, 'metric': metric, 'points': []}
+            filters['start_date'] = filters['start_date'] if filters['start_date'] is not None else first
+            filters['end_date'] = filters['end_date'] if filters['end_date'] is not None else last
+        if filters['end_date'] < filters['start_date']:
+            return {'bucket': None, 'metric': metric, 'points': []}
+        bucket = choose_bucket(filters['start_date'], filters['end_date'])
+        buckets = load_buckets(backend, connection, filters, bucket)
+    with span('downsample'):
+        x, y = build_series(buckets, filters['start_date'], filters['end_date'], bucket, metric)
+        # Для LTTB пропуски (NaN) заменяются нулями только при выборе точек, значения остаются NaN
+        selected = lttb(x, np.nan_to_num(y), max_points)
+        points = [[int(ts) * 1000, None if math.isnan(value) else float(value)]
+                  for ts, value in zip(x[selected], y[selected])]
+    return {'bucket': bucket, 'metric': metric, 'points': points}
@@ -2,15 +2,23 @@
 
 import logging
 import os
+import time
+from contextlib import ExitStack
+from urllib.parse import urlparse, parse_qs
 import dash
+import flask
 from dash import dcc, html
 from dash.dependencies import Input, Output
-import plotly.express as px
 import pandas as pd
-from datetime import datetime
-import psycopg2
-from log2db.config import DATABASE_CONFIG
-from log_export.export import export_to_dataframe
+import plotly.express as px
+import plotly.graph_objects as go
+from plotly.subplots import make_subplots
+from log_export.backends import get_backend, ignored_sketch_filters
+from log_export.queries import normalize_filters, hourly_counts_local, DASHBOARD_TIMEZONE
+from log_export.timeseries import get_timeseries
+from log2db.profiling import profiled
+from log2db.sketches import ALL_PATHS, LATENCY_BUCKET_EDGES, histogram_percentiles, latency_bucket_label
+from log2db.tracing import span, traced
 from rendering.layout import dash_layout
 
 app = dash.Dash(
@@ -20,72 +28,52 @@ app = dash.Dash(
 
 app.layout = dash_layout
 
-def fetch_logs_data(start_date=None, end_date=None, status_code=None, request_type=None):
+
+def requested_profile_mode():
     '''
-    Экспортирует данные из БД.
-    Применяет фильтрацию.
+    Режим профилирования, запрошенный в адресе страницы дашборда (/dashboard/?profile=...).
+    Колбэки Dash приходят отдельными запросами, поэтому адрес берется из Referer.
     '''
-    logging.info("Начало извлечения данных для дашборда...")
+    if not flask.has_request_context() or not flask.request.referrer:
+        return None
+    return parse_qs(urlparse(flask.request.referrer).query).get('profile', [None])[0]
 
-    try:
-        with psycopg2.connect(**DATABASE_CONFIG) as conn:
-            df = export_to_dataframe(conn)
-        logging.info("Данные успешно извлечены из базы данных")
-    except Exception as e:
-        logging.error(f"Ошибка при извлечении данных из базы: {e}")
-        raise
 
-    try:
-        df['timestamp_utc'] = pd.to_datetime(df['timestamp_utc'], utc=True)
-        logging.debug("Поле timestamp_utc преобразовано в datetime с таймзоной UTC")
-    except Exception as e:
-        logging.error(f"Ошибка при преобразовании timestamp_utc в datetime: {e}")
-        raise
+def finish_after_response(trace):
+    '''
+    Откладывает завершение трассы колбэка до конца HTTP-запроса:
+    Dash сериализует фигуры в JSON уже после возврата из колбэка.
+    '''
+    if not flask.has_request_context():
+        return False
+    flask.g.setdefault('dashboard_traces', []).append(trace)
+    return True
+
 
-    filtered_rows_before = len(df)
+@app.server.teardown_request
+def finish_dashboard_traces(exc=None):
+    for trace in flask.g.pop('dashboard_traces', []):
+        trace.add_span('serialize', time.perf_counter() - trace.returned)
+        trace.finish()
 
-    if isinstance(end_date, str) and end_date.lower() == "all":
-        end_date = None
-    elif isinstance(end_date, str):
-        end_date = pd.to_datetime(end_date)
-        if end_date.tzinfo is None:
-            end_date = end_date.tz_localize("UTC")
 
+def fetch_dashboard_aggregates(start_date=None, end_date=None, status_code=None, request_type=None):
+    '''
+    Считает агрегаты для графиков на стороне аналитического бэкенда,
+    не выгружая сырые строки логов.
+    '''
+    filters = normalize_filters(start_date, end_date, status_code, request_type)
     try:
-        if isinstance(start_date, str) and start_date.lower() != "all":
-            start_date = pd.to_datetime(start_date).tz_localize("UTC")
-        elif isinstance(start_date, pd.Timestamp) and start_date.tzinfo is None:
-            start_date = start_date.tz_localize("UTC")
-
-        if isinstance(end_date, str) and end_date.lower() != "all":
-            end_date = pd.to_datetime(end_date)
-            if end_date.tzinfo is None:
-                end_date = end_date.tz_localize("UTC")
-        elif isinstance(end_date, pd.Timestamp) and end_date.tzinfo is None:
-            end_date = end_date.tz_localize("UTC")
-
-        if start_date:
-            df = df[df['timestamp_utc'] >= start_date]
-            logging.debug(f"Фильтр по start_date применён: {start_date}")
-        if end_date:
-            df = df[df['timestamp_utc'] <= end_date]
-            logging.debug(f"Фильтр по end_date применён: {end_date}")
-
-        if status_code and status_code != 'all':
-            df = df[df['status_code'] == int(status_code)]
-            logging.debug(f"Фильтр по status_code применён: {status_code}")
-
-        if request_type and request_type != 'all':
-            df = df[df['request_type'] == request_type]
-            logging.debug(f"Фильтр по request_type применён: {request_type}")
-
-        filtered_rows_after = len(df)
-        logging.info(f"Фильтрация завершена. Строк до фильтрации: {filtered_rows_before}, после: {filtered_rows_after}")
+        backend = get_backend()
+        with ExitStack() as stack:
+            with span('connect'):
+                conn = stack.enter_context(backend.connect())
+            aggregates = backend.dashboard_aggregates(conn, filters)
+        logging.info("Агрегаты для дашборда успешно получены")
     except Exception as e:
-        logging.error(f"Ошибка при применении фильтров: {e}")
+        logging.error(f"Ошибка при получении агрегатов из базы: {e}")
         raise
-
-    return df
+    return aggregates
 
 @app.callback(
     [
@@ -111,7 +99,10 @@ def fetch_logs_data(start_date=None, end_date=None, status_code=None, request_ty
 
         # Для вкладки "Производительность"
         Output('avg-response-time-performance', 'figure'),
-        Output('requests-over-time-performance', 'figure')
+        Output('requests-over-time-performance', 'figure'),
+
+        # Для вкладки "Активность": страны клиентов
+        Output('requests-by-country', 'figure')
     ],
     [
         Input('date-picker-range', 'start_date'),
@@ -120,113 +111,143 @@ def fetch_logs_data(start_date=None, end_date=None, status_code=None, request_ty
         Input('request-type-dropdown', 'value')
     ]
 )
-
+@traced('update_graphs', defer=finish_after_response)
+@profiled('update_graphs', requested=requested_profile_mode)
 def update_graphs(start_date, end_date, status_code, request_type):
     logging.info("Обновление графиков дашборда...")
 
     try:
-        df = fetch_logs_data(start_date, end_date, status_code, request_type)
+        with span('aggregates'):
+            aggregates = fetch_dashboard_aggregates(start_date, end_date, status_code, request_type)
     except Exception as e:
         logging.error(f"Ошибка при загрузке данных для графиков: {e}")
         raise
 
+    with span('figures'):
+        return build_figures(aggregates)
+
+
+def build_figures(aggregates):
+    '''
+    Строит графики дашборда по агрегатам бэкенда
+    (hourly, status, api, status_by_type и country, если бэкенд знает страну клиента).
+    '''
     # График 1: Запросы по времени (по часам суток)
-    try:
-        df['timestamp_utc'] = pd.to_datetime(df['timestamp_utc'], utc=True)
-        df['timestamp_local'] = df['timestamp_utc'].dt.tz_convert('Europe/Amsterdam')
-        df['hour'] = df['timestamp_local'].dt.hour
-        hourly_counts = df.groupby('hour').size().reset_index(name='count')
-        
-        fig1 = px.bar(hourly_counts, x='hour', y='count',
-                      title='Количество запросов по часам суток (CET)',
-                      labels={'hour': 'Час суток (CET)', 'count': 'Количество запросов'},
-                      category_orders={'hour': list(range(24))})
-        fig1.update_xaxes(type='category')
-    except Exception as e:
-        logging.error(f"Ошибка при построении графика 'Количество запросов по часам суток': {e}")
-        raise
+    with span('figure:hourly'):
+        try:
+            with span('aggregate'):
+                hourly_counts = hourly_counts_local(aggregates['hourly'])
+
+            fig1 = px.bar(hourly_counts, x='hour', y='count',
+                          title='Количество запросов по часам суток (CET)',
+                          labels={'hour': 'Час суток (CET)', 'count': 'Количество запросов'},
+                          category_orders={'hour': list(range(24))})
+            fig1.update_xaxes(type='category')
+        except Exception as e:
+            logging.error(f"Ошибка при построении графика 'Количество запросов по часам суток': {e}")
+            raise
 
     # График 2: Распределение статус-кодов
-    try:
-        status_counts = df['status_code'].value_counts().reset_index()
-        status_counts.columns = ['status_code', 'count']
-        status_counts = status_counts.sort_values(by='count', ascending=False)
-        status_counts['status_code_str'] = status_counts['status_code'].astype(str)
-
-        fig2 = px.bar(status_counts, x='status_code_str', y='count', color='status_code_str',
-                      title='Распределение статус-кодов',
-                      labels={'status_code_str': 'Статус-код', 'count': 'Количество'},
-                      color_discrete_sequence=px.colors.sequential.Plasma,
-                      category_orders={'status_code_str': status_counts['status_code_str'].tolist()})
-        fig2.update_layout(showlegend=True)
-        fig2.update_xaxes(type='category')
-    except Exception as e:
-        logging.error(f"Ошибка при построении графика 'Распределение статус-кодов': {e}")
-        raise
+    with span('figure:status'):
+        try:
+            status_counts = aggregates['status'].sort_values(by='count', ascending=False)
+            status_counts['status_code_str'] = status_counts['status_code'].astype(str)
+
+            fig2 = px.bar(status_counts, x='status_code_str', y='count', color='status_code_str',
+                          title='Распределение статус-кодов',
+                          labels={'status_code_str': 'Статус-код', 'count': 'Количество'},
+                          color_discrete_sequence=px.colors.sequential.Plasma,
+                          category_orders={'status_code_str': status_counts['status_code_str'].tolist()})
+            fig2.update_layout(showlegend=True)
+            fig2.update_xaxes(type='category')
+        except Exception as e:
+            logging.error(f"Ошибка при построении графика 'Распределение статус-кодов': {e}")
+            raise
 
     # График 3: Топ-10 API-путей
-    try:
-        top_api = df['api_path'].value_counts().head(10).reset_index()
-        top_api.columns = ['api_path', 'count']
-        fig3 = px.bar(top_api, x='count', y='api_path', orientation='h', 
-                      title='Топ-10 API-путей', color='api_path',
-                      labels={'count': 'Количество', 'api_path' : 'АПИ пути'},
-                      color_discrete_sequence=px.colors.sequential.Viridis)
-    except Exception as e:
-        logging.error(f"Ошибка при построении графика 'Топ-10 API-путей': {e}")
-        raise
+    with span('figure:top_api'):
+        try:
+            api_stats = aggregates['api']
+            top_api = api_stats.sort_values(by='count', ascending=False).head(10)[['api_path', 'count']]
+            fig3 = px.bar(top_api, x='count', y='api_path', orientation='h', 
+                          title='Топ-10 API-путей', color='api_path',
+                          labels={'count': 'Количество', 'api_path' : 'АПИ пути'},
+                          color_discrete_sequence=px.colors.sequential.Viridis)
+        except Exception as e:
+            logging.error(f"Ошибка при построении графика 'Топ-10 API-путей': {e}")
+            raise
 
     # График 4: Среднее время ответа
-    try:
-        avg_response = df.groupby('api_path')['response_time'].mean().reset_index().sort_values(by='response_time', ascending=False).head(10)
-        fig4 = px.bar(avg_response, x='response_time', y='api_path', orientation='h', 
-                      title='Среднее время ответа по API-путям (Топ-10)', color='api_path',
-                      labels={'response_time' : 'Время ответа', 'api_path' : 'АПИ путь'},
-                      color_discrete_sequence=px.colors.sequential.Viridis_r)
-    except Exception as e:
-        logging.error(f"Ошибка при построении графика 'Среднее время ответа по API-путям': {e}")
-        raise
+    with span('figure:avg_response'):
+        try:
+            avg_response = api_stats.assign(
+                response_time=api_stats['response_time_sum'] / api_stats['response_time_count']
+            ).sort_values(by='response_time', ascending=False).head(10)[['api_path', 'response_time']]
+            fig4 = px.bar(avg_response, x='response_time', y='api_path', orientation='h', 
+                          title='Среднее время ответа по API-путям (Топ-10)', color='api_path',
+                          labels={'response_time' : 'Время ответа', 'api_path' : 'АПИ путь'},
+                          color_discrete_sequence=px.colors.sequential.Viridis_r)
+        except Exception as e:
+            logging.error(f"Ошибка при построении графика 'Среднее время ответа по API-путям': {e}")
+            raise
 
     # График 5: Распределение статус-кодов по типам запросов
-    try:
-        status_request_counts = df.groupby(['request_type', 'status_code']).size().reset_index(name='count')
-        fig5 = px.bar(
-            status_request_counts,
-            x='request_type',
-            y='count',
-            color='status_code',
-            color_discrete_sequence=['#7BC17E', '#FFA15A', '#EF553B'],
-            title='Распределение статус-кодов по типам запросов',
-            labels={
-                'request_type': 'Тип запроса',
-                'count': 'Количество запросов',
-                'status_code': 'Статус-код'
-            },
-            barmode='group',
-            category_orders={
-                'request_type': ['GET', 'POST', 'PUT', 'DELETE'],
-                'status_code': ['200', '404', '500']
-            },
-            text='count'
-        )
-        fig5.update_layout(
-            legend_title_text='Статус-код',
-            plot_bgcolor='white',
-            bargap=0.3,
-            bargroupgap=0.1,
-            uniformtext_minsize=10
-        )
-        fig5.update_traces(
-            texttemplate='%{text}',
-            textposition='inside',
-            marker_line_width=0.5,
-            marker_line_color='white',
-            opacity=0.9
-        )
-    except Exception as e:
-        logging.error(f"Ошибка при построении графика 'Распределение статус-кодов по типам запросов': {e}")
-        raise
+    with span('figure:status_by_type'):
+        try:
+            status_request_counts = aggregates['status_by_type'].sort_values(by=['request_type', 'status_code'])
+            fig5 = px.bar(
+                status_request_counts,
+                x='request_type',
+                y='count',
+                color='status_code',
+                color_discrete_sequence=['#7BC17E', '#FFA15A', '#EF553B'],
+                title='Распределение статус-кодов по типам запросов',
+                labels={
+                    'request_type': 'Тип запроса',
+                    'count': 'Количество запросов',
+                    'status_code': 'Статус-код'
+                },
+                barmode='group',
+                category_orders={
+                    'request_type': ['GET', 'POST', 'PUT', 'DELETE'],
+                    'status_code': ['200', '404', '500']
+                },
+                text='count'
+            )
+            fig5.update_layout(
+                legend_title_text='Статус-код',
+                plot_bgcolor='white',
+                bargap=0.3,
+                bargroupgap=0.1,
+                uniformtext_minsize=10
+            )
+            fig5.update_traces(
+                texttemplate='%{text}',
+                textposition='inside',
+                marker_line_width=0.5,
+                marker_line_color='white',
+                opacity=0.9
+            )
+        except Exception as e:
+            logging.error(f"Ошибка при построении графика 'Распределение статус-кодов по типам запросов': {e}")
+            raise
     
+    # График 6: Запросы по странам клиентов (Топ-10)
+    with span('figure:country'):
+        try:
+            countries = aggregates.get('country')
+            if countries is None:
+                countries = pd.DataFrame({'country_code': [], 'count': []})
+            top_countries = (countries.assign(country_code=countries['country_code'].fillna('Неизвестно'))
+                             .sort_values(by='count', ascending=False).head(10))
+            fig6 = px.bar(top_countries, x='count', y='country_code', orientation='h',
+                          title='Запросы по странам (Топ-10)', color='country_code',
+                          labels={'count': 'Количество', 'country_code': 'Страна'},
+                          color_discrete_sequence=px.colors.sequential.Viridis)
+        except Exception as e:
+            logging.error(f"Ошибка при построении графика 'Запросы по странам': {e}")
+            raise
+
     logging.info("Графики успешно обновлены")
     
     # Возвращаем все графики
@@ -240,9 +261,327 @@ def update_graphs(start_date, end_date, status_code, request_type):
         # Для вкладки "API"
         fig3, fig4,
         # Для вкладки "Производительность"
-        fig4, fig1
+        fig4, fig1,
+        # Для вкладки "Активность": страны клиентов
+        fig6
     )
 
+
+# Заголовки графиков по скетчам и гистограммам для пояснения про фильтры
+APPROX_TITLES = ('Уникальные посетители по часам', 'Перцентили времени ответа по часам',
+                 'Перцентили времени ответа по API-путям (Топ по запросам)')
+
+LATENCY_TITLES = ('Перцентили времени ответа по API-путям во времени', 'Тепловая карта времени ответа')
+
+# Подписи фильтров для пояснения на графиках по скетчам
+FILTER_LABELS = {'start_date': 'даты', 'end_date': 'даты', 'status_code': 'статус-кода', 'request_type': 'типа запроса'}
+
+
+def ignored_filters_figures(titles, ignored):
+    '''
+    Графики по скетчам без данных с пояснением: фильтры ignored скетчи бэкенда не применяют,
+    а нефильтрованные значения рядом с отфильтрованными графиками вводили бы в заблуждение.
+    '''
+    labels = list(dict.fromkeys(FILTER_LABELS.get(name, name) for name in ignored))
+    if len(labels) == 1:
+        message = f"Фильтр {labels[0]} к скетчам не применяется: сбросьте его или используйте бэкенд duckdb"
+    else:
+        message = f"Фильтры {' и '.join(labels)} к скетчам не применяются: сбросьте их или используйте бэкенд duckdb"
+    figures = []
+    for title in titles:
+        fig = go.Figure()
+        fig.update_layout(title=title, xaxis={'visible': False}, yaxis={'visible': False},
+                          annotations=[{'text': message, 'xref': 'paper', 'yref': 'paper', 'x': 0.5, 'y': 0.5,
+                                        'showarrow': False}])
+        figures.append(fig)
+    return tuple(figures)
+
+
+def fetch_approx_aggregates(start_date=None, end_date=None, status_code=None, request_type=None):
+    '''
+    Уникальные посетители и перцентили времени ответа по скетчам бэкенда:
+    сливаются предрассчитанные скетчи по часам, а не сырые строки логов.
+    '''
+    filters = normalize_filters(start_date, end_date, status_code, request_type)
+    try:
+        backend = get_backend()
+        with ExitStack() as stack:
+            with span('connect'):
+                conn = stack.enter_context(backend.connect())
+            approx = backend.approx_aggregates(conn, filters)
+        logging.info("Скетчи для дашборда успешно получены")
+    except Exception as e:
+        logging.error(f"Ошибка при получении скетчей из базы: {e}")
+        raise
+    return approx
+
+
+@app.callback(
+    [
+        # Для вкладки "Активность"
+        Output('unique-visitors', 'figure'),
+
+        # Для вкладки "Производительность"
+        Output('latency-percentiles', 'figure'),
+        Output('latency-percentiles-by-path', 'figure')
+    ],
+    [
+        Input('date-picker-range', 'start_date'),
+        Input('date-picker-range', 'end_date'),
+        Input('status-code-dropdown', 'value'),
+        Input('request-type-dropdown', 'value')
+    ]
+)
+@traced('update_approx_graphs', defer=finish_after_response)
+@profiled('update_approx_graphs', requested=requested_profile_mode)
+def update_approx_graphs(start_date, end_date, status_code, request_type):
+    logging.info("Обновление графиков по скетчам...")
+
+    ignored = ignored_sketch_filters(get_backend(), normalize_filters(start_date, end_date, status_code, request_type))
+    if ignored:
+        logging.info(f"Графики по скетчам не строятся: фильтры {ignored} к скетчам не применяются")
+        return ignored_filters_figures(APPROX_TITLES, ignored)
+
+    try:
+        with span('aggregates'):
+            approx = fetch_approx_aggregates(start_date, end_date, status_code, request_type)
+    except Exception as e:
+        logging.error(f"Ошибка при загрузке скетчей для графиков: {e}")
+        raise
+
+    with span('figures'):
+        return build_approx_figures(approx)
+
+
+def build_approx_figures(approx):
+    '''
+    Строит графики по скетчам бэкенда (hourly, paths, totals):
+    уникальные посетители и перцентили p50/p95/p99 времени ответа.
+    '''
+    hourly = approx['hourly'].assign(
+        time=pd.to_datetime(approx['hourly']['hour_bucket'] * 3600, unit='s', utc=True).dt.tz_convert(DASHBOARD_TIMEZONE)
+    )
+    totals = approx['totals']
+
+    # График 1: Уникальные посетители по часам
+    with span('figure:unique_visitors'):
+        try:
+            visitors = hourly.melt(id_vars='time', value_vars=['unique_ips', 'unique_user_agents'],
+                                   var_name='metric', value_name='count')
+            fig1 = px.line(visitors, x='time', y='count', color='metric',
+                           title=f"Уникальные посетители по часам (за период ≈ {totals['unique_ips']:,} IP, "
+                                 f"{totals['unique_user_agents']:,} User-Agent)",
+                           labels={'time': 'Время (CET)', 'count': 'Уникальных (≈)', 'metric': 'Метрика'})
+            fig1.for_each_trace(lambda trace: trace.update(name={'unique_ips': 'IP', 'unique_user_agents': 'User-Agent'}[trace.name]))
+        except Exception as e:
+            logging.error(f"Ошибка при построении графика 'Уникальные посетители по часам': {e}")
+            raise
+
+    # График 2: Перцентили времени ответа по часам
+    with span('figure:latency_percentiles'):
+        try:
+            percentiles = hourly.melt(id_vars='time', value_vars=['p50', 'p95', 'p99'],
+                                      var_name='percentile', value_name='response_time')
+            fig2 = px.line(percentiles, x='time', y='response_time', color='percentile',
+                           title=f"Перцентили времени ответа по часам (за период p50 ≈ {totals['p50']:.0f}, "
+                                 f"p95 ≈ {totals['p95']:.0f}, p99 ≈ {totals['p99']:.0f})",
+                           labels={'time': 'Время (CET)', 'response_time': 'Время ответа', 'percentile': 'Перцентиль'})
+        except Exception as e:
+            logging.error(f"Ошибка при построении графика 'Перцентили времени ответа по часам': {e}")
+            raise
+
+    # График 3: Перцентили времени ответа по самым частым API-путям
+    with span('figure:latency_by_path'):
+        try:
+            by_path = approx['paths'].melt(id_vars='api_path', value_vars=['p50', 'p95', 'p99'],
+                                           var_name='percentile', value_name='response_time')
+            fig3 = px.bar(by_path, x='response_time', y='api_path', color='percentile', orientation='h',
+                          barmode='group', title='Перцентили времени ответа по API-путям (Топ по запросам)',
+                          labels={'response_time': 'Время ответа', 'api_path': 'АПИ путь', 'percentile': 'Перцентиль'})
+        except Exception as e:
+            logging.error(f"Ошибка при построении графика 'Перцентили времени ответа по API-путям': {e}")
+            raise
+
+    logging.info("Графики по скетчам успешно обновлены")
+
+    return fig1, fig2, fig3
+
+
+def fetch_latency_histograms(start_date=None, end_date=None, status_code=None, request_type=None):
+    '''
+    Гистограммы времени ответа с фиксированными корзинами, сложенные на стороне бэкенда:
+    в дашборд приходят счетчики корзин, а не значения response_time.
+    '''
+    filters = normalize_filters(start_date, end_date, status_code, request_type)
+    try:
+        backend = get_backend()
+        with ExitStack() as stack:
+            with span('connect'):
+                conn = stack.enter_context(backend.connect())
+            histograms = backend.latency_histograms(conn, filters)
+        logging.info("Гистограммы времени ответа успешно получены")
+    except Exception as e:
+        logging.error(f"Ошибка при получении гистограмм времени ответа из базы: {e}")
+        raise
+    return histograms
+
+
+@app.callback(
+    [
+        # Для вкладки "Производительность"
+        Output('latency-percentiles-over-time', 'figure'),
+        Output('latency-heatmap', 'figure')
+    ],
+    [
+        Input('date-picker-range', 'start_date'),
+        Input('date-picker-range', 'end_date'),
+        Input('status-code-dropdown', 'value'),
+        Input('request-type-dropdown', 'value')
+    ]
+)
+@traced('update_latency_graphs', defer=finish_after_response)
+@profiled('update_latency_graphs', requested=requested_profile_mode)
+def update_latency_graphs(start_date, end_date, status_code, request_type):
+    logging.info("Обновление графиков времени ответа...")
+
+    ignored = ignored_sketch_filters(get_backend(), normalize_filters(start_date, end_date, status_code, request_type))
+    if ignored:
+        logging.info(f"Графики времени ответа не строятся: фильтры {ignored} к гистограммам не применяются")
+        return ignored_filters_figures(LATENCY_TITLES, ignored)
+
+    try:
+        with span('aggregates'):
+            histograms = fetch_latency_histograms(start_date, end_date, status_code, request_type)
+    except Exception as e:
+        logging.error(f"Ошибка при загрузке гистограмм для графиков: {e}")
+        raise
+
+    with span('figures'):
+        return build_latency_figures(histograms)
+
+
+def build_latency_figures(histograms):
+    '''
+    Строит графики по гистограммам времени ответа (hour_bucket, api_path, bucket, count):
+    перцентили по API-путям во времени и тепловую карту времени ответа.
+    '''
+    histograms = histograms.assign(
+        time=pd.to_datetime(histograms['hour_bucket'] * 3600, unit='s', utc=True).dt.tz_convert(DASHBOARD_TIMEZONE)
+    )
+    by_path = histograms[histograms['api_path'] != ALL_PATHS]
+    overall = histograms[histograms['api_path'] == ALL_PATHS]
+
+    # График 1: Перцентили времени ответа по API-путям во времени
+    with span('figure:percentiles_over_time'):
+        try:
+            with span('aggregate'):
+                percentiles = histogram_percentiles(by_path, ['time', 'api_path'])
+            # Подграфики собираются через graph_objects: фасеты plotly.express заметно медленнее
+            fig1 = make_subplots(rows=3, cols=1, shared_xaxes=True, vertical_spacing=0.06,
+                                 subplot_titles=['p99', 'p95', 'p50'])
+            colors = px.colors.qualitative.Plotly
+            traces, rows = [], []
+            for index, (api_path, path_percentiles) in enumerate(percentiles.sort_values('time').groupby('api_path')):
+                for row, name in enumerate(['p99', 'p95', 'p50'], start=1):
+                    traces.append(go.Scatter(
+                        x=path_percentiles['time'], y=path_percentiles[name], mode='lines', name=api_path,
+                        legendgroup=api_path, showlegend=row == 1, line={'color': colors[index % len(colors)]},
+                        hovertemplate=f'{api_path} {name}: %{{y:.0f}}<extra></extra>'))
+                    rows.append(row)
+            if traces:
+                fig1.add_traces(traces, rows=rows, cols=[1] * len(traces))
+            fig1.update_layout(title='Перцентили времени ответа по API-путям во времени', legend_title_text='АПИ путь')
+            fig1.update_xaxes(title_text='Время (CET)', row=3, col=1)
+        except Exception as e:
+            logging.error(f"Ошибка при построении графика 'Перцентили времени ответа по API-путям во времени': {e}")
+            raise
+
+    # График 2: Тепловая карта времени ответа
+    with span('figure:latency_heatmap'):
+        try:
+            with span('aggregate'):
+                heatmap = overall.pivot_table(index='bucket', columns='time', values='count', aggfunc='sum', fill_value=0)
+                heatmap = heatmap.reindex(range(len(LATENCY_BUCKET_EDGES)), fill_value=0)
+            fig2 = go.Figure(go.Heatmap(
+                x=heatmap.columns, y=[latency_bucket_label(bucket) for bucket in heatmap.index], z=heatmap.to_numpy(),
+                colorscale='Viridis', colorbar={'title': 'Запросов'},
+                hovertemplate='%{x}<br>Время ответа: %{y}<br>Запросов: %{z}<extra></extra>'))
+            fig2.update_layout(title='Тепловая карта времени ответа',
+                               xaxis_title='Время (CET)', yaxis_title='Время ответа')
+            fig2.update_yaxes(type='category')
+        except Exception as e:
+            logging.error(f"Ошибка при построении графика 'Тепловая карта времени ответа': {e}")
+            raise
+
+    logging.info("Графики времени ответа успешно обновлены")
+
+    return fig1, fig2
+
+
+# Подписи размеров корзин временного ряда
+BUCKET_LABELS = {'second': 'секунда', 'minute': 'минута', 'hour': 'час', 'day': 'сутки'}
+
+
+def zoomed_range(relayout_data):
+    '''
+    Диапазон, выбранный приближением графика (relayoutData), в UTC или None.
+    Ось показывает время в DASHBOARD_TIMEZONE, поэтому границы локализуются в ней.
+    '''
+    if not relayout_data or 'xaxis.range[0]' not in relayout_data:
+        return None
+    start, end = (pd.Timestamp(relayout_data[f'xaxis.range[{i}]']) for i in (0, 1))
+    if start.tzinfo is None:
+        start, end = start.tz_localize(DASHBOARD_TIMEZONE), end.tz_localize(DASHBOARD_TIMEZONE)
+    return start.tz_convert('UTC'), end.tz_convert('UTC')
+
+
+@app.callback(
+    Output('requests-timeline', 'figure'),
+    [
+        Input('date-picker-range', 'start_date'),
+        Input('date-picker-range', 'end_date'),
+        Input('status-code-dropdown', 'value'),
+        Input('request-type-dropdown', 'value'),
+        Input('requests-timeline', 'relayoutData')
+    ]
+)
+@traced('update_timeline', defer=finish_after_response)
+@profiled('update_timeline', requested=requested_profile_mode)
+def update_timeline(start_date, end_date, status_code, request_type, relayout_data):
+    '''
+    График запросов во времени. При приближении ряд перезапрашивается за видимый диапазон
+    с более мелкими корзинами (агрегаты корзин кэшируются, см. log_export.timeseries).
+    '''
+    logging.info("Обновление временного ряда запросов...")
+    # Смена фильтров сбрасывает приближение
+    zoomed = zoomed_range(relayout_data) if dash.callback_context.triggered_id == 'requests-timeline' else None
+    if zoomed is not None:
+        start_date, end_date = zoomed
+
+    try:
+        with span('aggregates'):
+            series = get_timeseries(start_date, end_date, status_code, request_type)
+    except Exception as e:
+        logging.error(f"Ошибка при загрузке временного ряда: {e}")
+        raise
+
+    with span('figure:timeline'):
+        try:
+            points = pd.DataFrame(series['points'], columns=['time', 'count'])
+            points['time'] = pd.to_datetime(points['time'], unit='ms', utc=True).dt.tz_convert(DASHBOARD_TIMEZONE)
+            fig = px.line(points, x='time', y='count',
+                          title=f"Запросы во времени (корзина: {BUCKET_LABELS.get(series['bucket'], '—')}, "
+                                f"точек: {len(points)})",
+                          labels={'time': 'Время (CET)', 'count': 'Количество запросов'})
+            # Сохраняем приближение пользователя между обновлениями, пока не сменились фильтры
+            fig.update_layout(uirevision=str((start_date, end_date, status_code, request_type)) if zoomed is None else 'zoom')
+        except Exception as e:
+            logging.error(f"Ошибка при построении графика 'Запросы во времени': {e}")
+            raise
+
+    return fig
+
+
 if __name__ == '__main__':
     logging.info("Запуск приложения Dash...")
     app.run_server(debug=True)
@@ -91,8 +91,11 @@ dash_layout = html.Div([
                 ]),
                 dcc.Tab(label='⏱ Активность', children=[
                     html.Div([
+                        dcc.Graph(id='requests-timeline', className='dash-graph'),
                         dcc.Graph(id='requests-over-time-activity', className='dash-graph'),
                         dcc.Graph(id='top-api-paths-activity', className='dash-graph'),
+                        dcc.Graph(id='unique-visitors', className='dash-graph'),
+                        dcc.Graph(id='requests-by-country', className='dash-graph'),
                     ], className='grid-container')
                 ]),
                 dcc.Tab(label='🧾 Ответы', children=[
@@ -111,6 +114,10 @@ dash_layout = html.Div([
                     html.Div([
                         dcc.Graph(id='avg-response-time-performance', className='dash-graph'),
                         dcc.Graph(id='requests-over-time-performance', className='dash-graph'),
+                        dcc.Graph(id='latency-percentiles', className='dash-graph'),
+                        dcc.Graph(id='latency-percentiles-by-path', className='dash-graph'),
+                        dcc.Graph(id='latency-percentiles-over-time', className='dash-graph'),
+                        dcc.Graph(id='latency-heatmap', className='dash-graph'),
                     ], className='grid-container')
                 ]),
             ], style={'padding': '20px'})
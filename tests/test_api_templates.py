@@ -0,0 +1,32 @@
+"""Шаблоны API-путей (log2db.api_templates)"""
+
+import numpy as np
+import pytest
+from log2db.api_templates import compile_rules, path_template, template_indices
+
+RULES = compile_rules(['/repos/{owner}/{repo}', '/users/{login}'])
+
+
+@pytest.mark.parametrize('path, template', [
+    ('/users/42/orders?page=2', '/users/{id}/orders'),
+    ('/items/123e4567-e89b-12d3-a456-426614174000', '/items/{uuid}'),
+    ('/blobs/0123456789abcdef0123#top', '/blobs/{hash}'),
+    ('/blobs/deadbeefdeadbeefdeadbeef', '/blobs/deadbeefdeadbeefdeadbeef'),
+    ('/static/app.js', '/static/app.js'),
+    ('/', '/'),
+])
+def test_auto_segments(path, template):
+    assert path_template(path, {}) == template
+
+
+def test_rules_take_precedence():
+    assert path_template('/repos/octo/hello', RULES) == '/repos/{owner}/{repo}'
+    assert path_template('/users/alice', RULES) == '/users/{login}'
+    assert path_template('/users/alice/keys', RULES) == '/users/alice/keys'
+    assert path_template('/repos//hello', RULES) == '/repos//hello'
+
+
+def test_template_indices():
+    templates, indices = template_indices(['/a/1', '/a/2', '/b'], np.array([0, 1, -1, 2]))
+    assert templates == ['/a/{id}', '/b']
+    assert indices.tolist() == [0, 0, -1, 1]
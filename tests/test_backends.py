@@ -0,0 +1,23 @@
+import pytest
+
+from log_export.backends import get_backend, ignored_sketch_filters
+from log_export.queries import normalize_filters
+
+
+def test_postgres_sketches_ignore_status_and_method():
+    backend = get_backend('postgres')
+    filters = normalize_filters('2024-01-01', '2024-01-02', 200, 'GET')
+    assert ignored_sketch_filters(backend, filters) == ['status_code', 'request_type']
+    assert ignored_sketch_filters(backend, normalize_filters('2024-01-01', '2024-01-02', None, None)) == []
+
+
+def test_sharded_sketches_follow_postgres():
+    pytest.importorskip('psycopg')
+    backend = get_backend('sharded')
+    assert ignored_sketch_filters(backend, normalize_filters(None, None, None, 'POST')) == ['request_type']
+
+
+def test_duckdb_applies_all_filters():
+    pytest.importorskip('duckdb')
+    backend = get_backend('duckdb')
+    assert ignored_sketch_filters(backend, normalize_filters('2024-01-01', '2024-01-02', 404, 'GET')) == []
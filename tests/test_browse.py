@@ -0,0 +1,26 @@
+"""Курсоры страниц /logs (log_export.browse) и шаблоны поиска /search (log_export.search)"""
+
+import pytest
+from log_export.browse import encode_cursor, decode_cursor
+from log_export.search import like_pattern
+
+
+def test_cursor_round_trip():
+    assert decode_cursor(encode_cursor(1672531200000001, 42)) == (1672531200000001, 42)
+
+
+@pytest.mark.parametrize('cursor', ['', 'bad', '1_2_3', 'x_1', None])
+def test_bad_cursor(cursor):
+    with pytest.raises(ValueError):
+        decode_cursor(cursor)
+
+
+@pytest.mark.parametrize('pattern, expected', [
+    ('/api/v1', '/api/v1%'),
+    ('/api/*/orders', '/api/%/orders'),
+    ('*checkout*', '%checkout%'),
+    ('/100%_off', '/100\\%\\_off%'),
+    ('C:\\path', 'C:\\\\path%'),
+])
+def test_like_pattern(pattern, expected):
+    assert like_pattern(pattern) == expected
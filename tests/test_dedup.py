@@ -0,0 +1,77 @@
+"""Фильтр Блума и отбор повторов блока (log2db.dedup) без базы"""
+
+import numpy as np
+import pyarrow as pa
+from log2db.dedup import BloomFilter, LineDeduplicator, line_hash, _words
+
+
+def _hashes(count, prefix='line'):
+    return [line_hash(f"{prefix} {i}") for i in range(count)]
+
+
+def test_bloom_filter_has_no_false_negatives():
+    bloom = BloomFilter(10_000, 0.01)
+    words = _words(_hashes(5_000))
+    bloom.add(words)
+    assert bloom.contains(words).all()
+    assert bloom.count == 5_000
+
+
+def test_bloom_filter_false_positive_rate():
+    bloom = BloomFilter(10_000, 0.01)
+    bloom.add(_words(_hashes(10_000)))
+    false_positives = bloom.contains(_words(_hashes(20_000, prefix='other'))).mean()
+    assert false_positives < 0.03
+
+
+def test_bloom_filter_clear():
+    bloom = BloomFilter(100, 0.01)
+    words = _words(_hashes(10))
+    bloom.add(words)
+    bloom.clear()
+    assert not bloom.contains(words).any()
+    assert bloom.count == 0
+
+
+def _block(hashes):
+    return pa.table({'line_hash': pa.array(hashes, pa.string())})
+
+
+def test_keep_drops_repeats_and_existing_rows():
+    dedup = LineDeduplicator(capacity=1_000, error_rate=0.01)
+    a, b, c = _hashes(3)
+    table = _block([a, b, a, c])
+    repeated, candidates = dedup.candidates(table)
+    assert repeated.tolist() == [False, False, True, False]
+    assert candidates == []
+    # c уже в базе (хэш из базы — uuid с дефисами)
+    existing = [f"{c[:8]}-{c[8:12]}-{c[12:16]}-{c[16:20]}-{c[20:]}"]
+    kept, dropped = dedup.keep(table, repeated, existing)
+    assert kept['line_hash'].to_pylist() == [a, b]
+    assert dropped == 2
+
+
+def test_kept_rows_become_candidates():
+    dedup = LineDeduplicator(capacity=1_000, error_rate=0.01)
+    hashes = _hashes(5)
+    table = _block(hashes)
+    kept, _ = dedup.keep(table, np.zeros(5, dtype=bool), [])
+    repeated, candidates = dedup.candidates(_block(hashes[:2] + _hashes(1, prefix='new')))
+    assert not repeated.any()
+    assert set(hashes[:2]) <= set(candidates)
+
+
+def test_pending_facts_are_repeats():
+    dedup = LineDeduplicator(capacity=1_000, error_rate=0.01)
+    a, b = _hashes(2)
+    repeated, _ = dedup.candidates(_block([a, b]), pending=[_block([b])])
+    assert repeated.tolist() == [False, True]
+
+
+def test_filter_is_cleared_at_capacity():
+    dedup = LineDeduplicator(capacity=10, error_rate=0.01)
+    dedup.loaded_hours.add(1)
+    dedup.keep(_block(_hashes(8)), np.zeros(8, dtype=bool), [])
+    dedup.keep(_block(_hashes(8, prefix='more')), np.zeros(8, dtype=bool), [])
+    assert dedup.bloom.count == 8
+    assert dedup.loaded_hours == set()
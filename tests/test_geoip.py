@@ -0,0 +1,40 @@
+"""Поиск диапазонов адресов (log2db.geoip)"""
+
+import ipaddress
+from log2db.geoip import RangeIndex, GeoIPIndex, NO_GEO
+
+
+def _ip(text):
+    return int(ipaddress.ip_address(text))
+
+
+def test_range_index_lookup():
+    index = RangeIndex([
+        (_ip('10.0.0.0'), _ip('10.0.0.255'), ('AA', 1, 'one')),
+        (_ip('1.0.0.0'), _ip('1.0.0.255'), ('BB', 2, 'two')),
+    ])
+    assert index.find(_ip('1.0.0.7')) == ('BB', 2, 'two')
+    assert index.find(_ip('10.0.0.255')) == ('AA', 1, 'one')
+    assert index.find(_ip('10.0.1.0')) is None
+    assert index.find(_ip('0.255.255.255')) is None
+
+
+def test_range_index_merges_adjacent_ranges():
+    value = ('CC', 3, 'three')
+    index = RangeIndex([(_ip('2.0.0.0'), _ip('2.0.0.127'), value), (_ip('2.0.0.128'), _ip('2.0.0.255'), value),
+                        (_ip('2.0.1.0'), _ip('2.0.1.255'), ('DD', 4, 'four'))])
+    assert len(index) == 2
+    assert index.find(_ip('2.0.0.200')) == value
+
+
+def test_geoip_index_combines_sources():
+    countries = {4: RangeIndex([(_ip('8.8.8.0'), _ip('8.8.8.255'), ('US', None, None))]), 6: RangeIndex([])}
+    asns = {4: RangeIndex([(_ip('8.8.0.0'), _ip('8.8.255.255'), (None, 15169, 'GOOGLE'))]),
+            6: RangeIndex([(_ip('2001:db8::'), _ip('2001:db8::ffff'), ('ZZ', 64500, 'DOC'))])}
+    index = GeoIPIndex([countries, asns])
+    assert index.lookup('8.8.8.8') == ('US', 15169, 'GOOGLE')
+    assert index.lookup('8.8.4.4') == (None, 15169, 'GOOGLE')
+    assert index.lookup('::ffff:8.8.8.8') == ('US', 15169, 'GOOGLE')
+    assert index.lookup('2001:db8::1') == ('ZZ', 64500, 'DOC')
+    assert index.lookup('127.0.0.1') == NO_GEO
+    assert index.lookup('not-an-ip') == NO_GEO
@@ -0,0 +1,75 @@
+"""Колоночный разбор блока (columnar.parse_block) против построчного (parser.try_parse_log_line)"""
+
+import pytest
+from log2db.columnar import parse_block
+from log2db.parser import try_parse_log_line, REJECT_BAD_VALUE, REJECT_NO_MATCH
+
+ALT = '10.0.0.{n} - - [{ts}] "GET /items/{n}?page=2 HTTP/1.1" 200 {bytes} "https://ref.example/a" "Mozilla/5.0" {rt}'
+NGINX = ('10.0.1.{n} - frank [{ts}] "POST /api/v1/{n} HTTP/2.0" 404 {bytes} "-" "curl/8.0" {rt}')
+
+LINES = [
+    ALT.format(n=1, ts='2023-01-01 00:00:00 +0300', bytes=512, rt=15),
+    NGINX.format(n=2, ts='01/Jan/2023:00:00:05 +0000', bytes='-', rt='-'),
+    ALT.format(n=3, ts='2024-02-29 23:59:59 +0000', bytes=0, rt=0),
+    'not a log line',
+    ALT.format(n=4, ts='2023-02-30 10:00:00 +0300', bytes=1, rt=1),
+    NGINX.format(n=5, ts='31/Apr/2023:10:00:00 +0300', bytes=1, rt=1),
+    ALT.format(n=6, ts='2023-02-29 10:00:00 +0000', bytes=1, rt=1),
+    ALT.format(n=7, ts='2023-13-01 10:00:00 +0000', bytes=1, rt=1),
+    ALT.format(n=8, ts='2023-01-01 24:00:00 +0000', bytes=1, rt=1),
+    ALT.format(n=9, ts='2023-01-01 10:00:00 +0000', bytes=1, rt=99999999999),
+    ALT.format(n=10, ts='2023-01-01 10:00:00 +0000', bytes='9' * 19, rt=1),
+    ALT.format(n=11, ts='2023-01-01 10:00:00 +0000', bytes='9' * 18, rt=2**31 - 1),
+    NGINX.format(n=12, ts='15/Mar/2023:12:30:00 +0530', bytes=100, rt=7),
+]
+
+
+def _row_results(lines):
+    accepted, rejected = {}, {}
+    for index, line in enumerate(lines):
+        record, reason = try_parse_log_line(line.strip())
+        if record is None:
+            rejected[index] = reason[0]
+        else:
+            accepted[index] = record
+    return accepted, rejected
+
+
+def test_block_matches_rows():
+    table, line_index, rejected = parse_block(LINES)
+    accepted, row_rejected = _row_results(LINES)
+    assert {index: reason for index, reason, _ in rejected} == row_rejected
+    assert list(line_index) == sorted(accepted)
+    rows = table.to_pylist()
+    for index, row in zip(line_index, rows):
+        record = accepted[int(index)]
+        assert int(row['timestamp_utc'].timestamp() * 1_000_000) == record.timestamp_us
+        for name in ('ip_client', 'request_type', 'api_path', 'protocol', 'status_code', 'bytes_sent',
+                     'referrer', 'user_agent', 'response_time'):
+            assert row[name] == getattr(record, name), name
+
+
+@pytest.mark.parametrize('timestamp', ['2023-02-30 10:00:00 +0300', '2023-04-31 00:00:00 +0000',
+                                       '2023-02-29 00:00:00 +0000', '2023-01-01 24:00:00 +0000'])
+def test_impossible_dates_are_rejected(timestamp):
+    line = ALT.format(n=1, ts=timestamp, bytes=1, rt=1)
+    table, _, rejected = parse_block([line])
+    assert table.num_rows == 0
+    assert [reason for _, reason, _ in rejected] == [REJECT_BAD_VALUE]
+    assert try_parse_log_line(line)[1][0] == REJECT_BAD_VALUE
+
+
+@pytest.mark.parametrize('bytes_sent, response_time', [(1, 99999999999), (1, 2**31), ('9' * 19, 1)])
+def test_out_of_range_numbers_are_rejected(bytes_sent, response_time):
+    lines = [ALT.format(n=1, ts='2023-01-01 00:00:00 +0000', bytes=bytes_sent, rt=response_time),
+             ALT.format(n=2, ts='2023-01-01 00:00:00 +0000', bytes=1, rt=1)]
+    table, line_index, rejected = parse_block(lines)
+    assert list(line_index) == [1]
+    assert rejected == [(0, REJECT_BAD_VALUE, 'number out of range')]
+    assert try_parse_log_line(lines[0]) == (None, (REJECT_BAD_VALUE, 'number out of range'))
+
+
+def test_unmatched_lines():
+    table, line_index, rejected = parse_block(['', 'garbage'])
+    assert table.num_rows == 0 and len(line_index) == 0
+    assert rejected == [(0, REJECT_NO_MATCH, None), (1, REJECT_NO_MATCH, None)]
@@ -0,0 +1,63 @@
+"""HyperLogLog и DDSketch (log2db.sketches): точность, слияние и сериализация"""
+
+import numpy as np
+import pytest
+from log2db.sketches import HyperLogLog, DDSketch
+
+
+def test_hyperloglog_accuracy():
+    hll = HyperLogLog(14)
+    for i in range(50_000):
+        hll.add(f"10.0.{i // 256}.{i % 256}-{i}")
+    assert hll.estimate() == pytest.approx(50_000, rel=0.03)
+
+
+def test_hyperloglog_small_cardinality():
+    hll = HyperLogLog(12)
+    for value in ('a', 'b', 'c', 'a', 'b'):
+        hll.add(value)
+    assert round(hll.estimate()) == 3
+
+
+def test_hyperloglog_merge_equals_union():
+    left, right, union = HyperLogLog(12), HyperLogLog(12), HyperLogLog(12)
+    for i in range(20_000):
+        value = f"ip-{i}"
+        (left if i % 2 else right).add(value)
+        union.add(value)
+    for i in range(10_000):
+        left.add(f"ip-{i}")
+    left.merge(right)
+    assert left.registers == union.registers
+    assert HyperLogLog.from_bytes(left.to_bytes()).registers == left.registers
+
+
+def test_hyperloglog_rejects_different_precision():
+    with pytest.raises(ValueError):
+        HyperLogLog(12).merge(HyperLogLog(14))
+
+
+def test_ddsketch_relative_accuracy():
+    values = np.random.default_rng(1).lognormal(mean=5, sigma=1.5, size=20_000)
+    sketch = DDSketch(0.01)
+    for value in values:
+        sketch.add(value)
+    for q in (0.5, 0.95, 0.99):
+        assert sketch.quantile(q) == pytest.approx(np.quantile(values, q, method='lower'), rel=0.02)
+
+
+def test_ddsketch_merge_and_zeros():
+    left, right, whole = DDSketch(0.01), DDSketch(0.01), DDSketch(0.01)
+    for value in range(0, 2_000):
+        (left if value % 3 else right).add(value)
+        whole.add(value)
+    left.merge(right)
+    assert left.bins == whole.bins
+    assert (left.count, left.zero_count) == (2_000, 1)
+    restored = DDSketch.from_bytes(left.to_bytes())
+    assert restored.bins == left.bins and restored.count == left.count
+    assert restored.quantile(0.5) == pytest.approx(1_000, rel=0.02)
+
+
+def test_empty_ddsketch_quantile_is_nan():
+    assert np.isnan(DDSketch(0.01).quantile(0.5))
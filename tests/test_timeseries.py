@@ -0,0 +1,63 @@
+"""Прореживание LTTB и загрузка корзин временного ряда кусками с кэшем (log_export.timeseries)"""
+
+import numpy as np
+import pandas as pd
+from log_export.timeseries import lttb, load_buckets, ChunkCache, CHUNK_BUCKETS
+
+
+def test_lttb_keeps_ends_and_peaks():
+    x = np.arange(1_000)
+    y = np.sin(x / 50.0)
+    y[437] = 10
+    selected = lttb(x, y, 50)
+    assert len(selected) == 50
+    assert selected[0] == 0 and selected[-1] == 999
+    assert (np.diff(selected) > 0).all()
+    assert 437 in selected
+
+
+def test_lttb_short_series_is_unchanged():
+    assert lttb([1, 2, 3], [3, 2, 1], 10).tolist() == [0, 1, 2]
+    assert lttb(range(10), range(10), 2).tolist() == list(range(10))
+
+
+class FakeBackend:
+    """Бэкенд с одной строкой на корзину; запоминает запрошенные диапазоны."""
+    __name__ = 'fake'
+
+    def __init__(self):
+        self.requests = []
+
+    def timeseries(self, _conn, filters, seconds):
+        start, end = int(filters['start_date'].timestamp()), int(filters['end_date'].timestamp())
+        self.requests.append((start, end))
+        buckets = np.arange(start // seconds * seconds, end + 1, seconds)
+        return pd.DataFrame({'bucket': buckets, 'count': np.ones(len(buckets), dtype=np.int64)})
+
+
+def _filters(start, end):
+    return {'start_date': pd.Timestamp(start, unit='s', tz='UTC'), 'end_date': pd.Timestamp(end, unit='s', tz='UTC')}
+
+
+def test_load_buckets_fetches_only_missing_chunks():
+    backend, cache = FakeBackend(), ChunkCache(max_chunks=100, ttl=60)
+    chunk = CHUNK_BUCKETS * 60
+    frame = load_buckets(backend, lambda: None, _filters(10 * chunk, 12 * chunk - 1), 'minute', cache)
+    assert len(frame) == 2 * CHUNK_BUCKETS
+    assert backend.requests == [(10 * chunk, 12 * chunk - 1)]
+    # Сдвиг диапазона: запрашивается только новый кусок
+    frame = load_buckets(backend, lambda: None, _filters(11 * chunk + 30, 13 * chunk - 1), 'minute', cache)
+    assert backend.requests[1:] == [(12 * chunk, 13 * chunk - 1)]
+    assert frame['bucket'].iloc[0] == 11 * chunk
+    assert frame['bucket'].iloc[-1] == 13 * chunk - 60
+    assert frame['bucket'].is_unique
+
+
+def test_load_buckets_does_not_connect_when_cached():
+    backend, cache = FakeBackend(), ChunkCache(max_chunks=100, ttl=60)
+    load_buckets(backend, lambda: None, _filters(0, 3_600), 'minute', cache)
+
+    def fail():
+        raise AssertionError("соединение не нужно")
+    frame = load_buckets(backend, fail, _filters(600, 1_200), 'minute', cache)
+    assert frame['bucket'].tolist() == list(range(600, 1_201, 60))